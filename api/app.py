@@ -1,16 +1,36 @@
 from __future__ import annotations
 from pathlib import Path
+import asyncio
 import logging
 import os
+from typing import Dict
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, PlainTextResponse, HTMLResponse
+from fastapi.responses import FileResponse, PlainTextResponse, HTMLResponse, JSONResponse
 from starlette.staticfiles import StaticFiles
 
+from .clients import client_gate
 from .config import settings
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, process_stats, registry
+from .retention import retention_service
+from .routes.batches import router as batches_router
+from .routes.files import router as files_router
 from .routes.jobs import router as jobs_router
-from .storage import BASE_DIR
+from .services.http_client import shared_http
+from .services.postprocess import postprocessor
+from .services.preprocess import preprocessor
+from .services.result_cache import result_cache
+from .services.router import provider_router
+from .services.singleflight import single_flight
+from .events import job_events
+from .job_store import import_legacy_jobs, job_store, publish_job_blobs
+from .startup import startup, warmup_steps
+from .storage import blob_store, ensure_storage_dirs
+from .queue import job_queue
+from .tasks import queue_stats, run_job
+from .worker import make_queue_worker
+from .worker_pool import worker_pool
 
 app = FastAPI(title="NanoImage API", version="0.1.0")
 
@@ -23,11 +43,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 上传大小上限：在解析 multipart（整包落到临时文件）之前按 Content-Length 拒绝
+@app.middleware("http")
+async def _limit_upload_size(request: Request, call_next):
+    limits = {"/api/jobs": settings.MAX_UPLOAD_BYTES, "/api/batches": settings.BATCH_MAX_BYTES}
+    limit = limits.get(request.url.path) if request.method == "POST" else None
+    if limit is not None:
+        length = request.headers.get("content-length")
+        # 预留 64KB 给 multipart 边界与表单字段
+        if length and length.isdigit() and int(length) > limit + 64 * 1024:
+            return JSONResponse({"detail": f"upload exceeds {limit} bytes"}, status_code=413)
+    return await call_next(request)
+
+
 # API routes
 app.include_router(jobs_router)
+app.include_router(batches_router)
 
-# Static files: serve storage as /files
-app.mount("/files", StaticFiles(directory=str(BASE_DIR), html=False), name="files")
+# 结果文件：只提供任务结果的 CAS blob（上传的输入图虽然也在 CAS 中，但不对外提供）与旧版 results/
+# （ETag、immutable 缓存、Range）；上传、任务记录等存储目录不对外暴露
+app.include_router(files_router)
 
 # Serve web frontend from /web to avoid overshadowing /api and /health
 
@@ -46,6 +81,58 @@ async def _log_config_on_startup():
     print(msg1)
     print(msg2)
 
+
+@app.on_event("startup")
+async def _start_worker_pool():
+    # 启动流程：各阶段计时（/ready 与 imagen_startup_phase_seconds）；重的导入与连接放到后台预热
+    with startup.phase("storage"):
+        ensure_storage_dirs()
+        for store in (job_store, blob_store, result_cache):
+            store.open()
+        # 从旧版 storage/jobs/*.json 升级：SQLite 为空时自动导入
+        imported = await asyncio.to_thread(import_legacy_jobs, job_store)
+        # 升级前写入的结果 blob 还没有 public 标记：按任务记录回填，旧结果链接继续可用
+        if imported or blob_store.needs_public_backfill:
+            await asyncio.to_thread(publish_job_blobs, job_store, blob_store)
+    job_events.bind(asyncio.get_running_loop())
+    with startup.phase("http"):
+        await shared_http.start()
+    with startup.phase("workers"):
+        if job_queue is None:
+            await worker_pool.start(run_job)
+        elif settings.QUEUE_EMBEDDED_WORKERS > 0:
+            # 持久队列 + 进程内消费者：单机部署无需另起 worker 进程
+            global _queue_worker
+            _queue_worker = make_queue_worker(settings.QUEUE_EMBEDDED_WORKERS)
+            await _queue_worker.recover()
+            await _queue_worker.start()
+    if settings.RETENTION_ENABLED:
+        _background_tasks.append(
+            asyncio.create_task(retention_service.run_forever(settings.RETENTION_INTERVAL), name="retention")
+        )
+    startup.serving()
+    if settings.STARTUP_WARMUP:
+        _background_tasks.append(asyncio.create_task(startup.warm_up(warmup_steps()), name="warmup"))
+
+
+@app.on_event("shutdown")
+async def _stop_worker_pool():
+    startup.stopping()
+    for t in _background_tasks:
+        t.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    await worker_pool.stop()
+    if _queue_worker is not None:
+        await _queue_worker.stop()
+    postprocessor.shutdown()
+    await shared_http.aclose()
+
+
+_background_tasks: list = []
+_queue_worker = None
+
+
 WEB_DIR = Path(__file__).resolve().parent.parent / "web"
 if WEB_DIR.exists():
     app.mount("/web", StaticFiles(directory=str(WEB_DIR), html=True), name="web")
@@ -110,11 +197,109 @@ def readme_html():
 
 @app.get("/health")
 def health():
+    """存活检查：进程能处理请求即返回 ok（不代表已就绪）。"""
     return {"status": "ok"}
 
 
+@app.get("/ready")
+def ready():
+    """就绪检查：启动流程与后台预热完成后返回 200，之前及关闭期间返回 503；附各阶段耗时与预热结果。"""
+    return JSONResponse(startup.status(), status_code=200 if startup.ready else 503)
+
+
+
+@app.get("/stats")
+def stats():
+    return {
+        "queue": queue_stats(),
+        "http": shared_http.stats(),
+        "providers": provider_router.stats(),
+        "cache": result_cache.stats(),
+        "blobs": blob_store.stats(),
+        "retention": retention_service.stats(),
+        "singleflight": single_flight.stats(),
+        "preprocess": preprocessor.stats(),
+        "postprocess": postprocessor.stats(),
+        "event_subscribers": job_events.subscribers(),
+        "clients": client_gate.stats(),
+        "startup": startup.status(),
+        "process": process_stats(),
+    }
+
+
+# ---- /metrics：Prometheus 文本格式 ----
+# 流水线计数与阶段耗时在 api.metrics 中直接记录；下面是渲染时从各组件读取的回调型指标
+def _provider_values(field: str, transform=float) -> Dict[tuple, float]:
+    return {(b.name,): transform(b.stats()[field]) for b in provider_router.backends}
+
+
+registry.gauge("imagen_queue_depth", "Jobs waiting in the job queue", fn=lambda: queue_stats()["depth"])
+registry.gauge("imagen_jobs_in_flight", "Jobs currently running", fn=lambda: queue_stats()["running"])
+registry.gauge(
+    "imagen_jobs_in_flight_by_type", "Running jobs per job type", ("job_type",),
+    fn=lambda: {(k,): v for k, v in queue_stats()["running_by_type"].items()},
+)
+registry.gauge(
+    "imagen_provider_in_flight", "Upstream calls in flight per backend", ("provider",),
+    fn=lambda: _provider_values("in_flight"),
+)
+registry.gauge(
+    "imagen_provider_breaker_open", "1 when the backend circuit breaker is not closed", ("provider",),
+    fn=lambda: _provider_values("breaker", lambda state: state != "closed"),
+)
+registry.counter(
+    "imagen_provider_retries_total", "Upstream retries per backend", ("provider",),
+    fn=lambda: _provider_values("retries"),
+)
+registry.counter(
+    "imagen_provider_short_circuited_total", "Calls rejected by an open circuit breaker", ("provider",),
+    fn=lambda: _provider_values("short_circuited"),
+)
+registry.counter("imagen_router_failovers_total", "Router failovers", fn=lambda: provider_router.failovers)
+registry.counter("imagen_router_hedges_total", "Hedged upstream requests", fn=lambda: provider_router.hedges)
+registry.counter(
+    "imagen_http_connections_total", "Shared HTTP client requests / new connections", ("kind",),
+    fn=lambda: {("requests",): shared_http.requests, ("new_connections",): shared_http.new_connections},
+)
+registry.counter(
+    "imagen_result_cache_total", "Result cache lookups", ("outcome",),
+    fn=lambda: {("hit",): result_cache.hits, ("miss",): result_cache.misses},
+)
+registry.counter(
+    "imagen_stage_cache_total", "Deterministic stage cache lookups", ("stage", "outcome"),
+    fn=lambda: dict(result_cache.stage_lookups),
+)
+registry.counter(
+    "imagen_singleflight_total", "Single-flight calls", ("role",),
+    fn=lambda: {("leader",): single_flight.leaders, ("follower",): single_flight.followers},
+)
+registry.counter(
+    "imagen_preprocess_total", "Preprocess memo lookups", ("outcome",),
+    fn=lambda: {("hit",): preprocessor.hits, ("miss",): preprocessor.misses},
+)
+registry.counter(
+    "imagen_postprocess_total", "Result post-processing runs", ("outcome",),
+    fn=lambda: {("success",): postprocessor.processed, ("failure",): postprocessor.failures},
+)
+registry.counter(
+    "imagen_client_jobs_total", "Client admission outcomes (accepted counts jobs; IP clients share client=\"ip\")",
+    ("client", "outcome"), fn=lambda: dict(client_gate.totals),
+)
+registry.gauge("imagen_event_subscribers", "Open SSE / WebSocket subscriptions", fn=job_events.subscribers)
+registry.gauge("imagen_blob_bytes", "Total bytes stored in the CAS blob store", fn=lambda: blob_store.stats()["bytes"])
+registry.gauge("imagen_process_rss_bytes", "Resident set size of this process", fn=lambda: process_stats()["rss_bytes"])
+registry.gauge("imagen_process_threads", "Threads in this process", fn=lambda: process_stats()["threads"])
+
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(registry.render(), media_type=METRICS_CONTENT_TYPE)
+
 
 @app.post("/ping")
 def ping():
     return {"ok": True}
 
+
+# 模块导入完成（uvicorn 随后执行 startup 事件）
+startup.mark("imported")
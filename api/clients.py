@@ -0,0 +1,231 @@
+from __future__ import annotations
+import hmac
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, Optional
+
+from fastapi import Request
+
+from .config import settings
+from .job_store import job_store
+
+logger = logging.getLogger("imagen.clients")
+
+ANONYMOUS = "anonymous"
+
+
+@dataclass(frozen=True)
+class ClientLimits:
+    rate: float  # 每秒提交请求数，0 表示不限
+    burst: int
+    max_active: int  # 排队 + 运行中的任务数上限，0 表示不限
+    max_running: int  # 任务池中同时运行的任务数上限，0 表示不限
+    weight: float  # 公平调度权重
+
+
+class ClientLimitExceeded(Exception):
+    """客户端超出速率或任务数上限，接口返回 429 并附带 Retry-After。"""
+
+    def __init__(self, client: str, reason: str, message: str, retry_after: int):
+        super().__init__(message)
+        self.client = client
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def client_identity(request: Request) -> str:
+    """
+    已配置的 API key（CLIENT_KEY_HEADER）-> "key:<名称>"；否则按来源 IP -> "ip:<地址>"。
+    未知 key 按 IP 识别，避免随意换 key 绕过限额。前置代理时用 CLIENT_TRUSTED_PROXIES 指定可信的转发层数。
+    """
+    key = request.headers.get(settings.CLIENT_KEY_HEADER)
+    if key:
+        for known, name in settings.CLIENT_API_KEYS.items():
+            if hmac.compare_digest(key.encode(), known.encode()):
+                return f"key:{name}"
+    host = request.client.host if request.client else ""
+    hops = settings.CLIENT_TRUSTED_PROXIES
+    if hops > 0:
+        # 每层可信代理在末尾追加它看到的来源地址，倒数第 hops 个即真实客户端
+        forwarded = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+        if len(forwarded) >= hops:
+            host = forwarded[-hops]
+    return f"ip:{host}" if host else ANONYMOUS
+
+
+def limits_for(client: Optional[str]) -> ClientLimits:
+    """默认值取 CLIENT_*；CLIENT_OVERRIDES 可按完整标识（如 "key:partner"、"ip:10.0.0.5"）覆盖任意字段。"""
+    o = settings.CLIENT_OVERRIDES.get(client or "", {})
+    return ClientLimits(
+        rate=float(o.get("rate", settings.CLIENT_RATE_LIMIT)),
+        burst=max(1, int(o.get("burst", settings.CLIENT_RATE_BURST))),
+        max_active=int(o.get("max_active", settings.CLIENT_MAX_ACTIVE_JOBS)),
+        max_running=int(o.get("max_running", settings.CLIENT_MAX_RUNNING)),
+        weight=max(0.01, float(o.get("weight", settings.CLIENT_WEIGHT))),
+    )
+
+
+LimitsFor = Callable[[Optional[str]], ClientLimits]
+
+
+def metric_client(client: str) -> str:
+    """指标标签：具名 API key 客户端保留名称，IP 客户端合并，避免标签基数无限增长。"""
+    return client if client.startswith("key:") else "ip"
+
+
+class _Usage:
+    __slots__ = ("tokens", "updated", "requests", "jobs", "rate_limited", "over_capacity", "last_seen")
+
+    def __init__(self, burst: int):
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.requests = 0
+        self.jobs = 0
+        self.rate_limited = 0
+        self.over_capacity = 0
+        self.last_seen = time.time()
+
+
+class ClientGate:
+    """
+    API 入口的按客户端准入：令牌桶限制提交频率（一次批量提交算一次），排队 + 运行中的任务数不超过 max_active。
+    任务数从任务记录中统计（需要 SQLite 任务存储；JOB_STORE=file 时不检查任务数），多个 API 进程 / 独立 worker 之间一致；令牌桶与用量计数保存在本进程内存中，
+    按最近使用保留至多 CLIENT_TRACKED_MAX 个客户端。
+    """
+
+    def __init__(self, max_tracked: int = 10000):
+        self.max_tracked = max(1, max_tracked)
+        self._clients: "OrderedDict[str, _Usage]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.totals: Dict[tuple, int] = {}  # (metric_client, outcome) -> 次数
+        self._warned_store = False
+
+    def _usage(self, client: str, limits: ClientLimits) -> _Usage:
+        usage = self._clients.get(client)
+        if usage is None:
+            usage = self._clients[client] = _Usage(limits.burst)
+            while len(self._clients) > self.max_tracked:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(client)
+        return usage
+
+    def _count(self, client: str, outcome: str, n: int = 1) -> None:
+        k = (metric_client(client), outcome)
+        self.totals[k] = self.totals.get(k, 0) + n
+
+    def admit(self, client: str, jobs: int = 1) -> None:
+        """
+        在保存上传之前调用：超出限额时抛出 ClientLimitExceeded；通过则预先扣除一个令牌。
+        之后的校验失败（上传被拒、队列已满）调用 refund() 退回令牌，任务写入后调用 accept() 记入用量。
+        """
+        if not settings.CLIENT_LIMITS_ENABLED:
+            return
+        limits = limits_for(client)
+        with self._lock:
+            usage = self._usage(client, limits)
+            usage.requests += 1
+            usage.last_seen = time.time()
+            if limits.rate > 0:
+                now = time.monotonic()
+                usage.tokens = min(limits.burst, usage.tokens + (now - usage.updated) * limits.rate)
+                usage.updated = now
+                if usage.tokens < 1:
+                    usage.rate_limited += 1
+                    self._count(client, "rate_limited")
+                    wait = (1 - usage.tokens) / limits.rate
+                    logger.debug("[clients] %s rate limited (%.2f tokens)", client, usage.tokens)
+                    raise ClientLimitExceeded(
+                        client,
+                        "rate",
+                        f"Rate limit exceeded for {client}: {limits.rate:g} submissions/s, burst {limits.burst}",
+                        max(1, int(wait + 0.999)),
+                    )
+        if limits.max_active > 0 and not job_store.counts_active and not self._warned_store:
+            self._warned_store = True
+            logger.warning(
+                "[clients] max active jobs per client needs JOB_STORE=sqlite; %s cannot count them, only the rate is limited",
+                type(job_store).__name__,
+            )
+        if limits.max_active > 0 and job_store.counts_active:
+            active = job_store.count_active(client)
+            if active + jobs > limits.max_active:
+                with self._lock:
+                    usage.over_capacity += 1
+                    self._count(client, "over_capacity")
+                logger.debug("[clients] %s over capacity: %d active + %d > %d", client, active, jobs, limits.max_active)
+                raise ClientLimitExceeded(
+                    client,
+                    "active",
+                    f"Too many active jobs for {client}: {active} queued or running, "
+                    f"{jobs} requested, limit {limits.max_active}",
+                    settings.JOB_QUEUE_RETRY_AFTER,
+                )
+        with self._lock:
+            if limits.rate > 0:
+                usage.tokens -= 1
+
+    def refund(self, client: str) -> None:
+        """admit() 通过但请求随后被拒绝（413/415/429 等）：退回令牌，不计入已接受的任务。"""
+        if not settings.CLIENT_LIMITS_ENABLED:
+            return
+        limits = limits_for(client)
+        with self._lock:
+            usage = self._clients.get(client)
+            if usage is not None and limits.rate > 0:
+                usage.tokens = min(limits.burst, usage.tokens + 1)
+
+    def accept(self, client: str, jobs: int = 1) -> None:
+        """任务记录已写入：计入该客户端的用量与 accepted 计数。"""
+        if not settings.CLIENT_LIMITS_ENABLED:
+            return
+        limits = limits_for(client)
+        with self._lock:
+            self._usage(client, limits).jobs += jobs
+            self._count(client, "accepted", jobs)
+
+    def usage(self, client: str) -> Dict[str, Any]:
+        """单个客户端的限额与用量（GET /api/usage）。"""
+        limits = limits_for(client)
+        with self._lock:
+            u = self._clients.get(client)
+            snapshot = (
+                {
+                    "requests": u.requests,
+                    "jobs": u.jobs,
+                    "rate_limited": u.rate_limited,
+                    "over_capacity": u.over_capacity,
+                    "tokens": round(min(limits.burst, u.tokens + (time.monotonic() - u.updated) * limits.rate), 2)
+                    if limits.rate > 0
+                    else None,
+                }
+                if u is not None
+                else {"requests": 0, "jobs": 0, "rate_limited": 0, "over_capacity": 0,
+                      "tokens": float(limits.burst) if limits.rate > 0 else None}
+            )
+        return {
+            "client": client,
+            "limits": asdict(limits),
+            "active_jobs": job_store.count_active(client) if job_store.counts_active else None,
+            "usage": snapshot,
+        }
+
+    def stats(self, top: int = 20) -> Dict[str, Any]:
+        with self._lock:
+            busiest = sorted(self._clients.items(), key=lambda kv: kv[1].jobs, reverse=True)[:top]
+            return {
+                "enabled": settings.CLIENT_LIMITS_ENABLED,
+                "tracked": len(self._clients),
+                "top": {
+                    c: {"jobs": u.jobs, "requests": u.requests, "rate_limited": u.rate_limited,
+                        "over_capacity": u.over_capacity}
+                    for c, u in busiest
+                },
+            }
+
+
+client_gate = ClientGate(max_tracked=settings.CLIENT_TRACKED_MAX)
+
@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import Any, Dict, List
 
 
 class Settings(BaseSettings):
@@ -12,22 +12,183 @@ class Settings(BaseSettings):
     # 默认图片模型名称（可在 .env 覆盖）
     GOOGLE_IMAGE_MODEL: str = "gemini-2.5-flash-image-preview"
 
+    # google-genai 没有异步客户端时，同步调用所用线程池的大小
+    GOOGLE_EXECUTOR_WORKERS: int = 8
+
     # Proxy（OpenAI 兼容）设置
     PROXY_BASE_URL: str = "https://api.laozhang.ai"  # 不带 /v1，代码里会拼接
     PROXY_API_KEY: str | None = None
     PROXY_MODEL: str = "gemini-2.5-flash-image-preview"  # 代理默认使用 Nano Banana（老张文档推荐）
 
+    # Proxy 共享连接池（app 生命周期内复用 TCP/TLS 连接）
+    PROXY_HTTP2: bool = False  # 需要 h2（pip install httpx[http2]）
+    PROXY_MAX_CONNECTIONS: int = 20
+    PROXY_MAX_KEEPALIVE: int = 10
+    PROXY_KEEPALIVE_EXPIRY: float = 60.0
+    PROXY_CONNECT_TIMEOUT: float = 10.0
+    PROXY_READ_TIMEOUT: float = 180.0
+    PROXY_WRITE_TIMEOUT: float = 60.0
+    PROXY_POOL_TIMEOUT: float = 30.0
+    # 流式响应（SSE）：每张图片的 base64 一结束就作为部分结果保存并推送，缩短首张结果的等待；可在 PROVIDER_BACKENDS 中按后端设置 stream
+    PROXY_STREAM: bool = False
+    PROXY_STREAM_MAX_EVENT_BYTES: int = 32 * 1024 * 1024  # 单个 SSE 事件的缓冲上限，超过视为上游错误
+
+    # 输入图预处理：按 EXIF 转正、去元数据、按 size 缩放并重新编码后再发给上游
+    PREPROCESS_ENABLED: bool = True
+    PREPROCESS_FORMAT: str = "JPEG"  # JPEG | WEBP | PNG
+    PREPROCESS_QUALITY: int = 90
+    PREPROCESS_MAX_EDGE: int = 2048
+    PREPROCESS_MEMO_ITEMS: int = 32
+
+    # 结果后处理（进程池）：缩略图、WebP/AVIF 版本、多图任务的总览图（JobTypeSpec.contact_sheet）；前端用 <picture> 按浏览器支持选择
+    POSTPROCESS_ENABLED: bool = True
+    POSTPROCESS_WORKERS: int = 2  # 进程数，0 表示在线程中执行
+    POSTPROCESS_FORMATS: List[str] = ["avif", "webp"]  # Pillow 不支持的编码器自动跳过
+    POSTPROCESS_QUALITY: int = 70
+    POSTPROCESS_THUMB_EDGE: int = 384  # 缩略图最长边
+    POSTPROCESS_MAX_EDGE: int = 2048  # 全尺寸版本的最长边上限
+    CONTACT_SHEET_TILE: int = 256  # 总览图每格边长
+    CONTACT_SHEET_GAP: int = 8
+
+    # 上游后端列表（provider router）；为空时按 PROVIDER 生成单个后端，兼容旧配置
+    # 每项：{"name": "proxy-a", "kind": "proxy" | "google", "base_url": ..., "api_key": ..., "model": ..., "weight": 1}
+    # 未填的字段取 PROXY_* / GOOGLE_* 的值；weight=0 表示只在故障转移/对冲时使用
+    PROVIDER_BACKENDS: List[Dict[str, Any]] = []
+    ROUTER_WINDOW: int = 50  # 每个后端保留最近多少次调用的延迟/成败
+    ROUTER_MIN_SAMPLES: int = 5  # 样本数达到后才按错误率判定不健康
+    ROUTER_ERROR_THRESHOLD: float = 0.5  # 错误率超过该值视为不健康，排到最后
+    ROUTER_COOLDOWN: float = 30.0  # 秒，不健康后端在最后一次失败后经过该时间重新参与排序（探测）
+    # 对冲请求：首选后端超过其延迟分位数仍未返回时，向次优后端再发一份，取先成功者
+    ROUTER_HEDGE: bool = False
+    ROUTER_HEDGE_QUANTILE: float = 0.95
+
+    # 上游调用的重试 / 限速 / 熔断（每个后端各自一套；PROVIDER_BACKENDS 中可用 rate_limit、rate_burst、max_in_flight 覆盖）
+    RETRY_MAX_ATTEMPTS: int = 3  # 含首次调用
+    RETRY_BASE_DELAY: float = 0.5  # 秒，指数退避基数（full jitter）
+    RETRY_MAX_DELAY: float = 20.0  # 秒，单次等待上限（含 Retry-After）
+    RETRY_STATUS_CODES: List[int] = [408, 429, 500, 502, 503, 504]
+    PROVIDER_RATE_LIMIT: float = 0  # 每秒请求数，0 表示不限
+    PROVIDER_RATE_BURST: int = 5
+    PROVIDER_MAX_IN_FLIGHT: int = 8
+    PROVIDER_ATTEMPT_TIMEOUT: float = 180.0  # 秒，单次调用总时长上限，0 表示不限
+    BREAKER_FAILURE_THRESHOLD: int = 5  # 连续多少次上游故障后熔断
+    BREAKER_RESET_TIMEOUT: float = 30.0  # 秒，熔断后多久放行探测请求
+
     # 可选：失败是否禁用回退
     IMAGEN_DISABLE_FALLBACK: bool = False
 
     # 本地开发存储目录（生产建议使用对象存储 GCS/S3）
     STORAGE_DIR: str = "storage"
 
+    # SSE / WebSocket 推送的心跳间隔（秒），心跳时也会重新读取一次任务记录
+    JOB_EVENTS_HEARTBEAT: float = 15.0
+    JOB_EVENTS_POLL: float = 1.0  # 持久队列模式下（worker 在其他进程）重新读取任务记录的间隔
+
+    # 任务记录存储：sqlite（WAL，默认）| file（旧版 storage/jobs/*.json）
+    JOB_STORE: str = "sqlite"
+    JOB_DB_PATH: str = ""  # 为空时使用 <STORAGE_DIR>/jobs.db
+
+    # CAS blob 垃圾回收：引用归零且超过宽限期的 blob 由保留服务删除
+    BLOB_GC_GRACE: int = 3600  # 秒
+
+    # 存储保留策略（后台服务 / python -m api.retention）
+    # jobs: 已结束任务的保留期；blobs: CAS 总大小上限；uploads/results: 旧版按任务分目录的文件
+    # 后台清理默认关闭（升级后不会自动删除已有数据）；建议先以 RETENTION_DRY_RUN=true 开启，确认 /stats 中的统计后再实际删除
+    RETENTION_ENABLED: bool = False
+    RETENTION_INTERVAL: int = 600  # 秒
+    RETENTION_BATCH: int = 100  # 每批删除的对象数
+    RETENTION_DRY_RUN: bool = False
+    RETENTION_POLICIES: Dict[str, Dict[str, float]] = {
+        "jobs": {"max_age_days": 30},
+        "blobs": {"max_bytes": 20 * 1024 ** 3},
+        "uploads": {"max_age_days": 30},
+        "results": {"max_age_days": 30},
+    }
+
+    # 结果文件服务（/files/blobs 与旧版 /files/results；其余存储目录不再对外暴露）
+    FILES_CACHE_MAX_AGE: int = 31536000  # 秒，CAS blob 内容不变：Cache-Control: public, max-age, immutable
+    FILES_LEGACY_MAX_AGE: int = 86400  # 秒，旧版 results/<job_id>/ 下的文件
+    # 交给前置反向代理发送文件（sendfile）："" 不启用 | "X-Accel-Redirect"（nginx internal location）| "X-Sendfile"
+    FILES_SENDFILE_HEADER: str = ""
+    FILES_SENDFILE_PREFIX: str = "/_storage/"  # X-Accel-Redirect 的内部路径前缀，对应 STORAGE_DIR
+    # 签名 URL：/files/blobs/... 302 到带过期时间与 HMAC 签名的对象地址（本地以 /objects 模拟对象存储）
+    FILES_SIGNED_URLS: bool = False
+    FILES_SIGNING_KEY: str = ""  # 为空时使用 storage/.signing_key（首次使用时生成）；多节点不共享 storage/ 时须显式设置
+    FILES_SIGNED_URL_TTL: int = 3600  # 秒
+    FILES_OBJECT_BASE_URL: str = ""  # 为空时使用本服务的 /objects
+
+    # 启动流程（api.startup）：打开存储、启动任务池后即开始接收请求；Pillow / 进程池 / 上游客户端与连接在后台预热
+    # /health 只表示进程存活；/ready 在启动流程与预热完成前（以及关闭期间）返回 503
+    STARTUP_WARMUP: bool = True
+    WARMUP_TIMEOUT: float = 20.0  # 秒，单个预热步骤的时限；超时或失败只记录，不阻塞就绪
+    WARMUP_CONNECTIONS: int = 2  # 每个代理后端预建的连接数（受 PROXY_MAX_KEEPALIVE 限制）
+    WARMUP_PROXY_PATH: str = "/v1/models"  # 预建连接时请求的轻量路径
+
+    # 上传大小上限（字节），超过返回 413
+    MAX_UPLOAD_BYTES: int = 20 * 1024 * 1024
+
     # CORS 设置（开发环境允许所有，生产请收紧）
     ALLOWED_ORIGINS: List[str] = ["*"]
 
-    # 任务队列（可选 Celery+Redis），此处占位
-    REDIS_URL: str = "redis://localhost:6379/0"
+    # 进程内任务池：并发 worker 数、排队上限（超过返回 429）、按类型的并发上限
+    WORKER_POOL_SIZE: int = 4
+    JOB_QUEUE_LIMIT: int = 100
+    JOB_QUEUE_RETRY_AFTER: int = 5  # 秒，429 响应中的 Retry-After
+    JOB_TYPE_CONCURRENCY: Dict[str, int] = {"hairstyle_grid": 2}
+    # 优先级：数值越小越先执行；params.priority 只能在该类型默认优先级到 +JOB_PRIORITY_CLIENT_RANGE 之间调整
+    # （客户端只能把自己的任务往后放，不能插到全局队列前面），超出范围返回 400
+    JOB_PRIORITY_DEFAULT: int = 10
+    JOB_TYPE_PRIORITY: Dict[str, int] = {"hairstyle_grid": 20}
+    JOB_PRIORITY_CLIENT_RANGE: int = 10
+
+    # 按客户端的准入与公平调度：客户端按 API key（CLIENT_API_KEYS 中登记的 key -> 名称）或来源 IP 识别
+    # 超出提交频率或排队 + 运行中的任务数上限时返回 429（带 Retry-After）；任务池与持久队列在客户端之间按权重公平调度（不受开关影响）
+    # 默认关闭：部署在反向代理之后须先设置 CLIENT_TRUSTED_PROXIES，否则所有用户共用代理的 IP，共享同一份限额
+    # 任务数上限需要 SQLite 任务存储（JOB_STORE=file 时只限制频率）
+    CLIENT_LIMITS_ENABLED: bool = False
+    CLIENT_KEY_HEADER: str = "X-API-Key"
+    CLIENT_API_KEYS: Dict[str, str] = {}  # {key: 名称}，未登记的 key 按 IP 识别
+    CLIENT_TRUSTED_PROXIES: int = 0  # 前置可信代理层数，>0 时从 X-Forwarded-For 取来源 IP
+    CLIENT_RATE_LIMIT: float = 2.0  # 每秒提交请求数（一次批量提交算一次），0 表示不限
+    CLIENT_RATE_BURST: int = 10
+    CLIENT_MAX_ACTIVE_JOBS: int = 500  # 排队 + 运行中的任务数上限（批量提交按文件数计），0 表示不限
+    CLIENT_MAX_RUNNING: int = 0  # 任务池中同时运行的任务数上限，0 表示只按权重公平分配
+    CLIENT_WEIGHT: float = 1.0  # 公平调度权重，越大分到的 worker 越多
+    # 按客户端标识覆盖上述限额，如 {"key:partner": {"rate": 10, "max_active": 2000, "weight": 4}, "ip:10.0.0.5": {"rate": 0}}
+    CLIENT_OVERRIDES: Dict[str, Dict[str, float]] = {}
+    CLIENT_TRACKED_MAX: int = 10000  # 内存中保留令牌桶与用量计数的客户端数（按最近使用淘汰）
+
+    # 批量任务（POST /api/batches）：单次请求的文件数/总字节上限、每个批次同时运行的子任务数
+    # 批次只在提交时检查一次队列容量，其子任务不再逐个受 JOB_QUEUE_LIMIT 限制
+    BATCH_MAX_FILES: int = 500
+    BATCH_MAX_BYTES: int = 1024 * 1024 * 1024
+    BATCH_CONCURRENCY: int = 2  # params.concurrency 可在 1..WORKER_POOL_SIZE 内覆盖
+    BATCH_ZIP_POLL: float = 1.0  # 秒，zip 下载等待未完成子任务时的轮询间隔
+    # 秒，zip 下载等待子任务的总时限（0 表示不限）；到时未结束的子任务在 manifest.json 中列为 missing
+    BATCH_ZIP_TIMEOUT: float = 1800.0
+
+    # 多图任务（hairstyle_grid / n>1）单个任务内的并发子请求上限
+    FANOUT_CONCURRENCY: int = 3
+    MAX_OUTPUTS_PER_JOB: int = 4  # params.n 的上限
+
+    # 结果缓存：相同输入图 + prompt + model + size + seed 直接复用已有结果
+    RESULT_CACHE_ENABLED: bool = True
+    RESULT_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024
+    # 后处理版本与总览图（阶段缓存）单独计算的字节上限，淘汰时不挤占上游结果
+    RESULT_CACHE_STAGE_MAX_BYTES: int = 512 * 1024 * 1024
+    RESULT_CACHE_TTL: int = 0  # 秒，0 表示不过期
+
+    # 任务队列：memory（默认，API 进程内的任务池执行）| sqlite | redis（持久队列，由 python -m api.worker 消费）
+    # 持久队列模式下 API 只负责入队，worker 进程可在多核 / 多节点上横向扩展
+    QUEUE_BACKEND: str = "memory"
+    QUEUE_DB_PATH: str = ""  # sqlite 队列文件，为空时使用 <STORAGE_DIR>/queue.db
+    REDIS_URL: str = "redis://localhost:6379/0"  # fakeredis:// 使用进程内的 fakeredis（本地 / 测试）
+    QUEUE_REDIS_PREFIX: str = "imagen:queue"
+    QUEUE_VISIBILITY_TIMEOUT: float = 60.0  # 秒，租约时长；worker 每 1/3 时长续约一次，崩溃后到期重新投递
+    QUEUE_POLL_INTERVAL: float = 0.5  # 秒，队列为空时 worker 的轮询间隔
+    QUEUE_MAX_DELIVERIES: int = 3  # 同一任务最多投递次数（含崩溃后的重投），超过则标记失败
+    QUEUE_WORKER_CONCURRENCY: int = 4  # 每个 worker 进程同时执行的任务数
+    QUEUE_EMBEDDED_WORKERS: int = 0  # 持久队列模式下 API 进程内额外运行的消费者数（单机部署用）
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,64 @@
+from __future__ import annotations
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Set
+
+logger = logging.getLogger("imagen.events")
+
+
+class JobEvents:
+    """
+    进程内 pub/sub：_update 每次写入任务记录后 publish 一份状态快照，
+    SSE / WebSocket 连接各自 subscribe 一个有界队列。
+    publish() 线程安全；订阅者消费过慢时丢弃最旧的快照（快照是全量状态，丢中间值无妨）。
+    """
+
+    def __init__(self, queue_size: int = 32):
+        self.queue_size = queue_size
+        self._subs: Dict[str, Set[asyncio.Queue]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        q: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subs.setdefault(job_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, job_id: str, q: asyncio.Queue) -> None:
+        subs = self._subs.get(job_id)
+        if subs is None:
+            return
+        subs.discard(q)
+        if not subs:
+            self._subs.pop(job_id, None)
+
+    def publish(self, job_id: str, event: Dict[str, Any]) -> None:
+        if job_id not in self._subs or self._loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._deliver(job_id, event)
+        else:
+            self._loop.call_soon_threadsafe(self._deliver, job_id, event)
+
+    def _deliver(self, job_id: str, event: Dict[str, Any]) -> None:
+        for q in list(self._subs.get(job_id, ())):
+            if q.full():
+                try:
+                    q.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+            q.put_nowait(event)
+
+    def subscribers(self) -> int:
+        return sum(len(s) for s in self._subs.values())
+
+
+job_events = JobEvents()
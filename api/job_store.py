@@ -0,0 +1,392 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from .config import settings
+from .storage import BASE_DIR, JOBS_DIR, BlobStore, LazySQLite, batch_json_path, ensure_storage_dirs
+
+logger = logging.getLogger("imagen.job_store")
+
+
+class JobStore:
+    """任务记录存储接口。记录是 Job.model_dump() 形式的 dict；不存在时抛出 FileNotFoundError。"""
+
+    def open(self) -> None:
+        """提前打开底层存储（启动流程调用）；默认无操作。"""
+
+    def create(self, job: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def update(self, job_id: str, **patch: Any) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def delete(self, job_id: str) -> None:
+        raise NotImplementedError
+
+    def list(self, status: Optional[str] = None, before: Optional[float] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """按 created_at 升序列出任务，可按状态与创建时间过滤。"""
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    # 能否按客户端高效统计未结束任务（count_active）；按客户端的任务数上限只在支持的存储上生效
+    counts_active = False
+
+    def count_active(self, client: str) -> int:
+        """该客户端排队中 + 运行中的任务数。"""
+        raise NotImplementedError
+
+    def create_many(self, jobs: Iterable[Dict[str, Any]]) -> None:
+        for job in jobs:
+            self.create(job)
+
+    def get_many(self, job_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """按 id 批量读取；不存在的 id 不出现在结果中。"""
+        out = {}
+        for job_id in job_ids:
+            try:
+                out[job_id] = self.get(job_id)
+            except FileNotFoundError:
+                continue
+        return out
+
+    # 批量任务记录（Batch.model_dump()）：创建后只读，聚合状态由子任务实时计算
+    def create_batch(self, batch: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def get_batch(self, batch_id: str) -> Dict[str, Any]:
+        raise NotImplementedError
+
+
+class FileJobStore(JobStore):
+    """
+    旧版存储：storage/jobs/<id>.json。
+    写入采用临时文件 + os.replace 原子替换，轮询不会读到半截文件；进程内更新加锁串行。
+    """
+
+    def __init__(self, jobs_dir: Path = JOBS_DIR):
+        self.jobs_dir = jobs_dir
+        self._lock = threading.Lock()
+
+    def _path(self, job_id: str) -> Path:
+        return self.jobs_dir / f"{job_id}.json"
+
+    def _write(self, data: Dict[str, Any]) -> None:
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        p = self._path(data["id"])
+        fd, tmp = tempfile.mkstemp(dir=str(p.parent), prefix=f".{p.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, p)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+    def _read(self, p: Path) -> Dict[str, Any]:
+        data = json.loads(p.read_text(encoding="utf-8"))
+        if not data.get("created_at"):
+            data["created_at"] = p.stat().st_mtime
+        return data
+
+    def create(self, job: Dict[str, Any]) -> None:
+        with self._lock:
+            self._write(job)
+
+    def get(self, job_id: str) -> Dict[str, Any]:
+        p = self._path(job_id)
+        if not p.exists():
+            raise FileNotFoundError(f"Job {job_id} not found")
+        return self._read(p)
+
+    def update(self, job_id: str, **patch: Any) -> Dict[str, Any]:
+        with self._lock:
+            data = self.get(job_id)
+            data.update(patch)
+            self._write(data)
+            return data
+
+    def delete(self, job_id: str) -> None:
+        self._path(job_id).unlink(missing_ok=True)
+
+    def list(self, status: Optional[str] = None, before: Optional[float] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        out = []
+        for p in self.jobs_dir.glob("*.json"):
+            try:
+                data = self._read(p)
+            except (OSError, ValueError):
+                continue
+            if status and data.get("status") != status:
+                continue
+            if before is not None and data["created_at"] >= before:
+                continue
+            out.append(data)
+        out.sort(key=lambda d: d["created_at"])
+        return out[:limit]
+
+    def count(self) -> int:
+        return sum(1 for _ in self.jobs_dir.glob("*.json"))
+
+    def create_batch(self, batch: Dict[str, Any]) -> None:
+        ensure_storage_dirs()
+        p = batch_json_path(batch["id"])
+        fd, tmp = tempfile.mkstemp(dir=str(p.parent), prefix=f".{p.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(batch, f, ensure_ascii=False)
+            os.replace(tmp, p)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+    def get_batch(self, batch_id: str) -> Dict[str, Any]:
+        p = batch_json_path(batch_id)
+        if not p.exists():
+            raise FileNotFoundError(f"Batch {batch_id} not found")
+        return json.loads(p.read_text(encoding="utf-8"))
+
+
+class SQLiteJobStore(LazySQLite, JobStore):
+    """
+    SQLite（WAL）存储：每个任务一行，status / created_at / (client, status) 建索引。
+    更新在 BEGIN IMMEDIATE 事务内完成读-合并-写，单行原子；WAL 下读不阻塞写，多进程可共享同一数据库。
+    """
+
+    counts_active = True
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                type TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+            CREATE INDEX IF NOT EXISTS idx_jobs_created_at ON jobs(created_at);
+            CREATE TABLE IF NOT EXISTS batches (
+                id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            """
+        )
+        # 旧库升级：增加 client 列（提交方标识，用于按客户端统计未结束任务）并从记录中回填
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if "client" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN client TEXT")
+            conn.execute("UPDATE jobs SET client = json_extract(data, '$.client') WHERE json_extract(data, '$.client') IS NOT NULL")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_client_status ON jobs(client, status)")
+        return conn
+
+    def _upsert(self, data: Dict[str, Any], replace: bool) -> None:
+        verb = "INSERT OR REPLACE" if replace else "INSERT"
+        self._conn.execute(
+            f"{verb} INTO jobs (id, type, status, created_at, updated_at, client, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                data["id"],
+                data.get("type") or "",
+                data.get("status") or "pending",
+                data.get("created_at") or time.time(),
+                time.time(),
+                data.get("client"),
+                json.dumps(data, ensure_ascii=False),
+            ),
+        )
+
+    def create(self, job: Dict[str, Any]) -> None:
+        with self._lock:
+            self._upsert(job, replace=False)
+
+    def create_many(self, jobs: Iterable[Dict[str, Any]]) -> None:
+        # 一个事务写入整批，批量提交只付一次提交开销
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for job in jobs:
+                    self._upsert(job, replace=False)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get_many(self, job_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        ids = list(job_ids)
+        out: Dict[str, Dict[str, Any]] = {}
+        for i in range(0, len(ids), 500):  # SQLite 参数个数上限
+            chunk = ids[i: i + 500]
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT id, data FROM jobs WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+            out.update((r[0], json.loads(r[1])) for r in rows)
+        return out
+
+    def import_many(self, jobs: Iterable[Dict[str, Any]]) -> int:
+        n = 0
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for job in jobs:
+                    self._upsert(job, replace=True)
+                    n += 1
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return n
+
+    def get(self, job_id: str) -> Dict[str, Any]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"Job {job_id} not found")
+        return json.loads(row[0])
+
+    def update(self, job_id: str, **patch: Any) -> Dict[str, Any]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                if row is None:
+                    raise FileNotFoundError(f"Job {job_id} not found")
+                data = json.loads(row[0])
+                data.update(patch)
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, updated_at = ?, data = ? WHERE id = ?",
+                    (data.get("status") or "pending", time.time(), json.dumps(data, ensure_ascii=False), job_id),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return data
+
+    def delete(self, job_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def list(self, status: Optional[str] = None, before: Optional[float] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        sql = "SELECT data FROM jobs"
+        where, args = [], []
+        if status:
+            where.append("status = ?")
+            args.append(status)
+        if before is not None:
+            where.append("created_at < ?")
+            args.append(before)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created_at LIMIT ?"
+        args.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def count_active(self, client: str) -> int:
+        # (client, status) 索引：只访问该客户端的未结束任务
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE client = ? AND status IN ('pending', 'running')", (client,)
+            ).fetchone()[0]
+
+    def create_batch(self, batch: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO batches (id, created_at, data) VALUES (?, ?, ?)",
+                (batch["id"], batch.get("created_at") or time.time(), json.dumps(batch, ensure_ascii=False)),
+            )
+
+    def get_batch(self, batch_id: str) -> Dict[str, Any]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"Batch {batch_id} not found")
+        return json.loads(row[0])
+
+
+def make_job_store() -> JobStore:
+    backend = settings.JOB_STORE.lower()
+    if backend == "file":
+        return FileJobStore()
+    if backend == "sqlite":
+        return SQLiteJobStore(Path(settings.JOB_DB_PATH) if settings.JOB_DB_PATH else BASE_DIR / "jobs.db")
+    raise ValueError(f"unknown JOB_STORE: {settings.JOB_STORE}")
+
+
+job_store = make_job_store()
+
+
+def migrate_json_jobs(target: SQLiteJobStore, jobs_dir: Path = JOBS_DIR, dry_run: bool = False) -> int:
+    """把旧版 storage/jobs/*.json 导入 SQLite（按 id 覆盖，可重复执行）。"""
+    legacy = FileJobStore(jobs_dir)
+    jobs = legacy.list(limit=1 << 62)
+    if dry_run:
+        return len(jobs)
+    return target.import_many(jobs)
+
+
+def import_legacy_jobs(store: JobStore, jobs_dir: Path = JOBS_DIR) -> int:
+    """
+    SQLite 存储为空、而旧版 storage/jobs/ 下有任务时自动导入（启动流程调用），升级后旧任务不会变成 404。
+    按 id 覆盖写入，多个进程同时启动也只是重复导入同一批记录。
+    """
+    if not isinstance(store, SQLiteJobStore) or store.count() or not any(jobs_dir.glob("*.json")):
+        return 0
+    n = migrate_json_jobs(store, jobs_dir)
+    logger.info("[job_store] imported %d legacy job(s) from %s into %s", n, jobs_dir, store.path)
+    return n
+
+
+def publish_job_blobs(store: JobStore, blobs: BlobStore) -> int:
+    """把任务记录引用的结果 blob（result_blobs / variant_blobs）标记为可公开；blobs.db 升级或导入旧任务后调用。"""
+    digests = {
+        d
+        for data in store.list(limit=1 << 62)
+        for d in (*(data.get("result_blobs") or []), *(data.get("variant_blobs") or []))
+    }
+    blobs.publish(sorted(digests))
+    logger.info("[job_store] marked %d result blob(s) as public", len(digests))
+    return len(digests)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="NanoImage job store tools")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    mig = sub.add_parser("migrate", help="import storage/jobs/*.json into the SQLite job store")
+    mig.add_argument("--jobs-dir", default=str(JOBS_DIR))
+    mig.add_argument("--db", default=settings.JOB_DB_PATH or str(BASE_DIR / "jobs.db"))
+    mig.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    if args.cmd == "migrate":
+        n = migrate_json_jobs(SQLiteJobStore(Path(args.db)), Path(args.jobs_dir), dry_run=args.dry_run)
+        print(f"{'would import' if args.dry_run else 'imported'} {n} job(s) from {args.jobs_dir} into {args.db}")
@@ -0,0 +1,247 @@
+from __future__ import annotations
+import asyncio
+import contextvars
+import functools
+import math
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Prometheus 文本格式（0.0.4）的最小实现：Counter / Gauge / Histogram，外加回调型指标（渲染时取值）
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+LabelValues = Tuple[str, ...]
+# 回调返回单个值，或 {标签值元组: 值}
+Collect = Callable[[], Any]
+
+# 当前任务的默认标签（run_job 设置 job_type，router 为每个后端调用设置 provider），
+# asyncio.create_task 会复制上下文，子任务中的计时自动带上这些标签
+metric_labels: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar("metric_labels", default={})
+
+
+def set_metric_labels(**labels: str) -> contextvars.Token:
+    return metric_labels.set({**metric_labels.get(), **labels})
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _fmt_value(v: float) -> str:
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), fn: Optional[Collect] = None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._fn = fn
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _samples(self) -> Iterable[Tuple[str, str, float]]:
+        if self._fn is not None:
+            got = self._fn()
+            items = got.items() if isinstance(got, dict) else [((), got)]
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        for values, v in items:
+            values = values if isinstance(values, tuple) else (values,)
+            yield self.name, _fmt_labels(self.labelnames, values), float(v)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {_fmt_value(v)}" for name, labels, v in self._samples()]
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series: Dict[LabelValues, List[float]] = {}  # 各桶计数 + [sum, count]
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._series.items()]
+        for values, series in items:
+            for bound, count in zip(self.buckets, series):
+                le = "+Inf" if math.isinf(bound) else _fmt_value(bound)
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, values, ('le', le))} {_fmt_value(count)}")
+            labels = _fmt_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_fmt_value(series[-2])}")
+            lines.append(f"{self.name}_count{labels} {_fmt_value(series[-1])}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> Any:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = (), fn: Optional[Collect] = None) -> Counter:
+        return self.register(Counter(name, help, labelnames, fn))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = (), fn: Optional[Collect] = None) -> Gauge:
+        return self.register(Gauge(name, help, labelnames, fn))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            try:
+                lines += metric.render()
+            except Exception:
+                # 单个回调出错不影响其余指标
+                continue
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# ---- 流水线指标 ----
+STAGE_SECONDS = registry.histogram(
+    "imagen_stage_seconds",
+    "Time spent in each pipeline stage",
+    ("stage", "job_type", "provider"),
+)
+JOBS = registry.counter("imagen_jobs_total", "Jobs that reached a terminal status", ("job_type", "status"))
+SLOTS = registry.counter(
+    "imagen_slots_total", "Per-output slot outcomes (success / failure / cache_hit)", ("job_type", "outcome")
+)
+FALLBACKS = registry.counter(
+    "imagen_fallbacks_total", "Results replaced by the original image after provider failure", ("job_type", "provider")
+)
+PROVIDER_CALLS = registry.counter(
+    "imagen_provider_calls_total", "Provider calls after retries (success / failure)", ("provider", "outcome")
+)
+
+# ---- 结果文件服务 ----
+FILE_RESPONSES = registry.counter(
+    "imagen_file_responses_total", "Result file responses (full / partial / not_modified / redirect)", ("route", "kind")
+)
+
+
+def observe_stage(stage: str, seconds: float, **labels: str) -> None:
+    merged = {**metric_labels.get(), **labels}
+    STAGE_SECONDS.observe(seconds, stage=stage, **merged)
+
+
+class stage_timer:
+    """
+    阶段计时：既可作上下文管理器（with / async with），也可作装饰器（同步或异步函数）。
+    标签缺省取 metric_labels 上下文（job_type / provider），显式传入的优先。
+        with stage_timer("result_save"): ...
+        @stage_timer("preprocess")
+        async def prepare(...): ...
+    """
+
+    def __init__(self, stage: str, **labels: str):
+        self.stage = stage
+        self.labels = labels
+        self._started: List[float] = []
+
+    def __enter__(self) -> "stage_timer":
+        self._started.append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        observe_stage(self.stage, time.perf_counter() - self._started.pop(), **self.labels)
+
+    async def __aenter__(self) -> "stage_timer":
+        return self.__enter__()
+
+    async def __aexit__(self, *exc: Any) -> None:
+        self.__exit__(*exc)
+
+    def __call__(self, fn: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    observe_stage(self.stage, time.perf_counter() - started, **self.labels)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe_stage(self.stage, time.perf_counter() - started, **self.labels)
+        return wrapper
+
+
+def process_stats() -> Dict[str, float]:
+    """进程 RSS（字节）与线程数；读取 /proc，其他平台退回 resource 的峰值 RSS。"""
+    rss = 0.0
+    try:
+        with open("/proc/self/statm") as f:
+            rss = float(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE"))
+    except (OSError, ValueError, IndexError):
+        try:
+            import resource
+            rss = float(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+        except Exception:
+            pass
+    return {"rss_bytes": rss, "threads": float(threading.active_count())}
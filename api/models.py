@@ -11,18 +11,95 @@ class Job(BaseModel):
     progress: int = 0
     params: Dict[str, Any] = {}
     input_path: Optional[str] = None
+    input_sha256: Optional[str] = None
     results: List[str] = []  # URL list
+    result_blobs: List[str] = []  # 结果对应的 CAS blob 摘要（与 results 一一对应）
+    variants: List[Optional[Dict[str, Any]]] = []  # 与 results 一一对应的缩略图 / WebP / AVIF 版本，后处理失败为 None
+    contact_sheet: Optional[str] = None  # hairstyle_grid 的平铺总览图 URL
+    variant_blobs: List[str] = []  # 后处理产物的 CAS blob 摘要
+    failed_slots: List[Dict[str, Any]] = []  # [{index, label, error}]
     error: Optional[str] = None
+    created_at: Optional[float] = None
+    batch_id: Optional[str] = None
+    client: Optional[str] = None  # 提交方标识（api.clients.client_identity），用于按客户端限额与公平调度
+
+
+class Batch(BaseModel):
+    id: str
+    type: str
+    params: Dict[str, Any] = {}
+    job_ids: List[str] = []  # 与上传顺序一致
+    filenames: List[str] = []
+    rejected: List[Dict[str, Any]] = []  # [{index, filename, error}]，未创建任务的文件
+    concurrency: int = 1
+    created_at: Optional[float] = None
+    client: Optional[str] = None
 
 
 class CreateJobResponse(BaseModel):
     job_id: str
 
 
+class CreateBatchResponse(BaseModel):
+    batch_id: str
+    job_ids: List[str] = []
+    rejected: List[Dict[str, Any]] = []
+
+
+class ImageSource(BaseModel):
+    type: str  # MIME，如 image/avif
+    width: int
+    url: str
+
+
+class ResultVariants(BaseModel):
+    """一张结果图的响应式版本：<picture> 中按 type 分组的 srcset，thumbnail 为 JPEG 兜底。"""
+    format: str  # 结果图的真实格式
+    width: int
+    height: int
+    thumbnail: Optional[str] = None
+    sources: List[ImageSource] = []
+
+
 class JobStatusResponse(BaseModel):
     id: str
     status: JobStatus
     progress: int
     results: List[str] = []
+    variants: List[Optional[ResultVariants]] = []
+    contact_sheet: Optional[str] = None
+    failed_slots: List[Dict[str, Any]] = []
     error: Optional[str] = None
 
+    @classmethod
+    def from_record(cls, data: Dict[str, Any]) -> "JobStatusResponse":
+        return cls(
+            id=data["id"],
+            status=data["status"],
+            progress=data.get("progress", 0),
+            results=[str(u) for u in data.get("results", [])],
+            variants=data.get("variants") or [],
+            contact_sheet=data.get("contact_sheet"),
+            failed_slots=data.get("failed_slots") or [],
+            error=data.get("error"),
+        )
+
+
+class BatchJobStatus(BaseModel):
+    id: str
+    filename: str
+    status: Literal["pending", "running", "finished", "failed", "expired"]
+    progress: int = 0
+    results: List[str] = []
+    error: Optional[str] = None
+
+
+class BatchStatusResponse(BaseModel):
+    id: str
+    type: str
+    status: Literal["pending", "running", "finished", "failed"]  # 全部结束且至少一个成功即 finished
+    progress: int
+    total: int
+    counts: Dict[str, int] = {}
+    jobs: List[BatchJobStatus] = []
+    rejected: List[Dict[str, Any]] = []
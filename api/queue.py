@@ -0,0 +1,573 @@
+from __future__ import annotations
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from .clients import LimitsFor, limits_for
+from .config import settings
+from .storage import BASE_DIR
+
+logger = logging.getLogger("imagen.queue")
+
+
+@dataclass
+class Lease:
+    """一次投递：receipt 是本次租约的凭证，ack / nack / extend 都须带上，过期后其他 worker 可重新领取。"""
+    job_id: str
+    job_type: str
+    group: Optional[str]
+    deliveries: int
+    receipt: str
+    client: str = ""
+
+
+class JobQueue:
+    """
+    持久化任务队列接口（QUEUE_BACKEND=sqlite | redis；memory 模式不使用本模块，仍由进程内 WorkerPool 调度）。
+    - enqueue 以 job_id 去重，可重复调用
+    - reserve 与进程内 WorkerPool 相同，按客户端加权公平调度（start-time fair queuing，虚拟时间保存在队列中，
+      多个 worker 进程共享）：从虚拟时间最小、且有可执行任务的客户端领取一条，客户端内部按 (priority, 提交顺序)；
+      遵守全局的按类型 / 按分组并发上限与按客户端的 max_running；租约 visibility_timeout 秒
+    - 处理完成 ack；worker 退出时 nack 放回；租约到期未续约（worker 崩溃）则在下一次 reserve 时自动放回
+    """
+
+    def enqueue(
+        self, job_id: str, job_type: str, priority: int = 0, group: Optional[str] = None, client: Optional[str] = None
+    ) -> bool:
+        raise NotImplementedError
+
+    def set_group_limit(self, group: str, limit: int) -> None:
+        raise NotImplementedError
+
+    def reserve(self, type_limits: Dict[str, int], visibility_timeout: float) -> Optional[Lease]:
+        raise NotImplementedError
+
+    def ack(self, lease: Lease) -> None:
+        raise NotImplementedError
+
+    def nack(self, lease: Lease) -> None:
+        """主动放回（worker 停止）：不计入投递次数。"""
+        raise NotImplementedError
+
+    def extend(self, lease: Lease, visibility_timeout: float) -> bool:
+        """续约；租约已失效（被放回或被其他 worker 领取）时返回 False。"""
+        raise NotImplementedError
+
+    def requeue_expired(self) -> int:
+        raise NotImplementedError
+
+    def state(self, job_id: str) -> Optional[str]:
+        """"ready" | "leased" | None（不在队列中）；租约已过期的视为 ready。"""
+        raise NotImplementedError
+
+    def depth(self) -> int:
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+
+class SQLiteJobQueue(JobQueue):
+    """SQLite（WAL）队列：不依赖外部服务，多进程共享同一文件；领取在 BEGIN IMMEDIATE 事务内完成。"""
+
+    def __init__(self, path: Path, client_limits: LimitsFor = limits_for):
+        self.path = path
+        self.client_limits = client_limits
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS queue (
+                job_id TEXT PRIMARY KEY,
+                job_type TEXT NOT NULL,
+                grp TEXT,
+                priority INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                lease_until REAL,
+                receipt TEXT,
+                deliveries INTEGER NOT NULL DEFAULT 0,
+                enqueued_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_queue_ready ON queue(state, priority, seq);
+            CREATE TABLE IF NOT EXISTS queue_groups (
+                grp TEXT PRIMARY KEY,
+                lim INTEGER NOT NULL
+            );
+            -- 公平调度：每个客户端下一个任务的虚拟开始时间；vtime 为最近一次领取的虚拟开始时间
+            CREATE TABLE IF NOT EXISTS queue_clients (
+                client TEXT PRIMARY KEY,
+                finish REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS queue_meta (
+                key TEXT PRIMARY KEY,
+                value REAL NOT NULL
+            );
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(queue)")}
+        if "client" not in columns:
+            # 旧版队列文件：已有的任务归入匿名客户端
+            self._conn.execute("ALTER TABLE queue ADD COLUMN client TEXT NOT NULL DEFAULT ''")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_queue_client ON queue(state, client, priority, seq)")
+
+    def _tx(self, fn):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def enqueue(
+        self, job_id: str, job_type: str, priority: int = 0, group: Optional[str] = None, client: Optional[str] = None
+    ) -> bool:
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO queue (job_id, job_type, grp, client, priority, seq, state, deliveries, enqueued_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, 'ready', 0, ?)",
+                (job_id, job_type, group, client or "", int(priority), time.time_ns(), now),
+            )
+        return cur.rowcount > 0
+
+    def set_group_limit(self, group: str, limit: int) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO queue_groups (grp, lim) VALUES (?, ?)", (group, max(1, int(limit))))
+
+    @staticmethod
+    def _requeue_expired(conn: sqlite3.Connection) -> int:
+        cur = conn.execute(
+            "UPDATE queue SET state = 'ready', receipt = NULL, lease_until = NULL "
+            "WHERE state = 'leased' AND lease_until < ?",
+            (time.time(),),
+        )
+        return cur.rowcount
+
+    def requeue_expired(self) -> int:
+        return self._tx(self._requeue_expired)
+
+    def reserve(self, type_limits: Dict[str, int], visibility_timeout: float) -> Optional[Lease]:
+        def _reserve(conn: sqlite3.Connection) -> Optional[Lease]:
+            if self._requeue_expired(conn):
+                logger.warning("[queue] requeued expired lease(s)")
+            running_type = dict(conn.execute(
+                "SELECT job_type, COUNT(*) FROM queue WHERE state = 'leased' GROUP BY job_type"
+            ).fetchall())
+            full_types = [t for t, lim in type_limits.items() if running_type.get(t, 0) >= lim]
+            full_groups = [r[0] for r in conn.execute(
+                "SELECT g.grp FROM queue_groups g WHERE g.lim <= "
+                "(SELECT COUNT(*) FROM queue q WHERE q.grp = g.grp AND q.state = 'leased')"
+            ).fetchall()]
+            where = "state = 'ready'"
+            args: list = []
+            if full_types:
+                where += f" AND job_type NOT IN ({','.join('?' * len(full_types))})"
+                args += full_types
+            if full_groups:
+                where += f" AND (grp IS NULL OR grp NOT IN ({','.join('?' * len(full_groups))}))"
+                args += full_groups
+            # 有可执行任务的客户端，按 (虚拟开始时间, 队首提交序号) 依次尝试，取第一个未达 max_running 的
+            heads = conn.execute(
+                f"SELECT client, MIN(seq) FROM queue WHERE {where} GROUP BY client", args
+            ).fetchall()
+            if not heads:
+                return None
+            running_client = dict(conn.execute(
+                "SELECT client, COUNT(*) FROM queue WHERE state = 'leased' GROUP BY client"
+            ).fetchall())
+            finish = dict(conn.execute("SELECT client, finish FROM queue_clients").fetchall())
+            vtime_row = conn.execute("SELECT value FROM queue_meta WHERE key = 'vtime'").fetchone()
+            vtime = vtime_row[0] if vtime_row else 0.0
+            for start, _, client in sorted((max(vtime, finish.get(c, 0.0)), seq, c) for c, seq in heads):
+                limits = self.client_limits(client or None)
+                if limits.max_running > 0 and running_client.get(client, 0) >= limits.max_running:
+                    continue
+                row = conn.execute(
+                    f"SELECT job_id, job_type, grp, deliveries FROM queue WHERE {where} AND client = ? "
+                    "ORDER BY priority, seq LIMIT 1",
+                    [*args, client],
+                ).fetchone()
+                conn.execute("INSERT OR REPLACE INTO queue_meta (key, value) VALUES ('vtime', ?)", (start,))
+                conn.execute(
+                    "INSERT OR REPLACE INTO queue_clients (client, finish) VALUES (?, ?)",
+                    (client, start + 1.0 / limits.weight),
+                )
+                receipt = uuid.uuid4().hex
+                conn.execute(
+                    "UPDATE queue SET state = 'leased', receipt = ?, lease_until = ?, deliveries = deliveries + 1 "
+                    "WHERE job_id = ?",
+                    (receipt, time.time() + visibility_timeout, row[0]),
+                )
+                return Lease(
+                    job_id=row[0], job_type=row[1], group=row[2], deliveries=row[3] + 1, receipt=receipt, client=client
+                )
+            return None
+
+        return self._tx(_reserve)
+
+    def ack(self, lease: Lease) -> None:
+        def _ack(conn: sqlite3.Connection) -> None:
+            conn.execute("DELETE FROM queue WHERE job_id = ? AND receipt = ?", (lease.job_id, lease.receipt))
+            # 客户端没有排队也没有运行中的任务时丢弃其虚拟时间；再次提交时从当前虚拟时间起步
+            conn.execute(
+                "DELETE FROM queue_clients WHERE client = ? AND NOT EXISTS (SELECT 1 FROM queue WHERE client = ?)",
+                (lease.client, lease.client),
+            )
+            if lease.group is not None:
+                conn.execute(
+                    "DELETE FROM queue_groups WHERE grp = ? AND NOT EXISTS (SELECT 1 FROM queue WHERE grp = ?)",
+                    (lease.group, lease.group),
+                )
+
+        self._tx(_ack)
+
+    def nack(self, lease: Lease) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE queue SET state = 'ready', receipt = NULL, lease_until = NULL, deliveries = deliveries - 1 "
+                "WHERE job_id = ? AND receipt = ?",
+                (lease.job_id, lease.receipt),
+            )
+
+    def extend(self, lease: Lease, visibility_timeout: float) -> bool:
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE queue SET lease_until = ? WHERE job_id = ? AND receipt = ? AND state = 'leased'",
+                (time.time() + visibility_timeout, lease.job_id, lease.receipt),
+            )
+        return cur.rowcount > 0
+
+    def state(self, job_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT state, lease_until FROM queue WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return "leased" if row[0] == "leased" and row[1] >= time.time() else "ready"
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM queue WHERE state = 'ready'").fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT state, job_type, COUNT(*) FROM queue GROUP BY state, job_type"
+            ).fetchall()
+        ready = sum(n for state, _, n in rows if state == "ready")
+        leased = {t: n for state, t, n in rows if state == "leased"}
+        return {
+            "backend": "sqlite",
+            "depth": ready,
+            "running": sum(leased.values()),
+            "running_by_type": leased,
+        }
+
+
+# ---- Redis ----
+# 数据结构（前缀 QUEUE_REDIS_PREFIX）：
+#   :ready  ZSET job_id -> priority * 1e10 + seq      :leased ZSET job_id -> 租约到期时间
+#   :ready:<client> ZSET 同 :ready，按客户端划分       :ready_clients SET 有排队任务的客户端
+#   :job:<id> HASH job_type / grp / client / score / deliveries / receipt
+#   :running_type / :running_group / :running_client HASH 计数
+#   :group_limits / :group_size / :client_size HASH   :finish HASH 客户端 -> 下一个任务的虚拟开始时间，:vtime
+# 所有状态变更在 Lua 脚本中原子完成；时间取 Redis 服务器的 TIME，多节点不依赖本机时钟。
+
+_LUA_NOW = "local t = redis.call('TIME'); local now = tonumber(t[1]) + tonumber(t[2]) / 1e6\n"
+
+_LUA_RELEASE = """
+local function make_ready(p, id, c, score)
+  redis.call('ZADD', p .. ':ready', score, id)
+  redis.call('ZADD', p .. ':ready:' .. c, score, id)
+  redis.call('SADD', p .. ':ready_clients', c)
+end
+local function release(p, id, to_ready)
+  local h = p .. ':job:' .. id
+  local jt = redis.call('HGET', h, 'job_type')
+  local g = redis.call('HGET', h, 'grp') or ''
+  local c = redis.call('HGET', h, 'client') or ''
+  redis.call('ZREM', p .. ':leased', id)
+  redis.call('HINCRBY', p .. ':running_type', jt, -1)
+  redis.call('HINCRBY', p .. ':running_client', c, -1)
+  if g ~= '' then redis.call('HINCRBY', p .. ':running_group', g, -1) end
+  redis.call('HDEL', h, 'receipt')
+  if to_ready then make_ready(p, id, c, redis.call('HGET', h, 'score')) end
+  return {g, c}
+end
+local function requeue_expired(p, now)
+  local expired = redis.call('ZRANGEBYSCORE', p .. ':leased', '-inf', now)
+  for _, id in ipairs(expired) do release(p, id, true) end
+  return #expired
+end
+"""
+
+_LUA_ENQUEUE = _LUA_RELEASE + """
+local p, id, jt, prio, g, c = ARGV[1], ARGV[2], ARGV[3], tonumber(ARGV[4]), ARGV[5], ARGV[6]
+local h = p .. ':job:' .. id
+if redis.call('EXISTS', h) == 1 then return 0 end
+local score = prio * 1e10 + redis.call('INCR', p .. ':seq')
+redis.call('HSET', h, 'job_type', jt, 'grp', g, 'client', c, 'score', score, 'deliveries', 0)
+make_ready(p, id, c, score)
+redis.call('HINCRBY', p .. ':client_size', c, 1)
+if g ~= '' then redis.call('HINCRBY', p .. ':group_size', g, 1) end
+return 1
+"""
+
+# ARGV: prefix, visibility_timeout, receipt, 类型数, (job_type, limit)...,
+#       默认权重, 默认 max_running, (client, weight, max_running)...
+_LUA_RESERVE = _LUA_NOW + _LUA_RELEASE + """
+local p, vt, receipt = ARGV[1], tonumber(ARGV[2]), ARGV[3]
+local requeued = requeue_expired(p, now)
+local limits = {}
+local i = 5
+for _ = 1, tonumber(ARGV[4]) do limits[ARGV[i]] = tonumber(ARGV[i + 1]); i = i + 2 end
+local default_weight, default_running = tonumber(ARGV[i]), tonumber(ARGV[i + 1])
+local weights, max_running = {}, {}
+for j = i + 2, #ARGV, 3 do weights[ARGV[j]] = tonumber(ARGV[j + 1]); max_running[ARGV[j]] = tonumber(ARGV[j + 2]) end
+
+local function eligible(id)
+  local h = p .. ':job:' .. id
+  local jt = redis.call('HGET', h, 'job_type')
+  local lim = limits[jt]
+  if lim and tonumber(redis.call('HGET', p .. ':running_type', jt) or '0') >= lim then return false end
+  local g = redis.call('HGET', h, 'grp') or ''
+  if g ~= '' then
+    local gl = redis.call('HGET', p .. ':group_limits', g)
+    if gl and tonumber(redis.call('HGET', p .. ':running_group', g) or '0') >= tonumber(gl) then return false end
+  end
+  return true
+end
+
+local function pick(c)
+  local offset = 0
+  while true do
+    local ids = redis.call('ZRANGE', p .. ':ready:' .. c, offset, offset + 99)
+    if #ids == 0 then return nil end
+    for _, id in ipairs(ids) do
+      if eligible(id) then return id end
+    end
+    offset = offset + 100
+  end
+end
+
+-- 有排队任务的客户端按 (虚拟开始时间, 队首 score) 依次尝试
+local vtime = tonumber(redis.call('GET', p .. ':vtime') or '0')
+local order = {}
+for _, c in ipairs(redis.call('SMEMBERS', p .. ':ready_clients')) do
+  local head = redis.call('ZRANGE', p .. ':ready:' .. c, 0, 0, 'WITHSCORES')
+  if #head == 0 then
+    redis.call('SREM', p .. ':ready_clients', c)
+  else
+    local start = math.max(vtime, tonumber(redis.call('HGET', p .. ':finish', c) or '0'))
+    table.insert(order, {start, tonumber(head[2]), c})
+  end
+end
+table.sort(order, function(a, b)
+  if a[1] ~= b[1] then return a[1] < b[1] end
+  return a[2] < b[2]
+end)
+for _, entry in ipairs(order) do
+  local start, c = entry[1], entry[3]
+  local mr = max_running[c] or default_running
+  local id = nil
+  if mr <= 0 or tonumber(redis.call('HGET', p .. ':running_client', c) or '0') < mr then id = pick(c) end
+  if id then
+    local h = p .. ':job:' .. id
+    local jt = redis.call('HGET', h, 'job_type')
+    local g = redis.call('HGET', h, 'grp') or ''
+    redis.call('ZREM', p .. ':ready', id)
+    redis.call('ZREM', p .. ':ready:' .. c, id)
+    redis.call('ZADD', p .. ':leased', now + vt, id)
+    redis.call('HINCRBY', p .. ':running_type', jt, 1)
+    redis.call('HINCRBY', p .. ':running_client', c, 1)
+    if g ~= '' then redis.call('HINCRBY', p .. ':running_group', g, 1) end
+    local d = redis.call('HINCRBY', h, 'deliveries', 1)
+    redis.call('HSET', h, 'receipt', receipt)
+    redis.call('SET', p .. ':vtime', tostring(start))
+    redis.call('HSET', p .. ':finish', c, tostring(start + 1 / (weights[c] or default_weight)))
+    return {requeued, id, jt, g, d, c}
+  end
+end
+return {requeued}
+"""
+
+_LUA_ACK = _LUA_RELEASE + """
+local p, id, receipt = ARGV[1], ARGV[2], ARGV[3]
+local h = p .. ':job:' .. id
+if redis.call('HGET', h, 'receipt') ~= receipt then return 0 end
+local gc = release(p, id, false)
+local g, c = gc[1], gc[2]
+redis.call('DEL', h)
+if g ~= '' and redis.call('HINCRBY', p .. ':group_size', g, -1) <= 0 then
+  redis.call('HDEL', p .. ':group_size', g)
+  redis.call('HDEL', p .. ':group_limits', g)
+  redis.call('HDEL', p .. ':running_group', g)
+end
+-- 客户端没有排队也没有运行中的任务时丢弃其虚拟时间；再次提交时从当前虚拟时间起步
+if redis.call('HINCRBY', p .. ':client_size', c, -1) <= 0 then
+  redis.call('HDEL', p .. ':client_size', c)
+  redis.call('HDEL', p .. ':running_client', c)
+  redis.call('HDEL', p .. ':finish', c)
+end
+return 1
+"""
+
+_LUA_NACK = _LUA_RELEASE + """
+local p, id, receipt = ARGV[1], ARGV[2], ARGV[3]
+if redis.call('HGET', p .. ':job:' .. id, 'receipt') ~= receipt then return 0 end
+release(p, id, true)
+redis.call('HINCRBY', p .. ':job:' .. id, 'deliveries', -1)
+return 1
+"""
+
+_LUA_EXTEND = _LUA_NOW + """
+local p, id, receipt, vt = ARGV[1], ARGV[2], ARGV[3], tonumber(ARGV[4])
+if redis.call('HGET', p .. ':job:' .. id, 'receipt') ~= receipt then return 0 end
+redis.call('ZADD', p .. ':leased', 'XX', now + vt, id)
+return 1
+"""
+
+_LUA_REQUEUE = _LUA_NOW + _LUA_RELEASE + """
+return requeue_expired(ARGV[1], now)
+"""
+
+# 旧版队列数据（任务记录没有 client 字段）：归入匿名客户端，补上按客户端的索引与计数
+_LUA_MIGRATE = _LUA_RELEASE + """
+local p = ARGV[1]
+local n = 0
+for _, key in ipairs({':ready', ':leased'}) do
+  for _, id in ipairs(redis.call('ZRANGE', p .. key, 0, -1)) do
+    local h = p .. ':job:' .. id
+    if redis.call('HEXISTS', h, 'client') == 0 then
+      redis.call('HSET', h, 'client', '')
+      redis.call('HINCRBY', p .. ':client_size', '', 1)
+      if key == ':ready' then
+        make_ready(p, id, '', redis.call('HGET', h, 'score'))
+      else
+        redis.call('HINCRBY', p .. ':running_client', '', 1)
+      end
+      n = n + 1
+    end
+  end
+end
+return n
+"""
+
+
+class RedisJobQueue(JobQueue):
+    """
+    Redis 队列：多节点 worker 共享。需要 redis 包；REDIS_URL=fakeredis:// 时使用进程内的 fakeredis（本地 / 测试替身）。
+    """
+
+    def __init__(self, url: str, prefix: str = "imagen:queue", client_limits: LimitsFor = limits_for):
+        self.prefix = prefix
+        self.client_limits = client_limits
+        if url.startswith("fakeredis://"):
+            import fakeredis  # type: ignore
+
+            self._redis = fakeredis.FakeStrictRedis(decode_responses=True)
+        else:
+            import redis  # type: ignore
+
+            self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._enqueue = self._redis.register_script(_LUA_ENQUEUE)
+        self._reserve = self._redis.register_script(_LUA_RESERVE)
+        self._ack = self._redis.register_script(_LUA_ACK)
+        self._nack = self._redis.register_script(_LUA_NACK)
+        self._extend = self._redis.register_script(_LUA_EXTEND)
+        self._requeue = self._redis.register_script(_LUA_REQUEUE)
+        migrated = self._redis.register_script(_LUA_MIGRATE)(args=[self.prefix])
+        if migrated:
+            logger.info("[queue] assigned %d queued job(s) from an older queue layout to the anonymous client", migrated)
+
+    def _key(self, name: str) -> str:
+        return f"{self.prefix}:{name}"
+
+    def enqueue(
+        self, job_id: str, job_type: str, priority: int = 0, group: Optional[str] = None, client: Optional[str] = None
+    ) -> bool:
+        return bool(self._enqueue(args=[self.prefix, job_id, job_type, int(priority), group or "", client or ""]))
+
+    def set_group_limit(self, group: str, limit: int) -> None:
+        self._redis.hset(self._key("group_limits"), group, max(1, int(limit)))
+
+    def reserve(self, type_limits: Dict[str, int], visibility_timeout: float) -> Optional[Lease]:
+        receipt = uuid.uuid4().hex
+        args: list = [self.prefix, visibility_timeout, receipt, len(type_limits)]
+        for job_type, limit in type_limits.items():
+            args += [job_type, int(limit)]
+        # 客户端的权重与 max_running 来自配置，随脚本参数传入（未列出的客户端使用默认值）
+        default = self.client_limits(None)
+        args += [default.weight, default.max_running]
+        for client in self._redis.smembers(self._key("ready_clients")):
+            limits = self.client_limits(client or None)
+            args += [client, limits.weight, limits.max_running]
+        res = self._reserve(args=args)
+        if res and int(res[0]):
+            logger.warning("[queue] requeued %s expired lease(s)", res[0])
+        if len(res) < 6:
+            return None
+        _, job_id, job_type, group, deliveries, client = res
+        return Lease(
+            job_id=job_id, job_type=job_type, group=group or None, deliveries=int(deliveries), receipt=receipt,
+            client=client,
+        )
+
+    def ack(self, lease: Lease) -> None:
+        self._ack(args=[self.prefix, lease.job_id, lease.receipt])
+
+    def nack(self, lease: Lease) -> None:
+        self._nack(args=[self.prefix, lease.job_id, lease.receipt])
+
+    def extend(self, lease: Lease, visibility_timeout: float) -> bool:
+        return bool(self._extend(args=[self.prefix, lease.job_id, lease.receipt, visibility_timeout]))
+
+    def requeue_expired(self) -> int:
+        return int(self._requeue(args=[self.prefix]))
+
+    def state(self, job_id: str) -> Optional[str]:
+        if self._redis.zscore(self._key("ready"), job_id) is not None:
+            return "ready"
+        until = self._redis.zscore(self._key("leased"), job_id)
+        if until is None:
+            return None
+        sec, usec = self._redis.time()
+        return "leased" if until >= sec + usec / 1e6 else "ready"
+
+    def depth(self) -> int:
+        return int(self._redis.zcard(self._key("ready")))
+
+    def stats(self) -> Dict[str, Any]:
+        running = {k: int(v) for k, v in self._redis.hgetall(self._key("running_type")).items() if int(v) > 0}
+        return {
+            "backend": "redis",
+            "depth": self.depth(),
+            "running": int(self._redis.zcard(self._key("leased"))),
+            "running_by_type": running,
+        }
+
+
+def make_job_queue() -> Optional[JobQueue]:
+    backend = settings.QUEUE_BACKEND.lower()
+    if backend == "memory":
+        return None
+    if backend == "sqlite":
+        return SQLiteJobQueue(Path(settings.QUEUE_DB_PATH) if settings.QUEUE_DB_PATH else BASE_DIR / "queue.db")
+    if backend == "redis":
+        return RedisJobQueue(settings.REDIS_URL, settings.QUEUE_REDIS_PREFIX)
+    raise ValueError(f"unknown QUEUE_BACKEND: {settings.QUEUE_BACKEND}")
+
+
+# memory 模式下为 None：任务由 API 进程内的 WorkerPool 执行
+job_queue = make_job_queue()
@@ -0,0 +1,235 @@
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import settings
+from .job_store import JobStore, job_store
+from .storage import BlobStore, RESULTS_DIR, UPLOADS_DIR, blob_store, path_size, remove_path
+
+logger = logging.getLogger("imagen.retention")
+
+TERMINAL_STATUSES = ("finished", "failed")
+
+
+@dataclass
+class RetentionPolicy:
+    max_age: Optional[float] = None  # 秒
+    max_bytes: Optional[int] = None
+
+    @classmethod
+    def from_settings(cls, raw: Dict[str, Any]) -> "RetentionPolicy":
+        days = raw.get("max_age_days")
+        max_bytes = raw.get("max_bytes")
+        return cls(
+            max_age=float(days) * 86400 if days else None,
+            max_bytes=int(max_bytes) if max_bytes else None,
+        )
+
+
+class RetentionService:
+    """
+    storage/ 的保留与回收：
+    - jobs：已结束（finished/failed）且超过 max_age 的任务删除记录，并释放其输入/结果 blob 的引用
+    - blobs：仍被引用的 blob 总大小超过 max_bytes 时按创建时间从最早的已结束任务开始删除；
+      之后回收引用为 0 且超过 BLOB_GC_GRACE 的 blob
+    - uploads / results（旧版按任务分目录的文件）：按 max_age 与 max_bytes（最旧优先）删除
+    每批最多 RETENTION_BATCH 个对象，阻塞的文件系统操作放在线程里执行，批次之间让出事件循环。
+    """
+
+    def __init__(
+        self,
+        policies: Dict[str, RetentionPolicy],
+        jobs: JobStore,
+        blobs: BlobStore,
+        batch: int = 100,
+        dry_run: bool = False,
+    ):
+        self.policies = policies
+        self.jobs = jobs
+        self.blobs = blobs
+        self.batch = max(1, batch)
+        self.dry_run = dry_run
+        self.objects_removed: Dict[str, int] = {}
+        self.bytes_reclaimed: Dict[str, int] = {}
+        self.runs = 0
+        self.last_run_at: Optional[float] = None
+        self.last_run_seconds: Optional[float] = None
+
+    def _record(self, target: str, objects: int, nbytes: int) -> None:
+        self.objects_removed[target] = self.objects_removed.get(target, 0) + objects
+        self.bytes_reclaimed[target] = self.bytes_reclaimed.get(target, 0) + nbytes
+
+    # ---- jobs ----
+    def _delete_jobs(self, jobs: List[Dict[str, Any]]) -> Tuple[int, int]:
+        """删除一批任务记录；返回 (任务数, 旧版目录释放的字节数)。blob 字节在 gc 时计入。"""
+        freed = 0
+        for job in jobs:
+            digests = [
+                d
+                for d in [job.get("input_sha256"), *(job.get("result_blobs") or []), *(job.get("variant_blobs") or [])]
+                if d
+            ]
+            self.jobs.delete(job["id"])
+            self.blobs.decref(digests)
+            for legacy in (UPLOADS_DIR / job["id"], RESULTS_DIR / job["id"]):
+                freed += remove_path(legacy)
+        return len(jobs), freed
+
+    async def _expire_jobs(self, policy: RetentionPolicy) -> None:
+        if not policy.max_age:
+            return
+        cutoff = time.time() - policy.max_age
+        for status in TERMINAL_STATUSES:
+            if self.dry_run:
+                candidates = await asyncio.to_thread(self.jobs.list, status, cutoff, 1 << 30)
+                self._record("jobs", len(candidates), 0)
+                continue
+            while True:
+                batch = await asyncio.to_thread(self.jobs.list, status, cutoff, self.batch)
+                if not batch:
+                    break
+                n, freed = await asyncio.to_thread(self._delete_jobs, batch)
+                self._record("jobs", n, freed)
+                await asyncio.sleep(0)
+
+    # ---- blobs ----
+    async def _enforce_blob_quota(self, policy: RetentionPolicy) -> None:
+        if policy.max_bytes:
+            # 只按仍被引用的字节数删除任务：引用刚释放的 blob 同样要等过了 BLOB_GC_GRACE 才回收
+            # （其他进程可能正在重新引用它），这段时间内磁盘占用可短暂超出配额
+            total = await asyncio.to_thread(self._referenced_bytes)
+            while total > policy.max_bytes:
+                if self.dry_run:
+                    logger.info("[retention] dry-run: blobs over quota by %d bytes", total - policy.max_bytes)
+                    break
+                oldest: List[Dict[str, Any]] = []
+                for status in TERMINAL_STATUSES:
+                    oldest += await asyncio.to_thread(self.jobs.list, status, None, self.batch)
+                oldest = sorted(oldest, key=lambda j: j.get("created_at") or 0)[: self.batch]
+                if not oldest:
+                    break
+                n, freed = await asyncio.to_thread(self._delete_jobs, oldest)
+                self._record("jobs", n, freed)
+                total = await asyncio.to_thread(self._referenced_bytes)
+        await self._gc_blobs(grace=settings.BLOB_GC_GRACE)
+
+    def _referenced_bytes(self) -> int:
+        stats = self.blobs.stats()
+        return stats["bytes"] - stats["unreferenced_bytes"]
+
+    async def _gc_blobs(self, grace: float) -> None:
+        while True:
+            removed, freed = await asyncio.to_thread(self.blobs.gc, grace, self.batch, self.dry_run)
+            self._record("blobs", removed, freed)
+            if removed < self.batch or self.dry_run:
+                break
+            await asyncio.sleep(0)
+
+    # ---- legacy per-job directories ----
+    def _scan_dir(self, root: Path) -> List[Tuple[float, int, Path]]:
+        out = []
+        if not root.exists():
+            return out
+        with os.scandir(root) as it:
+            for entry in it:
+                try:
+                    mtime = entry.stat(follow_symlinks=False).st_mtime
+                except OSError:
+                    continue
+                out.append((mtime, path_size(Path(entry.path)), Path(entry.path)))
+        out.sort()
+        return out
+
+    def _remove_batch(self, paths: List[Tuple[float, int, Path]]) -> int:
+        if self.dry_run:
+            return sum(size for _, size, _ in paths)
+        return sum(remove_path(p) for _, _, p in paths)
+
+    async def _enforce_dir(self, name: str, root: Path, policy: RetentionPolicy) -> None:
+        if not policy.max_age and not policy.max_bytes:
+            return
+        entries = await asyncio.to_thread(self._scan_dir, root)
+        now = time.time()
+        victims = []
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:  # 最旧优先
+            too_old = bool(policy.max_age) and now - mtime > policy.max_age
+            over_quota = bool(policy.max_bytes) and total > policy.max_bytes
+            if not (too_old or over_quota):
+                break
+            victims.append((mtime, size, path))
+            total -= size
+        for i in range(0, len(victims), self.batch):
+            chunk = victims[i: i + self.batch]
+            freed = await asyncio.to_thread(self._remove_batch, chunk)
+            self._record(name, len(chunk), freed)
+            await asyncio.sleep(0)
+
+    # ---- entry points ----
+    async def run_once(self) -> Dict[str, Any]:
+        started = time.monotonic()
+        if "jobs" in self.policies:
+            await self._expire_jobs(self.policies["jobs"])
+        await self._enforce_blob_quota(self.policies.get("blobs", RetentionPolicy()))
+        for name, root in (("uploads", UPLOADS_DIR), ("results", RESULTS_DIR)):
+            if name in self.policies:
+                await self._enforce_dir(name, root, self.policies[name])
+        self.runs += 1
+        self.last_run_at = time.time()
+        self.last_run_seconds = time.monotonic() - started
+        logger.info(
+            "[retention] run done in %.2fs%s: removed=%s reclaimed=%s",
+            self.last_run_seconds, " (dry-run)" if self.dry_run else "",
+            self.objects_removed, self.bytes_reclaimed,
+        )
+        return self.stats()
+
+    async def run_forever(self, interval: float) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("[retention] run failed")
+            await asyncio.sleep(interval)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "dry_run": self.dry_run,
+            "runs": self.runs,
+            "last_run_at": self.last_run_at,
+            "last_run_seconds": self.last_run_seconds,
+            "objects_removed": dict(self.objects_removed),
+            "bytes_reclaimed": dict(self.bytes_reclaimed),
+        }
+
+
+def make_retention_service(dry_run: Optional[bool] = None) -> RetentionService:
+    policies = {name: RetentionPolicy.from_settings(raw) for name, raw in settings.RETENTION_POLICIES.items()}
+    return RetentionService(
+        policies,
+        jobs=job_store,
+        blobs=blob_store,
+        batch=settings.RETENTION_BATCH,
+        dry_run=settings.RETENTION_DRY_RUN if dry_run is None else dry_run,
+    )
+
+
+retention_service = make_retention_service()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the NanoImage storage retention pass once")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be removed")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    service = make_retention_service(dry_run=args.dry_run or None)
+    print(json.dumps(asyncio.run(service.run_once()), indent=2))
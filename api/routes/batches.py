@@ -0,0 +1,66 @@
+from __future__ import annotations
+import json
+from typing import Any, Dict, List
+
+from fastapi import APIRouter, File, Form, HTTPException, Request, UploadFile
+from fastapi.responses import StreamingResponse
+
+from ..clients import ClientLimitExceeded, client_identity
+from ..models import BatchStatusResponse, CreateBatchResponse
+from ..services.batch_service import batch_service
+from ..services.errors import InvalidJobRequest
+from ..storage import UploadRejected
+from ..worker_pool import QueueFullError
+from .jobs import client_limit_response
+
+router = APIRouter(prefix="/api")
+
+
+@router.post("/batches", response_model=CreateBatchResponse)
+async def create_batch(
+    request: Request,
+    type: str = Form(...),
+    params: str = Form("{}"),
+    files: List[UploadFile] = File(...),
+):
+    """一次请求提交多张图片，共用同一 type/params；params.concurrency 控制该批次同时运行的子任务数。"""
+    try:
+        parsed: Dict[str, Any] = json.loads(params or "{}")
+    except Exception:
+        raise HTTPException(status_code=400, detail="params must be JSON string")
+
+    try:
+        batch = await batch_service.create(type, parsed, files, client=client_identity(request))
+    except (UploadRejected, InvalidJobRequest) as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except ClientLimitExceeded as e:
+        raise client_limit_response(e)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too many queued jobs ({e.depth}), retry later",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    return {"batch_id": batch.id, "job_ids": batch.job_ids, "rejected": batch.rejected}
+
+
+@router.get("/batches/{batch_id}", response_model=BatchStatusResponse)
+def get_batch(batch_id: str):
+    try:
+        return batch_service.status(batch_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+
+@router.get("/batches/{batch_id}/zip")
+def download_batch(batch_id: str):
+    """流式 zip：子任务完成一个写出一个，全部结束后附 manifest.json 并关闭。"""
+    try:
+        batch_service.status(batch_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return StreamingResponse(
+        batch_service.zip_stream(batch_id),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="batch-{batch_id}.zip"'},
+    )
@@ -0,0 +1,126 @@
+from __future__ import annotations
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from mimetypes import guess_type
+from pathlib import Path
+from typing import Dict, Optional
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, RedirectResponse, Response
+
+from ..config import settings
+from ..metrics import FILE_RESPONSES
+from ..storage import BASE_DIR, RESULTS_DIR, blob_store, signed_blob_url, verify_blob_signature
+
+router = APIRouter()
+
+_BLOB_NAME = re.compile(r"^([0-9a-f]{64})\.([a-z0-9]{1,8})$")
+_LEGACY_NAME = re.compile(r"^[\w.-]+$")
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # If-None-Match 使用弱比较：忽略 W/ 前缀
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def _not_modified(request: Request, etag: str, st: os.stat_result) -> bool:
+    inm = request.headers.get("if-none-match")
+    if inm is not None:
+        return _etag_matches(inm, etag)
+    ims = request.headers.get("if-modified-since")
+    if ims:
+        try:
+            return int(st.st_mtime) <= parsedate_to_datetime(ims).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _serve(request: Request, path: Path, etag: str, cache_control: str, route: str) -> Response:
+    """
+    条件请求返回 304；否则由 FileResponse 发送（Range / If-Range、ASGI pathsend），
+    或在配置了 FILES_SENDFILE_HEADER 时只返回头部，交给前置代理用 sendfile 发送文件本体。
+    """
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    headers: Dict[str, str] = {
+        "ETag": etag,
+        "Cache-Control": cache_control,
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+    }
+    if _not_modified(request, etag, st):
+        FILE_RESPONSES.inc(route=route, kind="not_modified")
+        return Response(status_code=304, headers=headers)
+
+    media_type = guess_type(path.name)[0] or "application/octet-stream"
+    sendfile = settings.FILES_SENDFILE_HEADER
+    if sendfile:
+        rel = path.relative_to(BASE_DIR).as_posix()
+        target = str(path.resolve()) if sendfile.lower() == "x-sendfile" else settings.FILES_SENDFILE_PREFIX + rel
+        FILE_RESPONSES.inc(route=route, kind="offloaded")
+        return Response(headers={**headers, sendfile: target}, media_type=media_type)
+
+    FILE_RESPONSES.inc(route=route, kind="partial" if request.headers.get("range") else "full")
+    return FileResponse(path, headers=headers, media_type=media_type, stat_result=st)
+
+
+def _blob_path(name: str) -> Optional[Path]:
+    m = _BLOB_NAME.match(name)
+    return blob_store.path(m.group(1), m.group(2)) if m else None
+
+
+def _immutable() -> str:
+    return f"public, max-age={settings.FILES_CACHE_MAX_AGE}, immutable"
+
+
+@router.api_route("/files/blobs/{a}/{b}/{name}", methods=["GET", "HEAD"])
+def get_blob(a: str, b: str, name: str, request: Request):
+    """
+    CAS blob：内容由文件名中的 sha256 决定，永不改变，ETag 即摘要，可长期缓存。
+    只提供任务结果（blobs.db 中标记为 public）；上传的输入图等其他 blob 即使知道摘要也返回 404。
+    """
+    path = _blob_path(name)
+    if path is None or name[:2] != a or name[2:4] != b:
+        raise HTTPException(status_code=404, detail="File not found")
+    digest, ext = name.split(".", 1)
+    if not blob_store.is_public(digest):
+        raise HTTPException(status_code=404, detail="File not found")
+    if settings.FILES_SIGNED_URLS:
+        # 重定向本身只短期缓存；签名地址在同一时间窗口内不变，目标内容仍可长期缓存
+        FILE_RESPONSES.inc(route="blobs", kind="redirect")
+        return RedirectResponse(
+            signed_blob_url(digest, ext),
+            status_code=302,
+            headers={"Cache-Control": f"private, max-age={max(1, settings.FILES_SIGNED_URL_TTL // 4)}"},
+        )
+    return _serve(request, path, f'"{digest}"', _immutable(), "blobs")
+
+
+@router.api_route("/objects/{name}", methods=["GET", "HEAD"])
+def get_signed_object(name: str, request: Request, expires: int = 0, sig: str = ""):
+    """本地对象存储替身：校验签名与过期时间后发送 blob（生产中由 GCS/S3 的签名 URL 取代）。"""
+    path = _blob_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not verify_blob_signature(name, expires, sig):
+        raise HTTPException(status_code=403, detail="Invalid or expired signature")
+    return _serve(request, path, f'"{name.split(".", 1)[0]}"', _immutable(), "objects")
+
+
+@router.api_route("/files/results/{job_id}/{name}", methods=["GET", "HEAD"])
+def get_legacy_result(job_id: str, name: str, request: Request):
+    """旧版按任务分目录的结果文件：没有内容摘要，ETag 取 大小-修改时间。"""
+    if not all(_LEGACY_NAME.match(part) and not part.startswith(".") for part in (job_id, name)):
+        raise HTTPException(status_code=404, detail="File not found")
+    path = RESULTS_DIR / job_id / name
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    etag = f'"{st.st_size:x}-{int(st.st_mtime * 1000):x}"'
+    return _serve(request, path, etag, f"public, max-age={settings.FILES_LEGACY_MAX_AGE}", "results")
@@ -1,16 +1,28 @@
 from __future__ import annotations
+import asyncio
 import json
-from fastapi import APIRouter, File, Form, UploadFile, HTTPException
-from typing import Any, Dict
+from fastapi import APIRouter, File, Form, UploadFile, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from typing import Any, AsyncIterator, Dict, Optional
 
+from ..clients import ClientLimitExceeded, client_gate, client_identity
+from ..config import settings
+from ..events import job_events
 from ..models import CreateJobResponse, JobStatusResponse
+from ..queue import job_queue
 from ..services.job_service import job_service
+from ..services.errors import InvalidJobRequest
+from ..storage import UploadRejected
+from ..worker_pool import QueueFullError
 
 router = APIRouter(prefix="/api")
 
+TERMINAL_STATUSES = ("finished", "failed")
+
 
 @router.post("/jobs", response_model=CreateJobResponse)
-def create_job(
+async def create_job(
+    request: Request,
     type: str = Form(...),
     params: str = Form("{}"),
     file: UploadFile = File(...),
@@ -20,10 +32,36 @@ def create_job(
     except Exception:
         raise HTTPException(status_code=400, detail="params must be JSON string")
 
-    job_id = job_service.enqueue(type, parsed, file)
+    try:
+        job_id = await job_service.enqueue(type, parsed, file, client=client_identity(request))
+    except (UploadRejected, InvalidJobRequest) as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except ClientLimitExceeded as e:
+        raise client_limit_response(e)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too many queued jobs ({e.depth}), retry later",
+            headers={"Retry-After": str(e.retry_after)},
+        )
     return {"job_id": job_id}
 
 
+def client_limit_response(e: ClientLimitExceeded) -> HTTPException:
+    """429：detail 说明超出的是哪项限额（rate | active），Retry-After 给出建议的重试等待。"""
+    return HTTPException(
+        status_code=429,
+        detail={"error": "client_limit", "reason": e.reason, "message": str(e), "retry_after": e.retry_after},
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+@router.get("/usage")
+def get_usage(request: Request):
+    """调用方自己的限额、当前排队 + 运行中的任务数与用量计数。"""
+    return client_gate.usage(client_identity(request))
+
+
 @router.get("/jobs/{job_id}", response_model=JobStatusResponse)
 def get_job(job_id: str):
     try:
@@ -31,3 +69,85 @@ def get_job(job_id: str):
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Job not found")
 
+
+async def _snapshots(job_id: str, queue: asyncio.Queue) -> AsyncIterator[Optional[Dict[str, Any]]]:
+    """
+    依次产出任务状态快照，直到 finished/failed。
+    一段时间内没有推送时重新读取一次记录（变化则产出快照，否则每个心跳间隔产出 None 表示心跳）。
+    调用方须在此之前 subscribe，避免读取初始状态与订阅之间漏掉更新。
+    """
+    # 持久队列模式下任务多在其他 worker 进程执行，收不到推送，改为每 JOB_EVENTS_POLL 秒读取一次记录
+    poll = settings.JOB_EVENTS_HEARTBEAT
+    if job_queue is not None:
+        poll = min(settings.JOB_EVENTS_POLL, poll)
+    idle = 0.0
+    # 读取任务记录（SQLite / JSON 文件）在线程中执行，轮询不阻塞事件循环
+    snap = (await asyncio.to_thread(job_service.status, job_id)).model_dump()
+    yield snap
+    while snap["status"] not in TERMINAL_STATUSES:
+        try:
+            snap = await asyncio.wait_for(queue.get(), timeout=poll)
+        except asyncio.TimeoutError:
+            idle += poll
+            latest = (await asyncio.to_thread(job_service.status, job_id)).model_dump()
+            if latest == snap:
+                if idle >= settings.JOB_EVENTS_HEARTBEAT:
+                    idle = 0.0
+                    yield None
+                continue
+            snap = latest
+        idle = 0.0
+        yield snap
+
+
+@router.get("/jobs/{job_id}/events")
+async def job_events_stream(job_id: str, request: Request):
+    """Server-Sent Events：推送进度、状态与已完成的结果 URL，任务结束后关闭。"""
+    queue = job_events.subscribe(job_id)
+    try:
+        snapshots = _snapshots(job_id, queue)
+        first = await snapshots.__anext__()
+    except FileNotFoundError:
+        job_events.unsubscribe(job_id, queue)
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def _stream() -> AsyncIterator[str]:
+        try:
+            yield f"event: status\ndata: {json.dumps(first, ensure_ascii=False)}\n\n"
+            async for snap in snapshots:
+                if snap is None:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: status\ndata: {json.dumps(snap, ensure_ascii=False)}\n\n"
+        finally:
+            job_events.unsubscribe(job_id, queue)
+
+    return StreamingResponse(
+        _stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/jobs/{job_id}/ws")
+async def job_events_ws(websocket: WebSocket, job_id: str):
+    """WebSocket 版本：每条消息是一份 JobStatusResponse JSON（心跳为 {"type": "ping"}）。"""
+    queue = job_events.subscribe(job_id)
+    try:
+        snapshots = _snapshots(job_id, queue)
+        try:
+            first = await snapshots.__anext__()
+        except FileNotFoundError:
+            await websocket.close(code=4404)
+            return
+        await websocket.accept()
+        await websocket.send_json(first)
+        async for snap in snapshots:
+            await websocket.send_json(snap if snap is not None else {"type": "ping"})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        job_events.unsubscribe(job_id, queue)
@@ -0,0 +1,321 @@
+from __future__ import annotations
+import asyncio
+import base64
+import binascii
+import json
+import re
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+# 3 的倍数，保证每块 base64 编码后无填充、可直接拼接
+ENCODE_CHUNK = 3 * 64 * 1024
+_PLACEHOLDER = "\x00__NANOIMAGE_DATA_URL__\x00"
+
+Source = Union[bytes, bytearray, memoryview, Path]
+# 每解码完一张图片调用一次（部分结果）；最终结果仍以 call_edit 的返回值为准
+ImageCallback = Callable[[bytes], Awaitable[None]]
+
+
+class JsonBase64Body:
+    """
+    流式请求体：输出 JSON 信封，并把其中的 data URL 替换为按块编码的 base64，
+    不在内存中构造完整的 base64 字符串或 JSON 文本。
+    envelope 中值为 data_url_placeholder() 的字符串会被替换为 "data:<mime>;base64,<...>"。
+    """
+
+    def __init__(self, envelope: Dict[str, Any], mime: str, source: Source):
+        text = json.dumps(envelope, ensure_ascii=False)
+        placeholder = json.dumps(_PLACEHOLDER)[1:-1]
+        head, sep, tail = text.partition(placeholder)
+        if not sep:
+            raise ValueError("envelope does not contain data_url_placeholder()")
+        self._head = (head + f"data:{mime};base64,").encode("utf-8")
+        self._tail = tail.encode("utf-8")
+        self._source = source
+        raw_len = source.stat().st_size if isinstance(source, Path) else len(source)
+        self.content_length = len(self._head) + 4 * ((raw_len + 2) // 3) + len(self._tail)
+
+    async def _raw_chunks(self) -> AsyncIterator[memoryview]:
+        if isinstance(self._source, Path):
+            with self._source.open("rb") as f:
+                while True:
+                    chunk = await asyncio.to_thread(f.read, ENCODE_CHUNK)
+                    if not chunk:
+                        break
+                    yield memoryview(chunk)
+        else:
+            view = memoryview(self._source)
+            for i in range(0, len(view), ENCODE_CHUNK):
+                yield view[i: i + ENCODE_CHUNK]
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        yield self._head
+        async for chunk in self._raw_chunks():
+            yield base64.b64encode(chunk)
+        yield self._tail
+
+
+def data_url_placeholder() -> str:
+    return _PLACEHOLDER
+
+
+_NON_B64 = re.compile(rb"[^A-Za-z0-9+/=]")
+_MARKER = b"data:image"  # 其后是 "/" 或 JSON 转义的 "\\/"
+_HEADER_END = b";base64,"
+_SUBTYPE = re.compile(rb"(?:/|\\/)([A-Za-z0-9.+-]*)")
+_MAX_HEADER = 64
+_MARKER_HEAD = b"data"  # 标记中属于 base64 字母表的部分
+# SSE 中一个选择结束（finish_reason）或流结束（[DONE]）时送给扫描器的分隔：正在解码的图片在此结束
+BOUNDARY = b"\n"
+
+
+class DataUrlScanner:
+    """
+    增量解析响应体中的 data:image/...;base64, 片段，边到达边解码。
+    - 不解析整个 JSON：直接在原始字节流中查找，兼容 JSON 转义（\\/、\\uXXXX、\\n 等）
+    - 支持一个响应中出现多张图片；除正在解码的图片外只缓存最多 7 个字符的 base64 余量
+    - 图片在第一个非 base64 字符（")"、引号、空白等）处结束；填充 "=" 之后、以及紧接着出现的
+      下一个 "data:image" 也是边界，两张图片之间没有分隔符时不会合并
+    feed() 返回本次新完成的图片；流结束时调用 close() 取出最后一张。
+    """
+
+    def __init__(self):
+        self._state = "search"
+        self._buf = bytearray()  # search/header 阶段的待匹配字节
+        self._carry = b""  # data 阶段跨块的不完整转义序列
+        self._quantum = bytearray()  # 尚未凑满 4 个字符的 base64
+        self._out = bytearray()
+        self.mime_subtypes: List[str] = []
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        done: List[bytes] = []
+        rest: Optional[bytes] = bytes(chunk)
+        while rest:
+            if self._state == "search":
+                rest = self._search(rest)
+            elif self._state == "header":
+                rest = self._header(rest)
+            else:
+                rest = self._data(rest, done)
+        return done
+
+    def _search(self, data: bytes) -> Optional[bytes]:
+        self._buf += data
+        idx = self._buf.find(_MARKER)
+        if idx < 0:
+            # 只保留可能是标记前缀的尾部
+            del self._buf[: max(0, len(self._buf) - len(_MARKER) + 1)]
+            return None
+        rest = bytes(self._buf[idx + len(_MARKER):])
+        self._buf.clear()
+        self._state = "header"
+        return rest
+
+    def _header(self, data: bytes) -> Optional[bytes]:
+        self._buf += data
+        buf = bytes(self._buf)
+        m = _SUBTYPE.match(buf)
+        if m is None:
+            if buf == b"\\":
+                return None  # 可能是转义的 "\\/"，等待更多数据
+            return self._reset_to_search()
+        tail = buf[m.end(): m.end() + len(_HEADER_END)]
+        if not _HEADER_END.startswith(tail):
+            # 不是 data:image/<subtype>;base64,，回到查找状态
+            return self._reset_to_search()
+        if len(tail) < len(_HEADER_END):
+            return self._reset_to_search() if len(buf) > _MAX_HEADER else None
+        self.mime_subtypes.append(m.group(1).decode("ascii"))
+        self._buf.clear()
+        self._state = "data"
+        return buf[m.end() + len(_HEADER_END):]
+
+    def _reset_to_search(self) -> bytes:
+        rest = bytes(self._buf)
+        self._buf.clear()
+        self._state = "search"
+        return rest
+
+    def _data(self, data: bytes, done: List[bytes]) -> Optional[bytes]:
+        if self._carry:
+            data, self._carry = self._carry + data, b""
+        i = 0
+        while True:
+            if self._quantum.endswith(b"=") and data[i: i + 1] not in (b"", b"="):
+                # 填充已结束（可能在上一块末尾）：图片在此结束
+                self._finish(done)
+                return data[i:]
+            m = _NON_B64.search(data, i)
+            end = m.start() if m else len(data)
+            pad = data.find(b"=", i, end)
+            if pad >= 0:
+                pad_end = pad
+                while pad_end < len(data) and data[pad_end] == 0x3D:
+                    pad_end += 1
+                if pad_end < end:
+                    # 填充之后又出现 base64 字符：图片在填充处结束
+                    self._quantum += data[i:pad_end]
+                    self._finish(done)
+                    return data[pad_end:]
+            self._quantum += data[i:end]
+            if m is None:
+                self._flush()
+                return None
+            if data[end] == 0x5C:  # 反斜杠转义
+                esc = data[end + 1: end + 6]
+                if not esc or (esc[:1] == b"u" and len(esc) < 5):
+                    self._carry = data[end:]
+                    self._flush()
+                    return None
+                ch, width = _resolve_escape(esc)
+                if ch is not None:
+                    self._quantum += ch
+                    i = end + 1 + width
+                    continue
+            # 非 base64 字符：当前图片结束
+            if data[end] == 0x3A and self._quantum.endswith(_MARKER_HEAD):
+                # "...AAAAdata:image/..."：下一张图片紧跟在后，"data" 不属于当前图片
+                del self._quantum[-len(_MARKER_HEAD):]
+                self._finish(done)
+                return _MARKER_HEAD + data[end:]
+            self._finish(done)
+            return data[end:]
+
+    def _flush(self) -> None:
+        # 保留末尾至少 4 个字符不解码：它们可能是紧跟着的下一个 "data:image" 的开头
+        usable = len(self._quantum) - len(self._quantum) % 4 - len(_MARKER_HEAD)
+        if usable > 0:
+            self._out += binascii.a2b_base64(bytes(self._quantum[:usable]))
+            del self._quantum[:usable]
+
+    def _finish(self, done: List[bytes]) -> None:
+        usable = len(self._quantum) - len(self._quantum) % 4
+        if usable:
+            self._out += binascii.a2b_base64(bytes(self._quantum[:usable]))
+            del self._quantum[:usable]
+        if self._quantum:
+            tail = bytes(self._quantum).rstrip(b"=")
+            tail += b"=" * (-len(tail) % 4)
+            try:
+                self._out += binascii.a2b_base64(tail)
+            except binascii.Error:
+                pass
+        if self._out:
+            done.append(bytes(self._out))
+        self._out = bytearray()
+        self._quantum.clear()
+        self._carry = b""
+        self._state = "search"
+
+    def close(self) -> List[bytes]:
+        done: List[bytes] = []
+        if self._state == "data":
+            self._finish(done)
+        return done
+
+
+def _resolve_escape(esc: bytes) -> Tuple[Optional[bytes], int]:
+    """
+    解析反斜杠后的转义，返回 (对应的 base64 片段, 消耗的字节数)。
+    空白转义（\\n 等）返回 b""；其他非 base64 字符返回 None，表示图片数据结束。
+    """
+    if esc[:1] == b"/":
+        return b"/", 1
+    if esc[:1] in (b"n", b"r", b"t"):
+        return b"", 1
+    if esc[:1] == b"u":
+        try:
+            ch = chr(int(esc[1:5].decode("ascii"), 16)).encode("utf-8")
+        except (UnicodeDecodeError, ValueError):
+            return None, 0
+        if not _NON_B64.search(ch):
+            return ch, 5
+    return None, 0
+
+
+class StreamError(ValueError):
+    """SSE 流中的错误事件，或单个事件超过缓冲上限。"""
+
+
+class SseContentReader:
+    """
+    把 chat.completions 的 SSE 流（"stream": true）还原为 content 文本增量：
+    feed() 返回本次完整到达的事件中的 choices[].delta.content（UTF-8 字节），依次交给 DataUrlScanner。
+    base64 被拆在多个事件里也能正确拼接（增量是未转义的原文）。
+    只缓存当前未结束的一个事件，超过 max_event_bytes 抛出 StreamError；上游的错误事件同样抛出 StreamError。
+    """
+
+    def __init__(self, max_event_bytes: int = 32 * 1024 * 1024):
+        self.max_event_bytes = max_event_bytes
+        self._line = bytearray()  # 未结束的一行
+        self._data: List[bytes] = []  # 当前事件的 data: 行
+        self._size = 0
+        self.done = False
+        self.events = 0
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        out: List[bytes] = []
+        start = 0
+        while not self.done:
+            end = chunk.find(b"\n", start)
+            if end < 0:
+                self._line += chunk[start:]
+                self._grow(len(chunk) - start)
+                break
+            self._line += chunk[start:end]
+            self._grow(end - start)
+            start = end + 1
+            line = bytes(self._line).rstrip(b"\r")
+            self._line.clear()
+            if line:
+                if line.startswith(b"data:"):
+                    self._data.append(line[5:].lstrip(b" "))
+                continue  # event:/id:/注释行忽略
+            out += self._dispatch()
+        return out
+
+    def close(self) -> List[bytes]:
+        """流结束：处理没有以空行结尾的最后一个事件。"""
+        if self._line:
+            line = bytes(self._line).rstrip(b"\r")
+            self._line.clear()
+            if line.startswith(b"data:"):
+                self._data.append(line[5:].lstrip(b" "))
+        return self._dispatch()
+
+    def _grow(self, n: int) -> None:
+        self._size += n
+        if self._size > self.max_event_bytes:
+            raise StreamError(f"stream event larger than {self.max_event_bytes} bytes")
+
+    def _dispatch(self) -> List[bytes]:
+        data = b"\n".join(self._data)
+        self._data.clear()
+        self._size = 0
+        if not data:
+            return []
+        if data.strip() == b"[DONE]":
+            self.done = True
+            return [BOUNDARY]
+        self.events += 1
+        try:
+            event = json.loads(data)
+        except ValueError:
+            return []
+        if isinstance(event, dict) and event.get("error"):
+            err = event["error"]
+            raise StreamError(str(err.get("message") if isinstance(err, dict) else err))
+        pieces: List[bytes] = []
+        for choice in (event.get("choices") or []) if isinstance(event, dict) else []:
+            delta = choice.get("delta") or choice.get("message") or {}
+            content = delta.get("content")
+            if isinstance(content, str) and content:
+                pieces.append(content.encode("utf-8"))
+            # 部分代理把图片放在 delta.images[].image_url.url 中
+            for img in delta.get("images") or []:
+                url = (img.get("image_url") or {}).get("url") if isinstance(img, dict) else None
+                if url:
+                    pieces.append(b" " + url.encode("utf-8") + b" ")
+            if choice.get("finish_reason"):
+                pieces.append(BOUNDARY)
+        return pieces
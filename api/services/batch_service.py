@@ -0,0 +1,276 @@
+from __future__ import annotations
+import asyncio
+import json
+import re
+import time
+import uuid
+import zipfile
+from collections import Counter
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi import UploadFile
+
+from ..clients import client_gate
+from ..config import settings
+from ..job_store import job_store
+from ..models import Batch, BatchJobStatus, BatchStatusResponse, Job
+from ..storage import UploadRejected, UploadTooLarge, ingest_upload, path_from_url
+from ..tasks import check_capacity, job_priority, process_job_background, set_group_limit
+from .prompts import validate_job
+
+TERMINAL_STATUSES = ("finished", "failed", "expired")
+ZIP_CHUNK = 256 * 1024
+
+
+class _ZipSink:
+    """zipfile 的不可 seek 输出：写入的字节暂存，由流式响应逐段取走。"""
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self.buf += data
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        out = bytes(self.buf)
+        self.buf.clear()
+        return out
+
+
+def _arc_dir(index: int, filename: str) -> str:
+    stem = re.sub(r"[^\w.-]+", "_", Path(filename or "").stem).strip("._") or "image"
+    return f"{index:04d}_{stem[:60]}"
+
+
+class BatchService:
+    """
+    批量任务：一次 multipart 请求上传多张图，共用一个 type/params。
+    - 队列容量只在提交时检查一次；子任务记录在一个事务中写入
+    - 子任务以 batch id 为组提交到任务池，同时运行数不超过该批次的 concurrency
+    - 聚合状态由子任务记录实时计算；zip 下载随子任务完成逐个写出
+    """
+
+    async def create(
+        self, job_type: str, params: Dict[str, Any], uploads: List[UploadFile], client: Optional[str] = None
+    ) -> Batch:
+        if not uploads:
+            raise UploadRejected("no files in batch")
+        if len(uploads) > settings.BATCH_MAX_FILES:
+            raise UploadTooLarge(f"at most {settings.BATCH_MAX_FILES} files per batch")
+        # 任务存储 / 持久队列的 SQLite 调用都在线程中执行，不阻塞事件循环
+        await asyncio.to_thread(check_capacity)
+
+        params = dict(params or {})
+        try:
+            concurrency = int(params.pop("concurrency", settings.BATCH_CONCURRENCY))
+        except (TypeError, ValueError):
+            raise UploadRejected("params.concurrency must be an integer")
+        concurrency = max(1, min(concurrency, settings.WORKER_POOL_SIZE))
+        params = validate_job(job_type, params)
+        # 一次批量提交消耗一个令牌，子任务数整体计入该客户端的任务数上限
+        if client is not None:
+            await asyncio.to_thread(client_gate.admit, client, len(uploads))
+        try:
+            batch = await self._create(job_type, params, uploads, concurrency, client)
+        except UploadRejected:
+            # 没有可接受的图片：退回 admit 扣除的令牌
+            if client is not None:
+                client_gate.refund(client)
+            raise
+        if client is not None:
+            client_gate.accept(client, jobs=len(batch.job_ids))
+        return batch
+
+    async def _create(
+        self, job_type: str, params: Dict[str, Any], uploads: List[UploadFile], concurrency: int, client: Optional[str]
+    ) -> Batch:
+        batch_id = str(uuid.uuid4())
+        now = time.time()
+        jobs: List[Job] = []
+        filenames: List[str] = []
+        rejected: List[Dict[str, Any]] = []
+        for i, upload in enumerate(uploads):
+            try:
+                info = await ingest_upload(upload, settings.MAX_UPLOAD_BYTES)
+            except UploadRejected as e:
+                rejected.append({"index": i + 1, "filename": upload.filename, "error": str(e)})
+                continue
+            jobs.append(
+                Job(
+                    id=str(uuid.uuid4()),
+                    type=job_type,
+                    status="pending",
+                    params=params,
+                    input_path=str(info.path),
+                    input_sha256=info.sha256,
+                    created_at=now,
+                    batch_id=batch_id,
+                    client=client,
+                )
+            )
+            filenames.append(upload.filename or f"image-{i + 1}")
+        if not jobs:
+            raise UploadRejected("no acceptable image in batch: " + "; ".join(r["error"] for r in rejected[:3]))
+
+        batch = Batch(
+            id=batch_id,
+            type=job_type,
+            params=params,
+            job_ids=[j.id for j in jobs],
+            filenames=filenames,
+            rejected=rejected,
+            concurrency=concurrency,
+            created_at=now,
+            client=client,
+        )
+        await asyncio.to_thread(self._submit, batch, jobs)
+        return batch
+
+    def _submit(self, batch: Batch, jobs: List[Job]) -> None:
+        job_store.create_batch(batch.model_dump())
+        job_store.create_many(j.model_dump() for j in jobs)
+
+        set_group_limit(batch.id, batch.concurrency)
+        priority = job_priority(batch.type, batch.params)
+        for job in jobs:
+            process_job_background(job.id, batch.type, priority, group=batch.id, client=batch.client)
+
+    def _children(self, batch: Dict[str, Any]) -> List[Tuple[int, str, str, Optional[Dict[str, Any]]]]:
+        records = job_store.get_many(batch["job_ids"])
+        return [
+            (i + 1, job_id, filename, records.get(job_id))
+            for i, (job_id, filename) in enumerate(zip(batch["job_ids"], batch["filenames"]))
+        ]
+
+    def status(self, batch_id: str) -> BatchStatusResponse:
+        batch = job_store.get_batch(batch_id)
+        jobs = []
+        for _, job_id, filename, data in self._children(batch):
+            if data is None:
+                # 子任务记录已被保留策略清理
+                jobs.append(BatchJobStatus(id=job_id, filename=filename, status="expired", progress=100))
+                continue
+            jobs.append(
+                BatchJobStatus(
+                    id=job_id,
+                    filename=filename,
+                    status=data["status"],
+                    progress=data.get("progress", 0),
+                    results=[str(u) for u in data.get("results", [])],
+                    error=data.get("error"),
+                )
+            )
+        counts = Counter(j.status for j in jobs)
+        if all(j.status in TERMINAL_STATUSES for j in jobs):
+            status = "finished" if counts["finished"] else "failed"
+        elif counts["pending"] == len(jobs):
+            status = "pending"
+        else:
+            status = "running"
+        return BatchStatusResponse(
+            id=batch_id,
+            type=batch["type"],
+            status=status,
+            progress=sum(j.progress for j in jobs) // max(1, len(jobs)),
+            total=len(jobs),
+            counts=dict(counts),
+            jobs=jobs,
+            rejected=batch.get("rejected") or [],
+        )
+
+    async def _zip_file(self, zf: zipfile.ZipFile, sink: _ZipSink, path: Path, arcname: str) -> AsyncIterator[bytes]:
+        st = await asyncio.to_thread(path.stat)
+        zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime(st.st_mtime)[:6])
+        zinfo.compress_type = zipfile.ZIP_STORED  # 图片本身已压缩
+        zinfo.file_size = st.st_size
+        with path.open("rb") as src, zf.open(zinfo, "w") as dst:
+            while True:
+                chunk = await asyncio.to_thread(src.read, ZIP_CHUNK)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                yield sink.drain()
+        yield sink.drain()
+
+    async def zip_stream(self, batch_id: str) -> AsyncIterator[bytes]:
+        """
+        按完成顺序把子任务结果写入 zip（<序号>_<原文件名>/<n>.<ext>），全部结束后写入 manifest.json。
+        zipfile 写到不可 seek 的输出时使用 data descriptor，整个归档无需在内存或磁盘上先拼好。
+        最多等待 BATCH_ZIP_TIMEOUT 秒：到时仍未结束的子任务（例如丢失在队列之外）不再等待，记入 manifest 的 missing。
+        """
+        batch = await asyncio.to_thread(job_store.get_batch, batch_id)
+        sink = _ZipSink()
+        zf = zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED)
+        manifest: List[Dict[str, Any]] = []
+        missing: List[int] = []
+        deadline = time.monotonic() + settings.BATCH_ZIP_TIMEOUT if settings.BATCH_ZIP_TIMEOUT > 0 else None
+        pending = await asyncio.to_thread(self._children, batch)
+        while pending:
+            waiting = []
+            for index, job_id, filename, data in pending:
+                status = data["status"] if data is not None else "expired"
+                if status not in TERMINAL_STATUSES:
+                    waiting.append((index, job_id, filename))
+                    continue
+                entry: Dict[str, Any] = {
+                    "index": index,
+                    "job_id": job_id,
+                    "filename": filename,
+                    "status": status,
+                    "error": data.get("error") if data is not None else "job record expired",
+                    "files": [],
+                }
+                for n, url in enumerate((data or {}).get("results") or [], 1):
+                    path = path_from_url(str(url))
+                    if path is None or not path.exists():
+                        continue
+                    arcname = f"{_arc_dir(index, filename)}/{n}{path.suffix}"
+                    async for chunk in self._zip_file(zf, sink, path, arcname):
+                        if chunk:
+                            yield chunk
+                    entry["files"].append(arcname)
+                manifest.append(entry)
+            if not waiting:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                statuses = {job_id: data["status"] if data is not None else "expired" for _, job_id, _, data in pending}
+                for index, job_id, filename in waiting:
+                    missing.append(index)
+                    manifest.append({
+                        "index": index,
+                        "job_id": job_id,
+                        "filename": filename,
+                        "status": statuses[job_id],
+                        "error": f"not finished within {settings.BATCH_ZIP_TIMEOUT:g}s",
+                        "files": [],
+                    })
+                break
+            await asyncio.sleep(settings.BATCH_ZIP_POLL)
+            records = await asyncio.to_thread(job_store.get_many, [job_id for _, job_id, _ in waiting])
+            pending = [(i, job_id, fn, records.get(job_id)) for i, job_id, fn in waiting]
+
+        manifest.sort(key=lambda e: e["index"])
+        zf.writestr(
+            "manifest.json",
+            json.dumps(
+                {
+                    "batch_id": batch_id,
+                    "type": batch["type"],
+                    "complete": not missing,
+                    "missing": sorted(missing),
+                    "jobs": manifest,
+                },
+                ensure_ascii=False,
+                indent=2,
+            ),
+        )
+        zf.close()
+        yield sink.drain()
+
+
+batch_service = BatchService()
@@ -0,0 +1,28 @@
+from __future__ import annotations
+from typing import Optional
+
+
+class ProviderError(Exception):
+    """
+    上游调用失败（适配器的 call_edit 抛出，provider router 据此做故障转移）。
+    status_code：上游 HTTP 状态码（网络错误/无图片时为 None）；retry_after：上游给出的 Retry-After 秒数。
+    """
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """只支持秒数形式的 Retry-After；HTTP 日期形式忽略。"""
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None
+
+
+class InvalidJobRequest(Exception):
+    """任务类型未知或参数不合法：在入队（保存上传之前）时抛出，接口返回 400。"""
+
+    status_code = 400
@@ -0,0 +1,88 @@
+from __future__ import annotations
+import importlib.util
+import logging
+from typing import Any, Dict, Optional
+
+import httpx
+
+from ..config import settings
+
+logger = logging.getLogger("imagen.http_client")
+
+
+class SharedHttpClient:
+    """
+    进程级共享的 httpx.AsyncClient（连接池），由适配器层持有。
+    - 连接数 / keepalive / HTTP/2 / connect-read-write 超时均来自 Settings
+    - 在 app startup 创建、shutdown 关闭；未启动时首次 get() 懒创建（脚本场景）
+    - 通过 httpcore trace 统计新建连接数，requests - new_connections 即连接复用次数
+    """
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self.requests = 0
+        self.new_connections = 0
+        self.http2 = False
+
+    def _build(self) -> httpx.AsyncClient:
+        http2 = settings.PROXY_HTTP2
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("[http] PROXY_HTTP2=true 但未安装 h2（pip install httpx[http2]），回退到 HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        limits = httpx.Limits(
+            max_connections=settings.PROXY_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.PROXY_MAX_KEEPALIVE,
+            keepalive_expiry=settings.PROXY_KEEPALIVE_EXPIRY,
+        )
+        timeout = httpx.Timeout(
+            connect=settings.PROXY_CONNECT_TIMEOUT,
+            read=settings.PROXY_READ_TIMEOUT,
+            write=settings.PROXY_WRITE_TIMEOUT,
+            pool=settings.PROXY_POOL_TIMEOUT,
+        )
+        logger.info(
+            "[http] shared client: http2=%s max_connections=%d keepalive=%d",
+            http2, settings.PROXY_MAX_CONNECTIONS, settings.PROXY_MAX_KEEPALIVE,
+        )
+        return httpx.AsyncClient(
+            http2=http2,
+            limits=limits,
+            timeout=timeout,
+            trust_env=False,
+            event_hooks={"request": [self._on_request]},
+        )
+
+    async def _on_request(self, request: httpx.Request) -> None:
+        self.requests += 1
+        request.extensions["trace"] = self._trace
+
+    async def _trace(self, event_name: str, info: Dict[str, Any]) -> None:
+        if event_name == "connection.connect_tcp.complete":
+            self.new_connections += 1
+
+    # ---- lifecycle ----
+    async def start(self) -> None:
+        if self._client is None:
+            self._client = self._build()
+
+    async def aclose(self) -> None:
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+
+    def get(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = self._build()
+        return self._client
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "http2": self.http2,
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reused_connections": max(0, self.requests - self.new_connections),
+        }
+
+
+shared_http = SharedHttpClient()
@@ -1,15 +1,46 @@
 from __future__ import annotations
+import asyncio
+import functools
 import logging
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
 from pathlib import Path
 from io import BytesIO
 
+from ..config import settings
+from ..metrics import FALLBACKS, metric_labels, stage_timer
+from .b64stream import ImageCallback
+from .errors import ProviderError
+from .preprocess import PreparedImage
+
 logger = logging.getLogger("imagen.adapter")
 # lazy imports will be done inside methods to keep server bootable if deps missing
 
 # 采用 Google 官方 SDK（google-genai），与您示例保持一致
 DEFAULT_IMAGE_MODEL = "gemini-2.5-flash-image-preview"
 
+# SDK 没有异步客户端时，阻塞调用放到这个有界线程池里，避免占住事件循环
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _blocking_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.GOOGLE_EXECUTOR_WORKERS, thread_name_prefix="genai")
+    return _executor
+
+
+def _image_part(image: PreparedImage):
+    from google.genai import types  # type: ignore
+    return types.Part.from_bytes(data=image.data, mime_type=image.mime)
+
+
+def _open_image(path: Path):
+    from PIL import Image as PILImage  # type: ignore
+    img = PILImage.open(path)
+    img.load()  # PIL 延迟解码，这里在工作线程里强制完成
+    return img
+
 
 class ImagenAdapter:
     """Wrap Google Gemini image generation/editing via google-genai SDK."""
@@ -21,19 +52,34 @@ class ImagenAdapter:
         self.model = model or DEFAULT_IMAGE_MODEL
         self._client = None  # lazy init to avoid hard import at module load
 
+    def _get_client(self):
+        if self._client is None:
+            from google import genai  # type: ignore
+            self._client = genai.Client(api_key=self.api_key)
+        return self._client
+
+    async def warm(self, connections: int = 1) -> None:
+        """启动预热：在线程中导入 google-genai 并构造客户端（SDK 自行管理连接，不预建）。"""
+        if self._client is None:
+            await asyncio.to_thread(self._get_client)
+
+    async def _generate_content(self, contents: List[Any]):
+        """优先使用 SDK 的异步客户端（client.aio）；没有时在有界线程池中执行同步调用。"""
+        # 首次 import google.genai 与构造客户端较慢，同样放到线程里
+        client = self._client or await asyncio.to_thread(self._get_client)
+        aio = getattr(client, "aio", None)
+        if aio is not None:
+            return await aio.models.generate_content(model=self.model, contents=contents)
+        loop = asyncio.get_running_loop()
+        call = functools.partial(client.models.generate_content, model=self.model, contents=contents)
+        return await loop.run_in_executor(_blocking_executor(), call)
+
     # ---- Text-to-image ----
     async def generate(self, prompt: str, size: str = "1024x1024", n: int = 1, seed: Optional[int] = None) -> List[bytes]:
         # google-genai 的生成在一个响应中可能混合文本与图片，我们仅提取图片 part
         logger.info("[generate] using model=%s", self.model)
         try:
-            # lazy import to keep startup resilient if package is not installed yet
-            from google import genai  # type: ignore
-            client = self._client or genai.Client(api_key=self.api_key)
-            self._client = client
-            resp = client.models.generate_content(
-                model=self.model,
-                contents=[prompt],
-            )
+            resp = await self._generate_content([prompt])
             imgs = _extract_images(resp)
             if not imgs:
                 logger.warning("[generate] google response had no images extracted")
@@ -54,35 +100,51 @@ class ImagenAdapter:
         size: str = "1024x1024",
         n: int = 1,
         seed: Optional[int] = None,
+        image: Optional[PreparedImage] = None,
     ) -> List[bytes]:
-        # 直接将 prompt 与 PIL Image 作为 contents 传入（lazy imports）
-        logger.info("[edit] using model=%s, image=%s, prompt_len=%d", self.model, image_path, len(prompt or ""))
+        """旧接口：失败时回退为原图（IMAGEN_DISABLE_FALLBACK=true 时返回 []）。"""
         try:
-            from PIL import Image as PILImage  # type: ignore
-            from google import genai  # type: ignore
-            client = self._client or genai.Client(api_key=self.api_key)
-            self._client = client
-            img = PILImage.open(image_path)
-            resp = client.models.generate_content(
-                model=self.model,
-                contents=[prompt, img],
-            )
-            imgs = _extract_images(resp)
-            if not imgs:
-                logger.warning("[edit] google response had no images extracted; prompt sample=%.60s", (prompt or "")[:60])
-            else:
-                logger.info("[edit] extracted %d image(s) from google response", len(imgs))
-            return imgs
+            return await self.call_edit(image_path, prompt, mask_path, size, n, seed, image)
         except Exception:
-            logger.exception("[edit] google-genai call failed, falling back to original image bytes")
-            try:
-                with open(image_path, 'rb') as f:
-                    data = f.read()
-                logger.warning("[edit] FALLBACK used: returning original image bytes (%d bytes)", len(data))
-                return [data]
-            except Exception:
-                logger.exception("[edit] fallback failed to read original image")
+            logger.exception("[edit] google-genai call failed")
+            if settings.IMAGEN_DISABLE_FALLBACK:
                 return []
+            return await fallback_original(image_path)
+
+    async def call_edit(
+        self,
+        image_path: Path,
+        prompt: str,
+        mask_path: Optional[Path] = None,
+        size: str = "1024x1024",
+        n: int = 1,
+        seed: Optional[int] = None,
+        image: Optional[PreparedImage] = None,
+        on_image: Optional[ImageCallback] = None,
+    ) -> List[bytes]:
+        """失败时抛出 ProviderError，供 provider router 故障转移；不做原图回退。SDK 调用一次返回全部图片，不调用 on_image。"""
+        # 直接将 prompt 与图片作为 contents 传入（lazy imports）
+        # image：预处理后的图（已缩放/重编码），以 inline bytes 发送；为空时发送原图 PIL Image
+        logger.info("[edit] using model=%s, image=%s, prompt_len=%d", self.model, image_path, len(prompt or ""))
+        try:
+            if image is not None:
+                img = await asyncio.to_thread(_image_part, image)
+            else:
+                img = await asyncio.to_thread(_open_image, image_path)
+            resp = await self._generate_content([prompt, img])
+        except Exception as e:
+            # google.genai.errors.APIError 带 HTTP 状态码（code）
+            code = getattr(e, "code", None)
+            raise ProviderError(
+                f"{type(e).__name__}: {e}", status_code=code if isinstance(code, int) else None
+            ) from e
+        with stage_timer("decode"):
+            imgs = _extract_images(resp)
+        if not imgs:
+            logger.warning("[edit] google response had no images extracted; prompt sample=%.60s", (prompt or "")[:60])
+            raise ProviderError("google response contained no image")
+        logger.info("[edit] extracted %d image(s) from google response", len(imgs))
+        return imgs
 
     # ---- Upscale / super-resolution (暂留) ----
     async def upscale(self, image_path: Path, factor: int = 2) -> bytes:
@@ -90,6 +152,19 @@ class ImagenAdapter:
 
 
 # ---- helpers ----
+async def fallback_original(image_path: Path) -> List[bytes]:
+    """失败回退：返回原图字节（IMAGEN_DISABLE_FALLBACK=false 时使用）。"""
+    try:
+        data = await asyncio.to_thread(Path(image_path).read_bytes)
+        logger.warning("[edit] FALLBACK used: returning original image bytes (%d bytes)", len(data))
+        labels = metric_labels.get()
+        FALLBACKS.inc(job_type=labels.get("job_type", ""), provider=labels.get("provider") or "router")
+        return [data]
+    except Exception:
+        logger.exception("[edit] fallback failed to read original image")
+        return []
+
+
 def _extract_images(resp) -> List[bytes]:
     images: List[bytes] = []
     # 参考官方示例：从 candidates[0].content.parts 中提取 inline_data
@@ -1,32 +1,41 @@
 from __future__ import annotations
-import json
-import threading
+import asyncio
+import time
 import uuid
-from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 from fastapi import UploadFile
 
+from ..clients import client_gate
 from ..config import settings
+from ..job_store import job_store
 from ..models import Job, JobStatusResponse
-from ..storage import (
-    UPLOADS_DIR,
-    RESULTS_DIR,
-    job_json_path,
-    save_upload_file,
-    result_url,
-)
-from ..tasks import process_job_background
+from ..storage import UploadRejected, ingest_upload
+from ..tasks import check_capacity, job_priority, process_job_background
+from ..worker_pool import QueueFullError
+from .prompts import validate_job
 
 
 class JobService:
-    def __init__(self):
-        self._lock = threading.Lock()
-
-    def enqueue(self, job_type: str, params: Dict[str, Any], upload: UploadFile) -> str:
+    async def enqueue(
+        self, job_type: str, params: Dict[str, Any], upload: UploadFile, client: Optional[str] = None
+    ) -> str:
+        # 未知类型 / 非法参数在保存上传之前拒绝（InvalidJobRequest -> 400）
+        params = validate_job(job_type, params)
+        # 任务存储 / 持久队列的 SQLite 调用都在线程中执行，不阻塞事件循环
+        # 按客户端的频率与任务数上限（ClientLimitExceeded -> 429）
+        if client is not None:
+            await asyncio.to_thread(client_gate.admit, client)
+        try:
+            # 背压：队列已满时在保存上传之前拒绝（QueueFullError -> 429）
+            await asyncio.to_thread(check_capacity)
+            upload_info = await ingest_upload(upload, settings.MAX_UPLOAD_BYTES)
+        except (QueueFullError, UploadRejected):
+            # 请求未被接受：退回 admit 扣除的令牌
+            if client is not None:
+                client_gate.refund(client)
+            raise
         job_id = str(uuid.uuid4())
-        input_dir = UPLOADS_DIR / job_id
-        input_path = save_upload_file(upload, input_dir)
 
         job = Job(
             id=job_id,
@@ -34,36 +43,32 @@ class JobService:
             status="pending",
             progress=0,
             params=params or {},
-            input_path=str(input_path),
+            input_path=str(upload_info.path),
+            input_sha256=upload_info.sha256,
             results=[],
             error=None,
+            created_at=time.time(),
+            client=client,
         )
-        self._write_job(job)
-
-        # Start background thread placeholder (production: Celery task)
-        process_job_background(job_id)
+        await asyncio.to_thread(self._submit, job)
         return job_id
 
     def status(self, job_id: str) -> JobStatusResponse:
-        data = self._read_job(job_id)
-        return JobStatusResponse(
-            id=data["id"],
-            status=data["status"],
-            progress=data.get("progress", 0),
-            results=[str(u) for u in data.get("results", [])],
-            error=data.get("error"),
-        )
+        return JobStatusResponse.from_record(self._read_job(job_id))
 
     # --- internal helpers ---
+    def _submit(self, job: Job) -> None:
+        self._write_job(job)
+        if job.client is not None:
+            client_gate.accept(job.client)
+        # 交给进程内任务池，或写入持久队列由 worker 进程执行（QUEUE_BACKEND）
+        process_job_background(job.id, job.type, job_priority(job.type, job.params), client=job.client)
+
     def _write_job(self, job: Job) -> None:
-        p = job_json_path(job.id)
-        p.write_text(job.model_dump_json(indent=2), encoding="utf-8")
+        job_store.create(job.model_dump())
 
     def _read_job(self, job_id: str) -> Dict[str, Any]:
-        p = job_json_path(job_id)
-        if not p.exists():
-            raise FileNotFoundError(f"Job {job_id} not found")
-        return json.loads(p.read_text(encoding="utf-8"))
+        return job_store.get(job_id)
 
 
 job_service = JobService()
@@ -0,0 +1,296 @@
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from ..config import settings
+from ..metrics import stage_timer
+from ..storage import blob_store, result_url
+from .result_cache import result_cache, stage_key
+
+logger = logging.getLogger("imagen.postprocess")
+
+FORMAT_MIME = {"avif": "image/avif", "webp": "image/webp", "jpg": "image/jpeg", "png": "image/png"}
+PIL_FORMAT = {"avif": "AVIF", "webp": "WEBP", "jpg": "JPEG", "png": "PNG"}
+
+# 子进程返回的一份编码结果：(用途 thumb|full|sheet, 扩展名, 宽, 高, 字节)
+Encoded = Tuple[str, str, int, int, bytes]
+
+
+def supported_formats(wanted: Sequence[str]) -> List[str]:
+    """POSTPROCESS_FORMATS 中当前 Pillow 能编码的格式（AVIF 需要 Pillow>=11.2 或 pillow-avif-plugin）。"""
+    from PIL import features  # type: ignore
+
+    return [f for f in (x.lower() for x in wanted) if f in ("avif", "webp") and features.check(f)]
+
+
+def _warm_child() -> None:
+    """进程池子进程的预热：导入 Pillow 并加载各格式插件。"""
+    from PIL import Image  # type: ignore
+
+    Image.init()
+
+
+def _encode(img: Any, ext: str, quality: int) -> bytes:
+    buf = BytesIO()
+    if ext == "jpg" and img.mode != "RGB":
+        img = img.convert("RGB")
+    kwargs: Dict[str, Any] = {"quality": quality}
+    if ext == "webp":
+        kwargs["method"] = 4
+    img.save(buf, format=PIL_FORMAT[ext], **kwargs)
+    return buf.getvalue()
+
+
+def _render(path: str, thumb_edge: int, full_edge: int, formats: Sequence[str], quality: int) -> Tuple[str, List[Encoded]]:
+    """
+    在子进程中执行：识别真实格式，输出各格式的缩略图与全尺寸版本，外加一张 JPEG 缩略图（<img> 兜底）。
+    返回 (真实格式, [编码结果])。
+    """
+    from PIL import Image, ImageOps  # type: ignore
+
+    with Image.open(path) as src:
+        real = (src.format or "").lower().replace("jpeg", "jpg")
+        img = ImageOps.exif_transpose(src)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        full = img
+        if max(full.size) > full_edge:
+            full = img.copy()
+            full.thumbnail((full_edge, full_edge), Image.LANCZOS)
+        thumb = img.copy()
+        thumb.thumbnail((thumb_edge, thumb_edge), Image.LANCZOS)
+
+        out: List[Encoded] = [("thumb", "jpg", thumb.width, thumb.height, _encode(thumb, "jpg", quality))]
+        for ext in formats:
+            out.append(("thumb", ext, thumb.width, thumb.height, _encode(thumb, ext, quality)))
+            if max(full.size) > thumb_edge:
+                out.append(("full", ext, full.width, full.height, _encode(full, ext, quality)))
+        return real, out
+
+
+def _render_sheet(paths: Sequence[str], tile: int, gap: int, ext: str, quality: int) -> Encoded:
+    """把多张结果按 ceil(sqrt(n)) 列平铺为一张总览图，每格等比缩放后居中。"""
+    from PIL import Image, ImageOps  # type: ignore
+
+    cols = math.ceil(math.sqrt(len(paths)))
+    rows = math.ceil(len(paths) / cols)
+    width, height = cols * tile + (cols + 1) * gap, rows * tile + (rows + 1) * gap
+    sheet = Image.new("RGB", (width, height), (255, 255, 255))
+    for i, p in enumerate(paths):
+        with Image.open(p) as src:
+            img = ImageOps.exif_transpose(src).convert("RGB")
+            img.thumbnail((tile, tile), Image.LANCZOS)
+        x = gap + (i % cols) * (tile + gap) + (tile - img.width) // 2
+        y = gap + (i // cols) * (tile + gap) + (tile - img.height) // 2
+        sheet.paste(img, (x, y))
+    return "sheet", ext, width, height, _encode(sheet, ext, quality)
+
+
+class Postprocessor:
+    """
+    结果后处理：缩略图、WebP/AVIF 版本与九宫格总览图。
+    Pillow 编码是 CPU 密集型，放在进程池中执行（POSTPROCESS_WORKERS=0 时退回线程），不占用事件循环所在进程的 GIL。
+    产物作为 CAS blob 写入，摘要记录在任务的 variant_blobs 中，随任务一起由保留策略释放。
+    输出只取决于输入 blob 与后处理设置，按 (摘要, 设置) 记入结果缓存：重跑或命中结果缓存的任务不再重新编码，
+    修改设置后只重新执行本阶段。
+    """
+
+    def __init__(self, workers: int = 2):
+        self.workers = workers
+        self._formats: Optional[List[str]] = None
+        self._pool: Optional[Executor] = None
+        self.processed = 0
+        self.failures = 0
+        self.sheets = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cache_hits = 0
+
+    @property
+    def formats(self) -> List[str]:
+        # 检测编码器需要导入 Pillow 及其插件，推迟到首次使用（或启动预热）
+        if self._formats is None:
+            self._formats = supported_formats(settings.POSTPROCESS_FORMATS)
+        return self._formats
+
+    async def warm(self) -> None:
+        """启动预热：检测可用编码器，并提前拉起进程池的全部子进程（spawn 启动与导入 Pillow 都较慢）。"""
+        await asyncio.to_thread(lambda: self.formats)
+        pool = self._executor()
+        if pool is not None:
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(pool, _warm_child) for _ in range(self.workers)))
+
+    def _executor(self) -> Optional[Executor]:
+        if self.workers <= 0:
+            return None
+        if self._pool is None:
+            # spawn：不继承父进程的线程与锁（sqlite / httpx / 线程池）
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def _run(self, fn: Any, *args: Any) -> Any:
+        pool = self._executor()
+        if pool is None:
+            return await asyncio.to_thread(fn, *args)
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+
+    def _store(self, encoded: Encoded) -> Tuple[str, Dict[str, Any]]:
+        kind, ext, width, height, data = encoded
+        digest, path = blob_store.put_bytes(data, ext, public=True)
+        self.bytes_out += len(data)
+        return digest, {"kind": kind, "type": FORMAT_MIME[ext], "width": width, "height": height, "url": result_url(path)}
+
+    @staticmethod
+    def _cacheable(path: Path) -> bool:
+        # 只有 CAS blob（文件名即内容摘要）才能作为缓存 key；旧版 results/ 下的文件不缓存
+        return settings.RESULT_CACHE_ENABLED and len(path.stem) == 64 and path.parent.parent.parent == blob_store.root
+
+    def _variants_key(self, path: Path) -> str:
+        return stage_key(
+            "postprocess",
+            path.stem,
+            settings.POSTPROCESS_THUMB_EDGE,
+            settings.POSTPROCESS_MAX_EDGE,
+            self.formats,
+            settings.POSTPROCESS_QUALITY,
+        )
+
+    def _cached_variants(self, key: str) -> Optional[Tuple[Dict[str, Any], List[str]]]:
+        """缓存条目的主 blob 是描述 JSON，依赖是各格式文件；命中时任务只保留依赖的引用。"""
+        hit = result_cache.get_with_deps(key, stage="postprocess")
+        if hit is None:
+            return None
+        desc_path, digests = hit
+        blob_store.decref([desc_path.stem])
+        try:
+            described = json.loads(desc_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            blob_store.decref(digests)
+            return None
+        self.cache_hits += 1
+        return described, digests
+
+    def _remember_variants(self, key: str, described: Dict[str, Any], digests: List[str]) -> None:
+        desc_digest, _ = blob_store.put_bytes(json.dumps(described, ensure_ascii=False).encode("utf-8"), "json")
+        result_cache.put(key, desc_digest, deps=digests, stage="postprocess")
+        blob_store.decref([desc_digest])
+
+    async def variants(self, path: Path) -> Tuple[Optional[Dict[str, Any]], List[str]]:
+        """
+        为一张结果图生成响应式版本，返回 (描述, 新增引用的 blob 摘要)。
+        描述：{"format", "width", "height", "thumbnail": JPEG 缩略图, "sources": [{type, width, url}]}；
+        失败时返回 (None, [])，不影响结果本身。
+        """
+        if not settings.POSTPROCESS_ENABLED:
+            return None, []
+        key = self._variants_key(path) if self._cacheable(path) else None
+        if key is not None:
+            cached = await asyncio.to_thread(self._cached_variants, key)
+            if cached is not None:
+                return cached
+        try:
+            async with stage_timer("postprocess"):
+                real, encoded = await self._run(
+                    _render,
+                    str(path),
+                    settings.POSTPROCESS_THUMB_EDGE,
+                    settings.POSTPROCESS_MAX_EDGE,
+                    self.formats,
+                    settings.POSTPROCESS_QUALITY,
+                )
+        except Exception:
+            self.failures += 1
+            logger.exception("[postprocess] failed for %s", path.name)
+            return None, []
+        self.processed += 1
+        self.bytes_in += path.stat().st_size
+        digests: List[str] = []
+        thumbnail: Optional[str] = None
+        sources: List[Dict[str, Any]] = []
+        size = (0, 0)
+        for item in encoded:
+            digest, info = await asyncio.to_thread(self._store, item)
+            digests.append(digest)
+            if info["kind"] == "thumb" and info["type"] == "image/jpeg":
+                thumbnail = info["url"]
+                continue
+            sources.append({"type": info["type"], "width": info["width"], "url": info["url"]})
+            size = max(size, (info["width"], info["height"]))
+        # 全尺寸版本的宽高；原图不超过缩略图尺寸时即缩略图本身
+        described = {
+            "format": real,
+            "width": size[0],
+            "height": size[1],
+            "thumbnail": thumbnail,
+            "sources": sources,
+        }
+        if key is not None:
+            await asyncio.to_thread(self._remember_variants, key, described, digests)
+        return described, digests
+
+    async def contact_sheet(self, paths: Sequence[Path]) -> Tuple[Optional[str], List[str]]:
+        """多张结果的平铺总览图，返回 (URL, 新增引用的 blob 摘要)。"""
+        if not settings.POSTPROCESS_ENABLED or not paths:
+            return None, []
+        ext = "webp" if "webp" in self.formats else "jpg"
+        key = None
+        if all(self._cacheable(p) for p in paths):
+            key = stage_key(
+                "contact_sheet",
+                [p.stem for p in paths],
+                settings.CONTACT_SHEET_TILE,
+                settings.CONTACT_SHEET_GAP,
+                ext,
+                settings.POSTPROCESS_QUALITY,
+            )
+            hit = await asyncio.to_thread(result_cache.get, key, "contact_sheet")
+            if hit is not None:
+                self.cache_hits += 1
+                return result_url(hit), [hit.stem]
+        try:
+            async with stage_timer("contact_sheet"):
+                encoded = await self._run(
+                    _render_sheet,
+                    [str(p) for p in paths],
+                    settings.CONTACT_SHEET_TILE,
+                    settings.CONTACT_SHEET_GAP,
+                    ext,
+                    settings.POSTPROCESS_QUALITY,
+                )
+        except Exception:
+            self.failures += 1
+            logger.exception("[postprocess] contact sheet failed")
+            return None, []
+        self.sheets += 1
+        digest, info = await asyncio.to_thread(self._store, encoded)
+        if key is not None:
+            await asyncio.to_thread(result_cache.put, key, digest, (), "contact_sheet")
+        return info["url"], [digest]
+
+    def shutdown(self) -> None:
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "formats": self.formats,
+            "processed": self.processed,
+            "failures": self.failures,
+            "contact_sheets": self.sheets,
+            "cache_hits": self.cache_hits,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+postprocessor = Postprocessor(workers=settings.POSTPROCESS_WORKERS)
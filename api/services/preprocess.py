@@ -0,0 +1,127 @@
+from __future__ import annotations
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from ..config import settings
+from ..metrics import stage_timer
+
+logger = logging.getLogger("imagen.preprocess")
+
+FORMAT_MIME = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+@dataclass(frozen=True)
+class PreparedImage:
+    """送往上游前的输入图：已按 EXIF 转正、去除元数据、缩放并重新编码。"""
+    data: bytes
+    mime: str
+    width: int
+    height: int
+
+
+def target_edge(size: str) -> int:
+    """由 "1024x1024" 这类 size 得到最长边，并受 PREPROCESS_MAX_EDGE 限制。"""
+    try:
+        edge = max(int(v) for v in str(size).lower().split("x"))
+    except ValueError:
+        edge = settings.PREPROCESS_MAX_EDGE
+    return max(1, min(edge, settings.PREPROCESS_MAX_EDGE))
+
+
+def _prepare(path: Path, edge: int) -> PreparedImage:
+    from PIL import Image, ImageOps  # type: ignore
+
+    fmt = settings.PREPROCESS_FORMAT.upper()
+    if fmt not in FORMAT_MIME:
+        raise ValueError(f"unsupported PREPROCESS_FORMAT: {settings.PREPROCESS_FORMAT}")
+    with Image.open(path) as src:
+        img = ImageOps.exif_transpose(src)  # 应用 EXIF 方向；新图不带 EXIF 等元数据
+        if max(img.size) > edge:
+            img.thumbnail((edge, edge), Image.LANCZOS)
+        if fmt == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        elif img.mode not in ("RGB", "RGBA", "L", "LA"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        buf = BytesIO()
+        save_kwargs = {"quality": settings.PREPROCESS_QUALITY} if fmt in ("JPEG", "WEBP") else {"optimize": True}
+        img.save(buf, format=fmt, **save_kwargs)
+        return PreparedImage(data=buf.getvalue(), mime=FORMAT_MIME[fmt], width=img.width, height=img.height)
+
+
+class Preprocessor:
+    """
+    输入图预处理（在线程中执行），结果按 (输入摘要, 目标边长) 记忆：
+    hairstyle_grid 的 9 个子请求、以及重复提交的同一张图只编码一次。
+    失败（无法解码的图片）同样记忆为 None，同一张图不再重复尝试；PREPROCESS_FORMAT 无效时只告警一次，直接发送原图。
+    """
+
+    def __init__(self, max_items: int = 32):
+        self.max_items = max_items
+        self._memo: "OrderedDict[Tuple[str, int], Optional[PreparedImage]]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, int], asyncio.Future] = {}
+        self._bad_format: Optional[str] = None  # 已告警过的无效 PREPROCESS_FORMAT
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    async def prepare(self, path: Path, digest: str, size: str) -> Optional[PreparedImage]:
+        if not settings.PREPROCESS_ENABLED:
+            return None
+        if settings.PREPROCESS_FORMAT.upper() not in FORMAT_MIME:
+            if self._bad_format != settings.PREPROCESS_FORMAT:
+                self._bad_format = settings.PREPROCESS_FORMAT
+                logger.error("[preprocess] unsupported PREPROCESS_FORMAT %r, sending originals", self._bad_format)
+            return None
+        key = (digest, target_edge(size))
+        if key in self._memo:
+            self._memo.move_to_end(key)
+            self.hits += 1
+            return self._memo[key]
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.hits += 1
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if not fut.cancelled():
+                    raise  # 被取消的是本调用
+                # 先开始的调用被取消：重新执行（第一个重试者接手，其余继续等待它）
+                return await self.prepare(path, digest, size)
+
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            with stage_timer("preprocess"):
+                prepared = await asyncio.to_thread(_prepare, path, key[1])
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception:
+            # 预处理失败时退回原图直传，不影响任务
+            logger.exception("[preprocess] failed for %s, sending original", path)
+            self.failures += 1
+            prepared = None
+        finally:
+            self._inflight.pop(key, None)
+        fut.set_result(prepared)
+        self._memo[key] = prepared
+        while len(self._memo) > self.max_items:
+            self._memo.popitem(last=False)
+        if prepared is not None:
+            logger.info(
+                "[preprocess] %s -> %dx%d %s (%d bytes)",
+                path.name, prepared.width, prepared.height, prepared.mime, len(prepared.data),
+            )
+        return prepared
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "failures": self.failures, "memo_items": len(self._memo)}
+
+
+preprocessor = Preprocessor(max_items=settings.PREPROCESS_MEMO_ITEMS)
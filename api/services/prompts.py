@@ -1,5 +1,11 @@
 from __future__ import annotations
-from typing import Dict, List
+import re
+from dataclasses import dataclass, field
+from string import Formatter
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from ..config import settings
+from .errors import InvalidJobRequest
 
 NEGATIVE_DEFAULT = "请避免：水印、文字、畸形手指或肢体、过度锐化、过饱和、过曝、明显噪点。"
 
@@ -45,3 +51,138 @@ HAIRSTYLES: List[str] = [
     "短发清爽", "中长直发", "空气刘海", "大波浪卷", "高马尾", "丸子头", "油头背梳", "层次短发", "波波头",
 ]
 
+
+
+# ---- 任务类型注册表：每种任务声明自己的流水线，_execute 不再按类型分支 ----
+Variant = Tuple[str, str, Optional[int]]  # (label, prompt, seed)
+
+_SIZE = re.compile(r"^\d{2,5}x\d{2,5}$", re.I)
+
+
+def _int_param(params: Dict[str, Any], name: str) -> Optional[int]:
+    value = params.get(name)
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise InvalidJobRequest(f"params.{name} must be an integer")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise InvalidJobRequest(f"params.{name} must be an integer")
+
+
+def priority_range(job_type: str) -> Tuple[int, int]:
+    """params.priority 允许的取值范围：该类型的默认优先级到 +JOB_PRIORITY_CLIENT_RANGE。"""
+    base = settings.JOB_TYPE_PRIORITY.get(job_type, settings.JOB_PRIORITY_DEFAULT)
+    return base, base + max(0, settings.JOB_PRIORITY_CLIENT_RANGE)
+
+
+@dataclass(frozen=True)
+class JobTypeSpec:
+    """
+    一种任务的流水线声明：
+    - template / defaults：提示词模板，以及调用方未提供时填入占位符的默认值
+    - fan_out：每个子请求的 (标签, 模板)，结果按此顺序；为空时按 params.n 对同一模板多次采样
+    - preprocess：上传图先按 size 缩放、重新编码再发给上游（否则发送原图）
+    - postprocess：结果生成缩略图与 WebP/AVIF 版本
+    - contact_sheet：多张结果额外拼一张平铺总览图
+    """
+
+    name: str
+    template: str = ""
+    defaults: Mapping[str, str] = field(default_factory=dict)
+    fan_out: Tuple[Tuple[str, str], ...] = ()
+    preprocess: bool = True
+    postprocess: bool = True
+    contact_sheet: bool = False
+
+    def placeholders(self) -> List[str]:
+        templates = [self.template, *(t for _, t in self.fan_out)]
+        return sorted({f for t in templates for _, f, _, _ in Formatter().parse(t) if f})
+
+    def validate(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """入队时调用一次：检查并规范化参数，返回写入任务记录的 params。"""
+        if params is not None and not isinstance(params, dict):
+            raise InvalidJobRequest("params must be a JSON object")
+        out = dict(params or {})
+        size = out.get("size")
+        if size is not None and not (isinstance(size, str) and _SIZE.match(size)):
+            raise InvalidJobRequest("params.size must look like 1024x1024")
+        n = _int_param(out, "n")
+        if n is not None:
+            if self.fan_out:
+                out.pop("n")  # 子请求由 fan_out 决定
+            else:
+                out["n"] = max(1, min(n, settings.MAX_OUTPUTS_PER_JOB))
+        seed = _int_param(out, "seed")
+        if seed is not None:
+            out["seed"] = seed
+        priority = _int_param(out, "priority")
+        if priority is not None:
+            low, high = priority_range(self.name)
+            if not low <= priority <= high:
+                raise InvalidJobRequest(f"params.priority must be between {low} and {high} for {self.name}")
+            out["priority"] = priority
+        if out.get("negatives") is not None and not isinstance(out["negatives"], str):
+            raise InvalidJobRequest("params.negatives must be a string")
+        for name in self.placeholders():
+            value = out.get(name)
+            if value is None or value == "":
+                if name not in self.defaults:
+                    raise InvalidJobRequest(f"params.{name} is required for {self.name}")
+                out[name] = self.defaults[name]
+            elif not isinstance(value, (str, int, float)) or isinstance(value, bool):
+                raise InvalidJobRequest(f"params.{name} must be a string")
+        return out
+
+    def variants(self, params: Dict[str, Any], n: int, seed: Optional[int]) -> List[Variant]:
+        """把任务展开为若干子请求（label, prompt, seed），顺序即结果顺序。"""
+        if self.fan_out:
+            return [(label, build_prompt(template, params), seed) for label, template in self.fan_out]
+        prompt = build_prompt(self.template, params)
+        # n>1：同一模板的多次采样；指定 seed 时逐个 +i 以得到不同结果
+        return [
+            (self.name if n == 1 else f"{self.name}#{i + 1}", prompt, None if seed is None else seed + i)
+            for i in range(n)
+        ]
+
+
+HAIRSTYLE_TEMPLATE = "为此人更换为{name}发型，保持脸部特征不变，正面头像构图，均匀光线，背景干净，高分辨率。"
+
+JOB_TYPES: Dict[str, JobTypeSpec] = {}
+
+
+def register_job_type(spec: JobTypeSpec) -> JobTypeSpec:
+    JOB_TYPES[spec.name] = spec
+    return spec
+
+
+def get_job_type(name: str) -> JobTypeSpec:
+    spec = JOB_TYPES.get(name)
+    if spec is None:
+        raise InvalidJobRequest(f"unknown job type {name!r}; expected one of: {', '.join(sorted(JOB_TYPES))}")
+    return spec
+
+
+def validate_job(job_type: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    return get_job_type(job_type).validate(params)
+
+
+for _name, _template in TEMPLATES.items():
+    register_job_type(JobTypeSpec(_name, _template))
+# era_style 的占位符默认值与前端示例一致，未填写时不再把 {era} 原样发给上游
+register_job_type(
+    JobTypeSpec(
+        "era_style",
+        TEMPLATES["era_style"],
+        defaults={"era": "1970", "gender": "男性", "hair": "长卷发", "face": "长胡子", "backdrop": "北京胡同夏日风景"},
+    )
+)
+# 每个发型一个子请求，结果保持 HAIRSTYLES 顺序
+register_job_type(
+    JobTypeSpec(
+        "hairstyle_grid",
+        fan_out=tuple((name, HAIRSTYLE_TEMPLATE.format(name=name)) for name in HAIRSTYLES),
+        contact_sheet=True,
+    )
+)
@@ -1,11 +1,27 @@
 from __future__ import annotations
-import base64
+import asyncio
 import logging
+import time
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Union
 
 import httpx
 
+from ..config import settings
+from ..metrics import observe_stage, stage_timer
+from ..storage import sniff_image_type
+from .b64stream import (
+    DataUrlScanner,
+    ImageCallback,
+    JsonBase64Body,
+    SseContentReader,
+    StreamError,
+    data_url_placeholder,
+)
+from .errors import ProviderError, parse_retry_after
+from .http_client import shared_http
+from .preprocess import PreparedImage
+
 logger = logging.getLogger("imagen.proxy_adapter")
 
 
@@ -15,14 +31,23 @@ class ProxyAdapter:
     - 模型：gemini-2.5-flash-image-preview（支持文生图/图像编辑）
     - 请求格式：messages[{ role: 'user', content: [ {type: 'text'}, {type: 'image_url'}... ] }]
     - 返回：message.content 中包含 data:image/...;base64,xxx 的字符串
+    - stream=True 时请求 SSE（"stream": true），按 delta 增量解码；每张图片的 base64 一结束就交给 on_image
     """
 
-    def __init__(self, api_key: str, base_url: str, model: str):
+    def __init__(self, api_key: str, base_url: str, model: str, stream: bool = False):
         if not api_key:
             raise ValueError("PROXY_API_KEY 未配置")
         self.api_key = api_key
         self.base_url = base_url.rstrip("/")
         self.model = model
+        self.stream = stream
+
+    async def warm(self, connections: int = 1) -> None:
+        """启动预热：并发发出 connections 个轻量 GET，提前完成 DNS / TCP / TLS，连接留在共享池中复用（不论状态码）。"""
+        url = f"{self.base_url}{settings.WARMUP_PROXY_PATH}"
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        client = shared_http.get()
+        await asyncio.gather(*(client.get(url, headers=headers) for _ in range(max(1, connections))))
 
     async def edit(
         self,
@@ -32,68 +57,132 @@ class ProxyAdapter:
         size: str = "1024x1024",
         n: int = 1,
         seed: Optional[int] = None,
+        image: Optional[PreparedImage] = None,
+        on_image: Optional[ImageCallback] = None,
     ) -> List[bytes]:
-        # 将输入图片转为 data URL，作为 image_url 传给 /v1/chat/completions
+        """旧接口：失败时记录日志并返回 []。"""
         try:
-            with open(image_path, "rb") as f:
-                img_bytes = f.read()
-            data_url = "data:image/png;base64," + base64.b64encode(img_bytes).decode("utf-8")
+            return await self.call_edit(image_path, prompt, mask_path, size, n, seed, image, on_image)
         except Exception:
-            logger.exception("[proxy/edit] 读取输入图片失败: %s", image_path)
+            logger.exception("[proxy/edit] 请求失败")
             return []
 
+    async def call_edit(
+        self,
+        image_path: Path,
+        prompt: str,
+        mask_path: Optional[Path] = None,
+        size: str = "1024x1024",
+        n: int = 1,
+        seed: Optional[int] = None,
+        image: Optional[PreparedImage] = None,
+        on_image: Optional[ImageCallback] = None,
+    ) -> List[bytes]:
+        """
+        失败时抛出 ProviderError（带上游状态码与 Retry-After），供 provider router 故障转移。
+        on_image：每解码完一张图片立即调用（部分结果）；非流式响应同样边接收边解码，只是图片通常在末尾才完整。
+        """
+        # 请求体流式生成：JSON 信封 + 分块 base64，不在内存中拼出完整的 data URL
+        # image：预处理后的图（已缩放/重编码，带正确 MIME）；为空时直接从文件分块读取
+        if image is not None:
+            source: Union[memoryview, Path] = memoryview(image.data)
+            mime = image.mime
+        else:
+            with open(image_path, "rb") as f:
+                ext = sniff_image_type(f.read(16)) or "png"
+            source = Path(image_path)
+            mime = "image/jpeg" if ext == "jpg" else f"image/{ext}"
+
         if mask_path:
             logger.info("[proxy/edit] mask 参数暂未被老张API使用，将忽略 mask=%s", mask_path)
 
         url = f"{self.base_url}/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
-        body = {
+        envelope = {
             "model": self.model,
-            "stream": False,
+            "stream": self.stream,
             "messages": [
                 {
                     "role": "user",
                     "content": [
                         {"type": "text", "text": prompt or "Edit this image"},
-                        {"type": "image_url", "image_url": {"url": data_url}},
+                        {"type": "image_url", "image_url": {"url": data_url_placeholder()}},
                     ],
                 }
             ],
         }
-        logger.info("[proxy/edit] url=%s model=%s (using chat.completions)", url, self.model)
+        body = JsonBase64Body(envelope, mime, source)
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "Content-Length": str(body.content_length),
+        }
+        logger.info("[proxy/edit] url=%s model=%s stream=%s (using chat.completions)", url, self.model, self.stream)
+
+        started = time.monotonic()
+        images: List[bytes] = []
+
+        async def _emit(decoded: List[bytes]) -> None:
+            for img in decoded:
+                if not images:
+                    # 首张图片的等待时间（流式模式下明显早于整个响应结束）
+                    observe_stage("first_image", time.monotonic() - started)
+                images.append(img)
+                if on_image is not None:
+                    await on_image(img)
 
         try:
-            async with httpx.AsyncClient(timeout=180, trust_env=False) as client:
-                resp = await client.post(url, headers=headers, json=body)
-            if resp.status_code != 200:
-                logger.error("[proxy/edit] http %s: %s", resp.status_code, resp.text[:800])
-                return []
-            payload = resp.json()
-            # 解析 choices[0].message.content 字符串中的 base64 图片
-            text = (
-                (((payload.get("choices") or [{}])[0]).get("message") or {}).get("content")
-            ) or ""
-            if not text:
-                logger.warning("[proxy/edit] 响应无 content 字段")
-                return []
-
-            import re
-            m = re.search(r"data:image/([a-zA-Z0-9.+-]+);base64,([A-Za-z0-9+/=]+)", text)
-            if not m:
-                logger.warning("[proxy/edit] 未发现 base64 图片数据，content 前200字: %s", text[:200])
-                return []
-            b64_data = m.group(2)
-            try:
-                img_out = base64.b64decode(b64_data)
-                logger.info("[proxy/edit] 提取到 1 张图片 (%d bytes)", len(img_out))
-                return [img_out]
-            except Exception:
-                logger.exception("[proxy/edit] base64 解码失败")
-                return []
-        except Exception:
-            logger.exception("[proxy/edit] 请求失败")
-            return []
+            # 共享连接池：不再为每张图片重新握手
+            async with shared_http.get().stream("POST", url, headers=headers, content=body) as resp:
+                if resp.status_code != 200:
+                    detail = await _read_limited(resp, 800)
+                    logger.error("[proxy/edit] http %s: %s", resp.status_code, detail)
+                    raise ProviderError(
+                        f"http {resp.status_code}: {detail[:200]}",
+                        status_code=resp.status_code,
+                        retry_after=parse_retry_after(resp.headers.get("retry-after")),
+                    )
+                # 边接收边解码 base64 图片：非流式时直接扫描原始字节流中的 choices[].message.content，
+                # SSE 时先还原各事件的 delta.content 再扫描（base64 可能跨多个事件）
+                scanner = DataUrlScanner()
+                sse = None
+                if resp.headers.get("content-type", "").startswith("text/event-stream"):
+                    sse = SseContentReader(settings.PROXY_STREAM_MAX_EVENT_BYTES)
+                head = b""
+                # decode 阶段：接收响应体 + 增量 base64 解码（两者交织，无法分开计时）
+                with stage_timer("decode"):
+                    async for chunk in resp.aiter_bytes():
+                        if len(head) < 200:
+                            head += chunk[: 200 - len(head)]
+                        if sse is None:
+                            await _emit(scanner.feed(chunk))
+                            continue
+                        for piece in sse.feed(chunk):
+                            await _emit(scanner.feed(piece))
+                        if sse.done:
+                            break
+                    if sse is not None:
+                        for piece in sse.close():
+                            await _emit(scanner.feed(piece))
+                    await _emit(scanner.close())
+        except httpx.HTTPError as e:
+            raise ProviderError(f"{type(e).__name__}: {e}") from e
+        except StreamError as e:
+            raise ProviderError(f"stream: {e}") from e
+
+        if not images:
+            logger.warning("[proxy/edit] 未发现 base64 图片数据，响应前200字节: %r", head)
+            raise ProviderError("response contained no image")
+        logger.info(
+            "[proxy/edit] 提取到 %d 张图片 (%s bytes)", len(images), ", ".join(str(len(i)) for i in images)
+        )
+        return images
+
 
+async def _read_limited(resp, limit: int) -> str:
+    """读取错误响应体的前 limit 字节，避免把大响应整个读入内存。"""
+    buf = b""
+    async for chunk in resp.aiter_bytes():
+        buf += chunk
+        if len(buf) >= limit:
+            break
+    return buf[:limit].decode("utf-8", "replace")
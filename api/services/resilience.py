@@ -0,0 +1,249 @@
+from __future__ import annotations
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+import httpx
+
+from ..config import settings
+from .errors import ProviderError
+
+logger = logging.getLogger("imagen.resilience")
+
+
+class CircuitOpenError(ProviderError):
+    """熔断器打开期间直接失败，不请求上游。"""
+
+
+def is_retryable(exc: BaseException, statuses: Iterable[int]) -> bool:
+    """可重试：上游返回 RETRY_STATUS_CODES 中的状态码，或网络层错误（连接失败、超时等）。"""
+    if isinstance(exc, CircuitOpenError):
+        return False
+    if isinstance(exc, ProviderError):
+        if exc.status_code is not None:
+            return exc.status_code in statuses
+        return isinstance(exc.__cause__, (httpx.TransportError, asyncio.TimeoutError))
+    return False
+
+
+def counts_as_outage(exc: BaseException) -> bool:
+    """计入熔断的失败：网络错误、超时、429 与 5xx；400 一类请求错误不算上游故障。"""
+    if not isinstance(exc, ProviderError) or isinstance(exc, CircuitOpenError):
+        return False
+    if exc.status_code is None:
+        return isinstance(exc.__cause__, (httpx.TransportError, asyncio.TimeoutError))
+    return exc.status_code == 429 or exc.status_code >= 500
+
+
+class RetryPolicy:
+    """指数退避 + full jitter；上游给出 Retry-After 时至少等待该时长（不超过 max_delay）。"""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 20.0,
+                 statuses: Iterable[int] = (408, 429, 500, 502, 503, 504)):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.statuses = frozenset(statuses)
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            backoff = max(backoff, retry_after)
+        return min(backoff, self.max_delay)
+
+
+class TokenBucket:
+    """令牌桶限速：rate 个/秒，容量 burst；rate<=0 表示不限速。pause() 用于遵守上游 429 的 Retry-After。"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self.waits = 0
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        async with self._lock:  # 排队取令牌，先到先得
+            while True:
+                now = time.monotonic()
+                wait = self._paused_until - now
+                if wait <= 0 and self.rate <= 0:
+                    return
+                if wait <= 0:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                self.waits += 1
+                await asyncio.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    熔断器：连续 failure_threshold 次上游故障后打开，reset_timeout 秒内直接失败；
+    之后进入半开状态放行一个探测请求，成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.opens = 0
+
+    def allows(self) -> bool:
+        if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self.state = "half_open"
+        return self.state == "closed" or (self.state == "half_open" and not self._probing)
+
+    def before_call(self, name: str) -> None:
+        if not self.allows():
+            raise CircuitOpenError(f"circuit open for {name}")
+        if self.state == "half_open":
+            self._probing = True
+
+    def on_success(self) -> None:
+        self._failures = 0
+        self._probing = False
+        self.state = "closed"
+
+    def on_cancel(self) -> None:
+        self._probing = False  # 探测请求被取消（如对冲落败），允许下一个请求探测
+
+    def on_failure(self, outage: bool) -> None:
+        self._probing = False
+        if not outage:
+            # 上游有响应，只是请求本身有问题：中断“连续故障”的计数
+            self._failures = 0
+            if self.state == "half_open":
+                self.state = "closed"
+            return
+        self._failures += 1
+        if self.state == "half_open" or self._failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opens += 1
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+
+class Resilience:
+    """
+    包裹单个后端的每次上游调用：熔断检查 -> 在途上限 -> 令牌桶 -> 单次超时 -> 按策略重试。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        retry: RetryPolicy,
+        bucket: TokenBucket,
+        breaker: CircuitBreaker,
+        max_in_flight: int = 8,
+        attempt_timeout: float = 0,
+    ):
+        self.name = name
+        self.retry = retry
+        self.bucket = bucket
+        self.breaker = breaker
+        self.attempt_timeout = attempt_timeout
+        self._in_flight = asyncio.Semaphore(max(1, max_in_flight))
+        self.max_in_flight = max(1, max_in_flight)
+        self.in_flight = 0
+        self.attempts = 0
+        self.retries = 0
+        self.retries_by_status: Dict[str, int] = {}
+        self.short_circuited = 0
+
+    async def _attempt(self, fn: Callable[[], Awaitable[List[bytes]]]) -> List[bytes]:
+        async with self._in_flight:
+            await self.bucket.acquire()
+            self.in_flight += 1
+            self.attempts += 1
+            try:
+                if self.attempt_timeout > 0:
+                    try:
+                        return await asyncio.wait_for(fn(), self.attempt_timeout)
+                    except asyncio.TimeoutError as e:
+                        raise ProviderError(f"attempt timed out after {self.attempt_timeout:g}s") from e
+                return await fn()
+            finally:
+                self.in_flight -= 1
+
+    async def call(self, fn: Callable[[], Awaitable[List[bytes]]]) -> List[bytes]:
+        attempt = 0
+        while True:
+            try:
+                self.breaker.before_call(self.name)
+            except CircuitOpenError:
+                self.short_circuited += 1
+                raise
+            try:
+                result = await self._attempt(fn)
+            except asyncio.CancelledError:
+                self.breaker.on_cancel()
+                raise
+            except Exception as e:
+                self.breaker.on_failure(counts_as_outage(e))
+                retry_after = getattr(e, "retry_after", None)
+                if getattr(e, "status_code", None) == 429 and retry_after:
+                    # 上游限流：整个后端暂停发送，而不仅是本次重试
+                    self.bucket.pause(retry_after)
+                attempt += 1
+                if attempt >= self.retry.max_attempts or not is_retryable(e, self.retry.statuses):
+                    raise
+                delay = self.retry.delay(attempt - 1, retry_after)
+                key = str(getattr(e, "status_code", None) or type(e.__cause__ or e).__name__)
+                self.retries += 1
+                self.retries_by_status[key] = self.retries_by_status.get(key, 0) + 1
+                logger.warning(
+                    "[resilience] %s attempt %d failed (%s), retrying in %.2fs", self.name, attempt, e, delay
+                )
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.on_success()
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "breaker": self.breaker.state,
+            "breaker_opens": self.breaker.opens,
+            "short_circuited": self.short_circuited,
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "retries_by_status": dict(self.retries_by_status),
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "rate_limit": self.bucket.rate,
+            "rate_limited_waits": self.bucket.waits,
+        }
+
+
+def make_resilience(name: str, overrides: Optional[Dict[str, Any]] = None) -> Resilience:
+    """按 Settings 构造；PROVIDER_BACKENDS 中的 rate_limit / rate_burst / max_in_flight 可按后端覆盖。"""
+    o = overrides or {}
+    return Resilience(
+        name,
+        retry=RetryPolicy(
+            max_attempts=settings.RETRY_MAX_ATTEMPTS,
+            base_delay=settings.RETRY_BASE_DELAY,
+            max_delay=settings.RETRY_MAX_DELAY,
+            statuses=settings.RETRY_STATUS_CODES,
+        ),
+        bucket=TokenBucket(
+            rate=float(o.get("rate_limit", settings.PROVIDER_RATE_LIMIT)),
+            burst=int(o.get("rate_burst", settings.PROVIDER_RATE_BURST)),
+        ),
+        breaker=CircuitBreaker(settings.BREAKER_FAILURE_THRESHOLD, settings.BREAKER_RESET_TIMEOUT),
+        max_in_flight=int(o.get("max_in_flight", settings.PROVIDER_MAX_IN_FLIGHT)),
+        attempt_timeout=settings.PROVIDER_ATTEMPT_TIMEOUT,
+    )
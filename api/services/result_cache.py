@@ -0,0 +1,202 @@
+from __future__ import annotations
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from ..config import settings
+from ..storage import BASE_DIR, LazySQLite, blob_store
+
+logger = logging.getLogger("imagen.result_cache")
+
+
+def cache_key(input_digest: str, prompt: str, model: str, size: str, seed: Any, variant: int = 0) -> str:
+    """(输入图 sha256, prompt, model, size, seed) -> 内容寻址的缓存 key。"""
+    raw = json.dumps([input_digest, prompt, model, size, seed, variant], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def stage_key(stage: str, *parts: Any) -> str:
+    """确定性阶段（后处理、总览图）的缓存 key：阶段名 + 输入摘要 + 影响输出的设置。"""
+    raw = json.dumps([stage, *parts], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResultCache(LazySQLite):
+    """
+    结果缓存：key -> CAS blob 摘要，索引保存在 SQLite（与 blobs.db 同库的 result_cache 表）。
+    - 每个缓存条目持有 blob 的一次引用，命中时再为新任务 incref，结果文件本身从不复制
+    - 阶段缓存的条目可带依赖 blob（deps，如后处理描述引用的各格式文件），与主 blob 一起持有与 incref
+    - LRU（accessed_at）+ 总字节数上限淘汰；可选 TTL（按条目写入时间）
+    - 上游结果（pool=result，max_bytes）与阶段缓存（pool=stage，stage_max_bytes）各自计算字节数、各自淘汰：
+      大量后处理条目不会挤掉重新生成代价高的上游结果
+    """
+
+    def __init__(self, db_path: Path, max_bytes: int, stage_max_bytes: int, ttl: int = 0):
+        self.max_bytes = max_bytes
+        self.stage_max_bytes = stage_max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stage_lookups: Dict[Tuple[str, str], int] = {}  # 阶段缓存：(stage, hit|miss) -> 次数
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._bytes: Dict[str, int] = {"result": 0, "stage": 0}  # pool -> 字节数
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS result_cache (
+                key TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_result_cache_accessed ON result_cache(accessed_at);
+            """
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(result_cache)")}
+        if "deps" not in columns:
+            conn.execute("ALTER TABLE result_cache ADD COLUMN deps TEXT NOT NULL DEFAULT ''")
+        if "pool" not in columns:
+            # 旧库：带依赖的只有后处理条目；总览图条目无法区分，按上游结果计
+            conn.execute("ALTER TABLE result_cache ADD COLUMN pool TEXT NOT NULL DEFAULT 'result'")
+            conn.execute("UPDATE result_cache SET pool = 'stage' WHERE deps != ''")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_result_cache_pool ON result_cache(pool, accessed_at)")
+        for pool, total in conn.execute("SELECT pool, COALESCE(SUM(size), 0) FROM result_cache GROUP BY pool"):
+            self._bytes[pool] = total
+        return conn
+
+    @staticmethod
+    def _pool(stage: str) -> str:
+        return "result" if stage == "result" else "stage"
+
+    def _drop(self, key: str, digest: str, size: int, deps: str = "", pool: str = "result") -> None:
+        self._conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+        self._bytes[pool] = self._bytes.get(pool, 0) - size
+        blob_store.decref([digest, *filter(None, deps.split(","))])
+
+    @staticmethod
+    def _incref_all(digests: Iterable[str]) -> Optional[Path]:
+        """依次 incref，任一 blob 不存在则撤销已加的引用并返回 None；否则返回第一个的路径。"""
+        taken: List[str] = []
+        first: Optional[Path] = None
+        for digest in digests:
+            path = blob_store.incref(digest)
+            if path is None:
+                blob_store.decref(taken)
+                return None
+            taken.append(digest)
+            first = first or path
+        return first
+
+    def _count(self, stage: str, hit: bool) -> None:
+        if stage == "result":
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return
+        k = (stage, "hit" if hit else "miss")
+        self.stage_lookups[k] = self.stage_lookups.get(k, 0) + 1
+
+    def _lookup(self, key: str) -> Optional[Tuple[Path, List[str]]]:
+        """命中则 incref 对应 blob 及其依赖并返回 (路径, 依赖摘要)，否则返回 None（须持有 _lock，不计数）。"""
+        row = self._conn.execute(
+            "SELECT digest, size, created_at, deps, pool FROM result_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if self.ttl and time.time() - row[2] > self.ttl:
+            self._drop(key, *row[:2], row[3], row[4])
+            return None
+        deps = [d for d in row[3].split(",") if d]
+        path = self._incref_all([row[0], *deps])
+        if path is None:
+            # blob 已被外部删除
+            self._drop(key, *row[:2], row[3], row[4])
+            return None
+        self._conn.execute("UPDATE result_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return path, deps
+
+    def get_with_deps(self, key: str, stage: str = "result") -> Optional[Tuple[Path, List[str]]]:
+        """命中则为调用方的任务 incref 对应 blob 及其依赖，返回 (路径, 依赖摘要)，否则返回 None。"""
+        with self._lock:
+            hit = self._lookup(key)
+            self._count(stage, hit is not None)
+            return hit
+
+    def get(self, key: str, stage: str = "result") -> Optional[Path]:
+        """命中则为调用方的任务 incref 对应 blob 并返回其路径，否则返回 None。"""
+        hit = self.get_with_deps(key, stage)
+        return None if hit is None else hit[0]
+
+    def get_any(self, keys: Iterable[str], stage: str = "result") -> Optional[Path]:
+        """依次查找多个 key（如各后端模型的同一请求），返回第一个命中；一次调用只计一次命中或未命中。"""
+        with self._lock:
+            for key in keys:
+                hit = self._lookup(key)
+                if hit is not None:
+                    self._count(stage, True)
+                    return hit[0]
+            self._count(stage, False)
+            return None
+
+    def put(self, key: str, digest: str, deps: Iterable[str] = (), stage: str = "result") -> None:
+        deps = list(deps)
+        pool = self._pool(stage)
+        budget = self.max_bytes if pool == "result" else self.stage_max_bytes
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM result_cache WHERE key = ?", (key,)).fetchone():
+                return
+            if self._incref_all([digest, *deps]) is None:
+                return
+            size = sum(blob_store.size_of(d) for d in [digest, *deps])
+            now = time.time()
+            self._conn.execute(
+                "INSERT INTO result_cache (key, digest, size, created_at, accessed_at, deps, pool) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, digest, size, now, now, ",".join(deps), pool),
+            )
+            self._bytes[pool] += size
+            # 只在同一 pool 内按 LRU 淘汰
+            while self._bytes[pool] > budget:
+                oldest = self._conn.execute(
+                    "SELECT key, digest, size, deps, pool FROM result_cache WHERE pool = ? AND key != ? "
+                    "ORDER BY accessed_at LIMIT 1",
+                    (pool, key),
+                ).fetchone()
+                if oldest is None:
+                    break
+                self._drop(*oldest)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM result_cache").fetchone()[0]
+        return {
+            "enabled": settings.RESULT_CACHE_ENABLED,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stages": {f"{stage}_{outcome}": n for (stage, outcome), n in sorted(self.stage_lookups.items())},
+            "entries": entries,
+            "bytes": self._bytes["result"],
+            "stage_bytes": self._bytes["stage"],
+        }
+
+
+result_cache = ResultCache(
+    BASE_DIR / "blobs.db",
+    max_bytes=settings.RESULT_CACHE_MAX_BYTES,
+    stage_max_bytes=settings.RESULT_CACHE_STAGE_MAX_BYTES,
+    ttl=settings.RESULT_CACHE_TTL,
+)
@@ -0,0 +1,333 @@
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from ..config import settings
+from ..metrics import PROVIDER_CALLS, set_metric_labels, stage_timer
+from .b64stream import ImageCallback
+from .errors import ProviderError
+from .imagen_adapter import ImagenAdapter, fallback_original
+from .preprocess import PreparedImage
+from .proxy_adapter import ProxyAdapter
+from .resilience import CircuitOpenError, Resilience, make_resilience
+
+logger = logging.getLogger("imagen.router")
+
+KINDS = ("proxy", "google")
+
+
+class Backend:
+    """
+    一个上游后端（某个代理 base_url/key，或 Google SDK），持有常驻的适配器实例，
+    并记录最近 window 次调用的 (延迟, 是否成功)。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        kind: str,
+        model: str,
+        weight: float = 1.0,
+        base_url: str = "",
+        api_key: Optional[str] = None,
+        window: int = 50,
+        adapter: Any = None,
+        resilience: Optional[Resilience] = None,
+        stream: bool = False,
+    ):
+        if kind not in KINDS:
+            raise ValueError(f"unknown provider kind: {kind}")
+        self.name = name
+        self.kind = kind
+        self.model = model
+        self.weight = max(0.0, float(weight))
+        self.base_url = base_url
+        self.stream = stream
+        self._api_key = api_key
+        self._adapter = adapter
+        self.resilience = resilience or make_resilience(name)
+        self._samples: Deque[Tuple[float, bool]] = deque(maxlen=max(1, window))
+        self.requests = 0
+        self.failures = 0
+        self.last_failure_at: Optional[float] = None
+
+    @property
+    def adapter(self) -> Any:
+        # 懒创建：缺少 key 时服务仍可启动，错误在调用时作为该后端的失败上报
+        if self._adapter is None:
+            try:
+                if self.kind == "proxy":
+                    self._adapter = ProxyAdapter(
+                        api_key=self._api_key or "", base_url=self.base_url, model=self.model, stream=self.stream
+                    )
+                else:
+                    self._adapter = ImagenAdapter(api_key=self._api_key, model=self.model)
+            except ValueError as e:
+                raise ProviderError(str(e)) from e
+        return self._adapter
+
+    async def warm(self) -> None:
+        await self.adapter.warm(settings.WARMUP_CONNECTIONS)
+
+    def record(self, ok: bool, latency: float) -> None:
+        self.requests += 1
+        self._samples.append((latency, ok))
+        if not ok:
+            self.failures += 1
+            self.last_failure_at = time.monotonic()
+
+    def error_rate(self) -> float:
+        if not self._samples:
+            return 0.0
+        return sum(1 for _, ok in self._samples if not ok) / len(self._samples)
+
+    def latencies(self) -> List[float]:
+        return sorted(lat for lat, ok in self._samples if ok)
+
+    def mean_latency(self) -> Optional[float]:
+        lats = self.latencies()
+        return sum(lats) / len(lats) if lats else None
+
+    def latency_quantile(self, q: float) -> Optional[float]:
+        lats = self.latencies()
+        if len(lats) < settings.ROUTER_MIN_SAMPLES:
+            return None
+        return lats[min(len(lats) - 1, int(q * len(lats)))]
+
+    def healthy(self) -> bool:
+        if not self.resilience.breaker.allows():
+            return False
+        if len(self._samples) < settings.ROUTER_MIN_SAMPLES or self.error_rate() <= settings.ROUTER_ERROR_THRESHOLD:
+            return True
+        # 冷却期过后重新参与排序，用真实请求探测是否恢复
+        return self.last_failure_at is not None and time.monotonic() - self.last_failure_at > settings.ROUTER_COOLDOWN
+
+    def stats(self) -> Dict[str, Any]:
+        mean = self.mean_latency()
+        p95 = self.latency_quantile(0.95)
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "model": self.model,
+            "weight": self.weight,
+            "healthy": self.healthy(),
+            "requests": self.requests,
+            "failures": self.failures,
+            "error_rate": round(self.error_rate(), 3),
+            "latency_avg": None if mean is None else round(mean, 3),
+            "latency_p95": None if p95 is None else round(p95, 3),
+            **self.resilience.stats(),
+        }
+
+
+class ProviderRouter:
+    """
+    在多个上游后端之间路由单次 edit 调用：
+    - 每个后端内部：重试、令牌桶限速、在途上限与熔断（见 resilience.py）；熔断打开的后端视为不健康
+    - 排序：健康且 weight>0 的后端按 平均延迟/weight 升序（没有样本的排最前，先采样）；
+      weight=0 的备用后端其次；不健康（错误率超过阈值且未过冷却期）的最后
+    - 故障转移：当前后端抛错或无图片时，依次尝试下一个
+    - 对冲（ROUTER_HEDGE）：首选后端超过其延迟分位数仍未返回时，向下一个后端并发再发一份，取先成功者
+    - 全部失败：有 google 后端参与且 IMAGEN_DISABLE_FALLBACK=false 时返回原图（与旧 ImagenAdapter 行为一致），否则抛出 ProviderError
+    接口与适配器的 edit 相同，tasks 直接把 router 当作适配器使用。
+    """
+
+    def __init__(self, backends: List[Backend], hedge: bool = False, hedge_quantile: float = 0.95):
+        self.backends = backends
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.failovers = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @property
+    def models(self) -> List[str]:
+        """各后端的模型（去重，按当前路由顺序）：结果缓存按实际服务的模型分别记录，查找时依次尝试。"""
+        return list(dict.fromkeys(b.model for b in self.rank()))
+
+    @property
+    def streams(self) -> bool:
+        """是否有后端以流式返回（此时 edit 的 on_image 会收到部分结果）。"""
+        return any(b.stream and b.kind == "proxy" for b in self.backends)
+
+    async def warm(self) -> Dict[str, str]:
+        """各后端并发预热（构造适配器、导入 SDK、预建连接），返回 {后端名: "ok" | 错误}；失败不影响后续调用。"""
+        results = await asyncio.gather(*(b.warm() for b in self.backends), return_exceptions=True)
+        return {
+            b.name: "ok" if not isinstance(r, BaseException) else f"{type(r).__name__}: {r}"
+            for b, r in zip(self.backends, results)
+        }
+
+    def describe(self) -> str:
+        return ", ".join(f"{b.name}({b.kind} model={b.model} w={b.weight:g})" for b in self.backends)
+
+    def rank(self) -> List[Backend]:
+        def key(b: Backend) -> Tuple[int, float]:
+            if not b.healthy():
+                return 2, b.error_rate()
+            if b.weight <= 0:
+                return 1, b.mean_latency() or 0.0
+            return 0, (b.mean_latency() or 0.0) / b.weight
+
+        return sorted(self.backends, key=key)
+
+    async def _call(self, backend: Backend, image_path: Path, prompt: str, kwargs: Dict[str, Any]) -> List[bytes]:
+        async def attempt() -> List[bytes]:
+            imgs = await backend.adapter.call_edit(image_path, prompt, **kwargs)
+            if not imgs:
+                raise ProviderError("provider returned no image")
+            return imgs
+
+        # 本调用运行在独立的 task 中，provider 标签只作用于该后端的计时
+        set_metric_labels(provider=backend.name)
+        started = time.monotonic()
+        try:
+            # 重试 / 限速 / 熔断在单个后端内完成；仍失败时由 edit() 故障转移到下一个后端
+            async with stage_timer("provider_call"):
+                imgs = await backend.resilience.call(attempt)
+        except (asyncio.CancelledError, CircuitOpenError):
+            # 对冲中落败被取消、或熔断未实际请求：不计入该后端的延迟/成败统计
+            raise
+        except Exception:
+            backend.record(False, time.monotonic() - started)
+            PROVIDER_CALLS.inc(provider=backend.name, outcome="failure")
+            raise
+        backend.record(True, time.monotonic() - started)
+        PROVIDER_CALLS.inc(provider=backend.name, outcome="success")
+        return imgs
+
+    async def edit(
+        self,
+        image_path: Path,
+        prompt: str,
+        mask_path: Optional[Path] = None,
+        size: str = "1024x1024",
+        n: int = 1,
+        seed: Optional[int] = None,
+        image: Optional[PreparedImage] = None,
+        on_image: Optional[ImageCallback] = None,
+    ) -> List[bytes]:
+        imgs, _ = await self.serve(image_path, prompt, mask_path, size, n, seed, image, on_image)
+        return imgs
+
+    async def serve(
+        self,
+        image_path: Path,
+        prompt: str,
+        mask_path: Optional[Path] = None,
+        size: str = "1024x1024",
+        n: int = 1,
+        seed: Optional[int] = None,
+        image: Optional[PreparedImage] = None,
+        on_image: Optional[ImageCallback] = None,
+    ) -> Tuple[List[bytes], Optional[str]]:
+        """同 edit，另外返回实际返回结果的后端的模型；回退返回原图时为 None。"""
+        # on_image 收到的是尚未确认的部分结果：重试、故障转移或对冲时可能来自多次尝试，最终以返回值为准
+        if not self.backends:
+            raise ProviderError("no provider backend configured")
+        kwargs = {"mask_path": mask_path, "size": size, "n": n, "seed": seed, "image": image, "on_image": on_image}
+        queue = self.rank()
+        pending: Dict[asyncio.Task, Backend] = {}
+        hedged: set = set()
+        errors: List[str] = []
+
+        def launch(backend: Backend) -> None:
+            task = asyncio.create_task(self._call(backend, image_path, prompt, kwargs), name=f"provider:{backend.name}")
+            pending[task] = backend
+
+        try:
+            while queue or pending:
+                if not pending:
+                    if errors:
+                        self.failovers += 1
+                        logger.warning("[router] failing over to %s after: %s", queue[0].name, errors[-1])
+                    launch(queue.pop(0))
+                timeout = None
+                if self.hedge and queue and len(pending) == 1:
+                    timeout = next(iter(pending.values())).latency_quantile(self.hedge_quantile)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 首选后端已超过其尾延迟：并发向下一个后端再发一份
+                    slow = next(iter(pending.values()))
+                    logger.info("[router] hedging %s -> %s after %.2fs", slow.name, queue[0].name, timeout)
+                    self.hedges += 1
+                    hedged.add(queue[0].name)
+                    launch(queue.pop(0))
+                    continue
+                winner: Optional[Tuple[Backend, List[bytes]]] = None
+                for task in done:
+                    backend = pending.pop(task)
+                    exc = task.exception()
+                    if exc is not None:
+                        errors.append(f"{backend.name}: {exc}")
+                    elif winner is None:
+                        winner = (backend, task.result())
+                if winner is not None:
+                    if winner[0].name in hedged:
+                        self.hedge_wins += 1
+                    return winner[1], winner[0].model
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if not settings.IMAGEN_DISABLE_FALLBACK and any(b.kind == "google" for b in self.backends):
+            imgs = await fallback_original(image_path)
+            if imgs:
+                return imgs, None
+        raise ProviderError("all provider backends failed: " + "; ".join(errors))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "failovers": self.failovers,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "backends": [b.stats() for b in self.rank()],
+        }
+
+
+def backends_from_settings() -> List[Backend]:
+    raw = list(settings.PROVIDER_BACKENDS)
+    if not raw:
+        # 旧配置：PROVIDER 选择单个后端
+        raw = [{"name": settings.PROVIDER.lower(), "kind": "proxy" if settings.PROVIDER.lower() == "proxy" else "google"}]
+    backends = []
+    for i, item in enumerate(raw):
+        kind = str(item.get("kind", "proxy")).lower()
+        if kind == "proxy":
+            model = item.get("model") or settings.PROXY_MODEL or settings.GOOGLE_IMAGE_MODEL
+            base_url = item.get("base_url") or settings.PROXY_BASE_URL
+            api_key = item.get("api_key") or settings.PROXY_API_KEY
+        else:
+            model = item.get("model") or settings.GOOGLE_IMAGE_MODEL
+            base_url = ""
+            api_key = item.get("api_key") or settings.GOOGLE_API_KEY
+        name = str(item.get("name") or f"{kind}-{i + 1}")
+        backends.append(
+            Backend(
+                name=name,
+                kind=kind,
+                model=model,
+                weight=item.get("weight", 1.0),
+                base_url=base_url,
+                api_key=api_key,
+                window=settings.ROUTER_WINDOW,
+                resilience=make_resilience(name, item),
+                stream=bool(item.get("stream", settings.PROXY_STREAM)),
+            )
+        )
+    return backends
+
+
+def make_provider_router() -> ProviderRouter:
+    return ProviderRouter(
+        backends_from_settings(),
+        hedge=settings.ROUTER_HEDGE,
+        hedge_quantile=settings.ROUTER_HEDGE_QUANTILE,
+    )
+
+
+provider_router = make_provider_router()
@@ -0,0 +1,59 @@
+from __future__ import annotations
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List
+
+logger = logging.getLogger("imagen.singleflight")
+
+
+class SingleFlight:
+    """
+    合并并发的相同请求：同一 key 在途期间，后来者等待第一个调用的结果，而不是再请求一次上游。
+    结果（或异常）由所有等待者共享；调用结束后 key 即释放，不做缓存（缓存见 result_cache）。
+    第一个调用被取消时不把取消传给等待者：等待者重新竞争，由其中一个接着执行。
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[List[bytes]]]) -> List[bytes]:
+        while (fut := self._calls.get(key)) is not None:
+            self.followers += 1
+            logger.info("[singleflight] joined in-flight call key=%s", key[:12])
+            try:
+                # shield：某个等待者被取消不影响其他人
+                return list(await asyncio.shield(fut))
+            except asyncio.CancelledError:
+                if not fut.cancelled():
+                    raise  # 被取消的是本调用
+                logger.info("[singleflight] leader cancelled, re-electing key=%s", key[:12])
+
+        fut = asyncio.get_running_loop().create_future()
+        self._calls[key] = fut
+        self.leaders += 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # 标记已读取，避免无人等待时的 "never retrieved" 警告
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            self._calls.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,153 @@
+from __future__ import annotations
+import asyncio
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator
+
+from .config import settings
+from .metrics import registry
+
+logger = logging.getLogger("imagen.startup")
+
+WarmupStep = Callable[[], Awaitable[Any]]
+
+
+def _process_started() -> float:
+    """进程启动时刻（time.monotonic 时间轴）；读取 /proc，其他平台退回本模块的导入时刻。"""
+    now = time.monotonic()
+    try:
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        with open("/proc/self/stat") as f:
+            # 进程名可能含空格：从最后一个 ")" 之后数，starttime 是第 22 个字段
+            fields = f.read().rsplit(")", 1)[1].split()
+        age = uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return now - max(0.0, age)
+    except (OSError, ValueError, IndexError):
+        return now
+
+
+def _init_pillow() -> None:
+    # 首次打开图片时 Pillow 才逐个加载格式插件；预热时一次加载完
+    from PIL import Image  # type: ignore
+
+    Image.init()
+
+
+async def _warm_providers() -> None:
+    from .services.router import provider_router
+
+    failed = {name: r for name, r in (await provider_router.warm()).items() if r != "ok"}
+    if failed:
+        raise RuntimeError("; ".join(f"{name}: {r}" for name, r in failed.items()))
+
+
+async def _warm_postprocess() -> None:
+    from .services.postprocess import postprocessor
+
+    await postprocessor.warm()
+
+
+def warmup_steps() -> Dict[str, WarmupStep]:
+    steps: Dict[str, WarmupStep] = {
+        "pillow": lambda: asyncio.to_thread(_init_pillow),
+        "providers": _warm_providers,
+    }
+    if settings.POSTPROCESS_ENABLED:
+        steps["postprocess"] = _warm_postprocess
+    return steps
+
+
+class Startup:
+    """
+    进程的启动流程与就绪状态（API 与 python -m api.worker 共用）：
+    - phase()：启动流程各阶段计时（打开存储、HTTP 客户端、任务池 / 队列消费者……）
+    - warm_up()：启动流程结束、开始接收请求后在后台预热；各步骤并发执行，有 WARMUP_TIMEOUT 时限，失败只记录
+    - 里程碑（距进程启动的秒数）：imported（模块导入完成）、serving（开始接收请求）、ready（预热结束）、
+      first_job（第一个任务执行结束），即冷启动到首个任务的耗时
+    """
+
+    def __init__(self):
+        self.started = _process_started()
+        self.state = "starting"  # starting | warming | ready | stopping
+        self.phases: Dict[str, float] = {}
+        self.milestones: Dict[str, float] = {}
+        self.warmup: Dict[str, str] = {}  # 步骤 -> "ok" | 错误
+
+    def mark(self, milestone: str) -> None:
+        """记录里程碑（只记第一次）。"""
+        if milestone not in self.milestones:
+            self.milestones[milestone] = elapsed = time.monotonic() - self.started
+            logger.info("[startup] %s at %.3fs after process start", milestone, elapsed)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.monotonic() - t0
+            logger.info("[startup] phase %s took %.3fs", name, self.phases[name])
+
+    async def _step(self, name: str, step: WarmupStep) -> None:
+        t0 = time.monotonic()
+        try:
+            await asyncio.wait_for(step(), timeout=settings.WARMUP_TIMEOUT)
+            self.warmup[name] = "ok"
+        except asyncio.TimeoutError:
+            self.warmup[name] = f"timed out after {settings.WARMUP_TIMEOUT:g}s"
+        except Exception as e:
+            self.warmup[name] = f"{type(e).__name__}: {e}"
+        self.phases[f"warmup_{name}"] = time.monotonic() - t0
+        if self.warmup[name] != "ok":
+            logger.warning("[startup] warm-up %s failed: %s", name, self.warmup[name])
+
+    def serving(self) -> None:
+        """启动流程结束：开始接收请求；不预热时直接就绪。"""
+        self.mark("serving")
+        if settings.STARTUP_WARMUP:
+            self.state = "warming"
+        else:
+            self.set_ready()
+
+    async def warm_up(self, steps: Dict[str, WarmupStep]) -> None:
+        with self.phase("warmup"):
+            await asyncio.gather(*(self._step(name, step) for name, step in steps.items()))
+        self.set_ready()
+
+    def set_ready(self) -> None:
+        if self.state != "stopping":
+            self.state = "ready"
+            self.mark("ready")
+
+    def stopping(self) -> None:
+        # 关闭期间 /ready 返回 503，负载均衡器不再转发新请求
+        self.state = "stopping"
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "status": self.state,
+            "uptime": round(time.monotonic() - self.started, 3),
+            "milestones": {k: round(v, 3) for k, v in self.milestones.items()},
+            "phases": {k: round(v, 3) for k, v in self.phases.items()},
+            "warmup": dict(self.warmup),
+        }
+
+
+startup = Startup()
+
+registry.gauge("imagen_ready", "1 when the startup sequence and warm-up are done", fn=lambda: float(startup.ready))
+registry.gauge(
+    "imagen_startup_phase_seconds", "Duration of each startup / warm-up phase", ("phase",),
+    fn=lambda: {(k,): v for k, v in startup.phases.items()},
+)
+registry.gauge(
+    "imagen_cold_start_seconds", "Seconds from process start to each startup milestone", ("milestone",),
+    fn=lambda: {(k,): v for k, v in startup.milestones.items()},
+)
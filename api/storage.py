@@ -1,9 +1,20 @@
 from __future__ import annotations
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Iterable
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+import hashlib
+import hmac
+import os
+import secrets
 import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 
 from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
 
 from .config import settings
 
@@ -12,17 +23,133 @@ BASE_DIR = Path(settings.STORAGE_DIR)
 UPLOADS_DIR = BASE_DIR / "uploads"
 RESULTS_DIR = BASE_DIR / "results"
 JOBS_DIR = BASE_DIR / "jobs"
+BATCHES_DIR = BASE_DIR / "batches"
+BLOBS_DIR = BASE_DIR / "blobs"
+BLOBS_TMP_DIR = BLOBS_DIR / ".tmp"
 
-for d in (UPLOADS_DIR, RESULTS_DIR, JOBS_DIR):
-    d.mkdir(parents=True, exist_ok=True)
+_dirs_ready = False
 
 
-def save_upload_file(upload: UploadFile, dest_dir: Path) -> Path:
-    dest_dir.mkdir(parents=True, exist_ok=True)
-    target = dest_dir / upload.filename
-    with target.open("wb") as f:
-        shutil.copyfileobj(upload.file, f)
-    return target
+def ensure_storage_dirs() -> None:
+    """
+    创建存储目录。导入本模块不再有文件系统副作用：由启动流程（api.startup）显式调用，
+    各存储在首次打开时也会调用（脚本 / 单独使用时）。
+    """
+    global _dirs_ready
+    if _dirs_ready:
+        return
+    for d in (UPLOADS_DIR, RESULTS_DIR, JOBS_DIR, BATCHES_DIR, BLOBS_TMP_DIR):
+        d.mkdir(parents=True, exist_ok=True)
+    _dirs_ready = True
+
+
+class LazySQLite:
+    """
+    SQLite 连接在首次使用 _conn 时才打开（建目录、建表），导入模块不打开数据库；
+    启动流程调用 open() 提前打开，首个请求不再付这部分开销。子类实现 _open()。
+    """
+
+    _db: Optional[sqlite3.Connection] = None
+    _open_lock = threading.RLock()
+
+    def _open(self) -> sqlite3.Connection:
+        raise NotImplementedError
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        conn = self._db
+        if conn is None:
+            with self._open_lock:
+                if self._db is None:
+                    ensure_storage_dirs()
+                    self._db = self._open()
+                conn = self._db
+        return conn
+
+    def open(self) -> None:
+        self._conn
+
+
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+
+class UploadRejected(Exception):
+    status_code = 400
+
+
+class UploadTooLarge(UploadRejected):
+    status_code = 413
+
+
+class UnsupportedImage(UploadRejected):
+    status_code = 415
+
+
+@dataclass
+class IngestedUpload:
+    path: Path
+    sha256: str
+    size: int
+    ext: str
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """根据文件头识别图片格式，返回扩展名；非图片返回 None。"""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    if head.startswith(b"BM"):
+        return "bmp"
+    return None
+
+
+async def ingest_upload(upload: UploadFile, max_bytes: int) -> IngestedUpload:
+    """
+    分块流式写入上传文件：边写边计算 SHA-256，超过 max_bytes 立即中止（UploadTooLarge），
+    首块即校验图片文件头（UnsupportedImage）；完成后以摘要存入 CAS（同一内容只保存一份，
+    返回的 blob 已计入一次引用，由任务记录持有）。
+    """
+    if upload.size is not None and upload.size > max_bytes:
+        raise UploadTooLarge(f"file exceeds {max_bytes} bytes")
+    ensure_storage_dirs()
+    fd, tmp_name = tempfile.mkstemp(dir=str(BLOBS_TMP_DIR), prefix="upload-", suffix=".tmp")
+    tmp = Path(tmp_name)
+    h = hashlib.sha256()
+    size = 0
+    head = b""
+    ext: Optional[str] = None
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if ext is None:
+                    head += chunk[:16]
+                    if len(head) >= 12:
+                        ext = sniff_image_type(head)
+                        if ext is None:
+                            raise UnsupportedImage("file is not a supported image (png/jpeg/webp/gif/bmp)")
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"file exceeds {max_bytes} bytes")
+                h.update(chunk)
+                await run_in_threadpool(f.write, chunk)
+        if ext is None:
+            ext = sniff_image_type(head)
+            if ext is None:
+                raise UnsupportedImage("file is not a supported image (png/jpeg/webp/gif/bmp)")
+        digest = h.hexdigest()
+        target = await run_in_threadpool(blob_store.put_file, tmp, digest, ext)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return IngestedUpload(path=target, sha256=digest, size=size, ext=ext)
 
 
 def save_bytes(content: bytes, dest_path: Path) -> Path:
@@ -31,16 +158,301 @@ def save_bytes(content: bytes, dest_path: Path) -> Path:
     return dest_path
 
 
+def file_sha256(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def job_json_path(job_id: str) -> Path:
     return JOBS_DIR / f"{job_id}.json"
 
 
 def result_url(path: Path) -> str:
-    #  Serve via FastAPI StaticFiles mounted at /files
+    # 由 routes/files.py 提供（CAS blob 与旧版 results/ 目录）
     rel = path.relative_to(BASE_DIR)
     return f"/files/{rel.as_posix()}"
 
 
+def path_from_url(url: str) -> Optional[Path]:
+    """result_url 的逆操作；不是 /files/ 下的地址时返回 None。"""
+    prefix = "/files/"
+    if not url.startswith(prefix):
+        return None
+    path = (BASE_DIR / url[len(prefix):]).resolve()
+    return path if path.is_relative_to(BASE_DIR.resolve()) else None
+
+
+def batch_json_path(batch_id: str) -> Path:
+    return BATCHES_DIR / f"{batch_id}.json"
+
+
+def blob_url(digest: str, ext: str) -> str:
+    return result_url(blob_store.path(digest, ext))
+
+
+SIGNING_KEY_PATH = BASE_DIR / ".signing_key"
+_signing_key: Optional[bytes] = None
+_signing_key_lock = threading.Lock()
+
+
+def _load_signing_key() -> bytes:
+    """
+    FILES_SIGNING_KEY 为空时使用 storage/.signing_key：首次使用时随机生成并持久化（O_EXCL，0600），
+    共享同一 storage/ 的 API 进程与 worker、以及重启前后签出的 URL 都有效。多节点不共享磁盘时须显式设置。
+    """
+    global _signing_key
+    with _signing_key_lock:
+        if _signing_key is None:
+            if settings.FILES_SIGNING_KEY:
+                _signing_key = settings.FILES_SIGNING_KEY.encode()
+            else:
+                BASE_DIR.mkdir(parents=True, exist_ok=True)
+                try:
+                    fd = os.open(SIGNING_KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                except FileExistsError:
+                    pass
+                else:
+                    with os.fdopen(fd, "w") as f:
+                        f.write(secrets.token_hex(32))
+                # 并发创建时另一进程可能尚未写完：读到空内容则稍后重读
+                for _ in range(50):
+                    key = SIGNING_KEY_PATH.read_text().strip()
+                    if key:
+                        break
+                    time.sleep(0.01)
+                else:
+                    raise RuntimeError(f"{SIGNING_KEY_PATH} is empty; set FILES_SIGNING_KEY or remove the file")
+                _signing_key = key.encode()
+        return _signing_key
+
+
+def _signature(name: str, expires: int) -> str:
+    return hmac.new(_load_signing_key(), f"{name}:{expires}".encode(), hashlib.sha256).hexdigest()
+
+
+def signed_blob_url(digest: str, ext: str, now: Optional[float] = None) -> str:
+    """
+    对象存储风格的签名地址：<FILES_OBJECT_BASE_URL>/objects/<digest>.<ext>?expires=..&sig=..
+    过期时间按 TTL/2 的窗口取整，同一窗口内签出的 URL 相同，浏览器 / CDN 缓存可以命中。
+    """
+    ttl = max(2, settings.FILES_SIGNED_URL_TTL)
+    window = ttl // 2
+    expires = int((now or time.time()) // window * window + ttl)
+    name = f"{digest}.{ext}"
+    return f"{settings.FILES_OBJECT_BASE_URL.rstrip('/')}/objects/{name}?expires={expires}&sig={_signature(name, expires)}"
+
+
+def verify_blob_signature(name: str, expires: int, sig: str) -> bool:
+    return expires >= time.time() and hmac.compare_digest(_signature(name, expires), sig)
+
+
+class BlobStore(LazySQLite):
+    """
+    内容寻址存储（CAS）：blobs/<ab>/<cd>/<sha256>.<ext>，同一内容只写一次。
+    引用计数保存在 SQLite（blobs.db）：任务输入、任务结果、结果缓存条目各持有一次引用；
+    引用归零的 blob 超过宽限期后由 gc() 删除（宽限期避免“刚写入、尚未被任务记录引用”的竞争）。
+    引用计数的变更与 gc 都在 BEGIN IMMEDIATE 事务内完成（文件的写入 / 删除也在事务内），
+    多个进程（API、独立 worker、保留服务）共享 blobs.db 时不会删掉刚被另一进程引用的 blob。
+    public 标记任务结果（结果图、后处理版本、总览图）：只有这些 blob 通过 /files/blobs 对外提供，上传的输入图不提供。
+    """
+
+    def __init__(self, root: Path, db_path: Path):
+        self.root = root
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self.bytes_written = 0
+        self.writes_skipped = 0
+        self.needs_public_backfill = False  # 旧库升级：public 列刚加上，需按任务记录回填
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                ext TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                refs INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                public INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_blobs_refs ON blobs(refs, updated_at);
+            """
+        )
+        if "public" not in {row[1] for row in conn.execute("PRAGMA table_info(blobs)")}:
+            conn.execute("ALTER TABLE blobs ADD COLUMN public INTEGER NOT NULL DEFAULT 0")
+            self.needs_public_backfill = True
+        return conn
+
+    def path(self, digest: str, ext: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / f"{digest}.{ext}"
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        # _lock 串行本进程内的调用；BEGIN IMMEDIATE 在读取之前取得数据库写锁，与其他进程互斥
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _incref_existing(self, digest: str, public: bool = False) -> Optional[str]:
+        """已存在则引用 +1（public 时同时标记为可公开）并返回其扩展名，否则返回 None（须在 _transaction 内）。"""
+        row = self._conn.execute("SELECT ext FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        if row is None or not self.path(digest, row[0]).exists():
+            return None
+        self._conn.execute(
+            "UPDATE blobs SET refs = refs + 1, updated_at = ?, public = MAX(public, ?) WHERE digest = ?",
+            (time.time(), int(public), digest),
+        )
+        return row[0]
+
+    def _insert(self, digest: str, ext: str, size: int, public: bool = False) -> None:
+        # 记录已存在但文件丢失时（文件刚写回）：保留已有的引用数再 +1，不重置
+        now = time.time()
+        self._conn.execute(
+            "INSERT INTO blobs (digest, ext, size, refs, created_at, updated_at, public) VALUES (?, ?, ?, 1, ?, ?, ?) "
+            "ON CONFLICT(digest) DO UPDATE SET ext = excluded.ext, size = excluded.size, refs = refs + 1, "
+            "updated_at = excluded.updated_at, public = MAX(public, excluded.public)",
+            (digest, ext, size, now, now, int(public)),
+        )
+
+    def put_bytes(self, data: bytes, ext: str, public: bool = False) -> Tuple[str, Path]:
+        """写入（或复用）一段内容并引用 +1，返回 (digest, path)；任务结果传 public=True。"""
+        digest = hashlib.sha256(data).hexdigest()
+        with self._transaction():
+            existing = self._incref_existing(digest, public)
+            if existing is not None:
+                self.writes_skipped += 1
+                return digest, self.path(digest, existing)
+            target = self.path(digest, ext)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=str(BLOBS_TMP_DIR), prefix="put-", suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, target)
+            self._insert(digest, ext, len(data), public)
+            self.bytes_written += len(data)
+            return digest, target
+
+    def put_file(self, src: Path, digest: str, ext: str) -> Path:
+        """把已计算好摘要的临时文件移入 CAS（已存在则丢弃临时文件）并引用 +1。"""
+        with self._transaction():
+            existing = self._incref_existing(digest)
+            if existing is not None:
+                src.unlink(missing_ok=True)
+                self.writes_skipped += 1
+                return self.path(digest, existing)
+            target = self.path(digest, ext)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            size = src.stat().st_size
+            os.replace(src, target)
+            self._insert(digest, ext, size)
+            self.bytes_written += size
+            return target
+
+    def incref(self, digest: str) -> Optional[Path]:
+        """已有 blob 引用 +1，返回其路径；blob 不存在时返回 None。"""
+        with self._transaction():
+            ext = self._incref_existing(digest)
+        return None if ext is None else self.path(digest, ext)
+
+    def decref(self, digests: Iterable[str]) -> None:
+        now = time.time()
+        with self._transaction():
+            for digest in digests:
+                self._conn.execute(
+                    "UPDATE blobs SET refs = MAX(refs - 1, 0), updated_at = ? WHERE digest = ?", (now, digest)
+                )
+
+    def is_public(self, digest: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT public FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        return bool(row and row[0])
+
+    def publish(self, digests: Iterable[str]) -> None:
+        """把已有 blob 标记为可公开（升级时按任务记录的 result_blobs / variant_blobs 回填）。"""
+        with self._lock:
+            self._conn.executemany("UPDATE blobs SET public = 1 WHERE digest = ?", [(d,) for d in digests])
+
+    def size_of(self, digest: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        return row[0] if row else 0
+
+    def gc(self, grace: float = 3600.0, batch: int = 200, dry_run: bool = False) -> Tuple[int, int]:
+        """删除一批引用为 0 且超过宽限期的 blob，返回 (删除数, 字节数)。"""
+        cutoff = time.time() - grace
+        if dry_run:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT digest, ext, size FROM blobs WHERE refs <= 0 AND updated_at < ? LIMIT ?",
+                    (cutoff, batch),
+                ).fetchall()
+            return len(rows), sum(r[2] for r in rows)
+        # 先删记录、再删文件，且在同一个写事务内：其他进程的引用要么在此之前（refs > 0，不会被选中），
+        # 要么在提交之后（记录已不存在，按新内容重新写入）
+        with self._transaction():
+            rows = self._conn.execute(
+                "DELETE FROM blobs WHERE digest IN "
+                "(SELECT digest FROM blobs WHERE refs <= 0 AND updated_at < ? LIMIT ?) "
+                "RETURNING digest, ext, size",
+                (cutoff, batch),
+            ).fetchall()
+            for digest, ext, _ in rows:
+                self.path(digest, ext).unlink(missing_ok=True)
+        return len(rows), sum(r[2] for r in rows)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count, total, unreferenced, unreferenced_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refs <= 0), 0), "
+                "COALESCE(SUM(CASE WHEN refs <= 0 THEN size ELSE 0 END), 0) FROM blobs"
+            ).fetchone()
+        return {
+            "blobs": count,
+            "bytes": total,
+            "unreferenced": unreferenced,
+            "unreferenced_bytes": unreferenced_bytes,
+            "bytes_written": self.bytes_written,
+            "writes_skipped": self.writes_skipped,
+        }
+
+
+blob_store = BlobStore(BLOBS_DIR, BASE_DIR / "blobs.db")
+
+
+def path_size(path: Path) -> int:
+    """文件或目录（递归）占用的字节数。"""
+    try:
+        if path.is_dir() and not path.is_symlink():
+            return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+def remove_path(path: Path) -> int:
+    """删除文件或目录，返回释放的字节数（不存在时为 0）。"""
+    size = path_size(path)
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path, ignore_errors=True)
+    elif path.exists() or path.is_symlink():
+        path.unlink(missing_ok=True)
+    else:
+        return 0
+    return size
+
+
 def clean_dir(dir_path: Path, keep: Iterable[Path] | None = None) -> None:
     keep = set(keep or [])
     for p in dir_path.glob("*"):
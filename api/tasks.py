@@ -1,127 +1,297 @@
 from __future__ import annotations
-import json
-import threading
 import asyncio
 import logging
+import time
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 logger = logging.getLogger("imagen.tasks")
-from .storage import job_json_path, RESULTS_DIR, result_url, save_bytes
+from .events import job_events
+from .metrics import JOBS, SLOTS, metric_labels, observe_stage, set_metric_labels, stage_timer
+from .job_store import job_store
+from .models import JobStatusResponse
+from .storage import blob_store, file_sha256, path_from_url, result_url, sniff_image_type
 from .config import settings
-from .services.imagen_adapter import ImagenAdapter
-from .services.proxy_adapter import ProxyAdapter
-from .services.prompts import TEMPLATES, build_prompt, HAIRSTYLES
+from .queue import job_queue
+from .startup import startup
+from .worker_pool import QueueFullError, worker_pool
+from .services.prompts import JobTypeSpec, Variant, get_job_type, priority_range
+from .services.postprocess import postprocessor
+from .services.preprocess import preprocessor
+from .services.result_cache import cache_key, result_cache
+from .services.router import provider_router
+from .services.singleflight import single_flight
 
 
-def _update(job_id: str, **patch: Any) -> Dict[str, Any]:
-    p = job_json_path(job_id)
-    data = json.loads(p.read_text(encoding="utf-8"))
-    data.update(patch)
-    p.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+def _update_sync(job_id: str, **patch: Any) -> Dict[str, Any]:
+    data = job_store.update(job_id, **patch)
+    # 推送给 SSE / WebSocket 订阅者
+    job_events.publish(job_id, JobStatusResponse.from_record(data).model_dump())
     return data
 
 
-def _load(job_id: str) -> Dict[str, Any]:
-    p = job_json_path(job_id)
-    return json.loads(p.read_text(encoding="utf-8"))
+async def _update(job_id: str, **patch: Any) -> Dict[str, Any]:
+    # 任务存储（SQLite 事务 / JSON 文件）的读写在线程中执行，不阻塞事件循环
+    return await asyncio.to_thread(_update_sync, job_id, **patch)
 
 
-# Background worker without Celery (dev-friendly)
-def process_job_background(job_id: str) -> None:
-    t = threading.Thread(target=_run_job, args=(job_id,), daemon=True)
-    t.start()
+async def _load(job_id: str) -> Dict[str, Any]:
+    return await asyncio.to_thread(job_store.get, job_id)
 
 
-def _run_job(job_id: str) -> None:
+def job_priority(job_type: str, params: Dict[str, Any]) -> int:
+    # 入队时已校验；恢复旧记录（worker.recover）时仍限制在允许范围内，不让旧数据插队
+    low, high = priority_range(job_type)
     try:
-        _update(job_id, status="running", progress=5)
-        data = _load(job_id)
+        return max(low, min(int(params["priority"]), high))
+    except (KeyError, TypeError, ValueError):
+        return low
+
+
+# ---- 任务分发：memory 模式交给进程内常驻的 asyncio 任务池，持久队列模式只入队（由 api.worker 消费） ----
+def check_capacity() -> None:
+    """在保存上传文件之前调用，排队数达到 JOB_QUEUE_LIMIT 时抛出 QueueFullError。"""
+    if job_queue is None:
+        worker_pool.check_capacity()
+        return
+    depth = job_queue.depth()
+    if depth >= settings.JOB_QUEUE_LIMIT:
+        raise QueueFullError(depth, settings.JOB_QUEUE_RETRY_AFTER)
+
+
+def set_group_limit(group: str, limit: int) -> None:
+    if job_queue is None:
+        worker_pool.set_group_limit(group, limit)
+    else:
+        job_queue.set_group_limit(group, limit)
+
+
+def process_job_background(
+    job_id: str, job_type: str, priority: int = 0, group: Optional[str] = None, client: Optional[str] = None
+) -> None:
+    if job_queue is None:
+        worker_pool.submit(job_id, job_type, priority, group, client)
+    else:
+        # 持久队列同样按客户端公平调度（见 JobQueue.reserve）
+        job_queue.enqueue(job_id, job_type, priority, group, client)
+
+
+def queue_stats() -> Dict[str, Any]:
+    if job_queue is None:
+        return {"backend": "memory", **worker_pool.stats()}
+    return {"queue_limit": settings.JOB_QUEUE_LIMIT, **job_queue.stats()}
+
+
+def mark_failed(job_id: str, error: str) -> None:
+    data = _update_sync(job_id, status="failed", progress=100, error=error)
+    JOBS.inc(job_type=data.get("type") or "", status="failed")
+
+
+async def run_job(job_id: str) -> None:
+    job_type = None
+    try:
+        data = await _update(job_id, status="running", progress=5)
         job_type = data.get("type")
+        # 本任务内的阶段计时都带上 job_type 标签
+        set_metric_labels(job_type=job_type or "")
+        if data.get("created_at"):
+            observe_stage("queue_wait", max(0.0, time.time() - data["created_at"]))
         params: Dict[str, Any] = data.get("params") or {}
         input_path = Path(data.get("input_path"))
         logger.info("[job %s] start type=%s input=%s params=%s", job_id, job_type, input_path, params)
 
-        # Dispatch to async pipeline
-        results = asyncio.run(_execute(job_id, job_type, input_path, params))
-        logger.info("[job %s] pipeline returned %d image(s)", job_id, len(results or []))
-
-        _update(job_id, progress=95)
-        # Save results to disk
-        out_dir = RESULTS_DIR / job_id
-        out_dir.mkdir(parents=True, exist_ok=True)
-        urls: List[str] = []
-        for i, img_bytes in enumerate(results, start=1):
-            out_img = out_dir / f"result_{i}.png"
-            save_bytes(img_bytes, out_img)
-            urls.append(result_url(out_img))
-
-        _update(job_id, status="finished", progress=100, results=urls)
+        # Dispatch to async pipeline（结果在 fan-out 中逐个落盘并更新进度）
+        urls, failed = await _execute(job_id, job_type, input_path, params, data.get("input_sha256"))
+        logger.info("[job %s] pipeline returned %d image(s), %d failed slot(s)", job_id, len(urls), len(failed))
+
+        if not urls:
+            errors = "; ".join(f"#{f['index']} {f['error']}" for f in failed)
+            await _update(job_id, status="failed", progress=100, error=f"no image produced: {errors}")
+            JOBS.inc(job_type=job_type or "", status="failed")
+            return
+        await _update(job_id, status="finished", progress=100, results=urls, failed_slots=failed)
+        JOBS.inc(job_type=job_type or "", status="finished")
         logger.info("[job %s] finished with %d outputs", job_id, len(urls))
     except Exception as e:
         logger.exception("[job %s] failed: %s", job_id, e)
-        _update(job_id, status="failed", error=str(e))
+        await _update(job_id, status="failed", error=str(e))
+        JOBS.inc(job_type=job_type or "", status="failed")
+    finally:
+        # 冷启动到首个任务结束的耗时（imagen_cold_start_seconds{milestone="first_job"}）
+        startup.mark("first_job")
 
 
-async def _execute(job_id: str, job_type: str, image_path: Path, params: Dict[str, Any]) -> List[bytes]:
-    # Choose provider
-    if settings.PROVIDER.lower() == "proxy":
-        model = (settings.PROXY_MODEL or settings.GOOGLE_IMAGE_MODEL)
-        adapter = ProxyAdapter(api_key=(settings.PROXY_API_KEY or ""), base_url=settings.PROXY_BASE_URL, model=model)
-        provider_desc = f"proxy base={settings.PROXY_BASE_URL} model={model}"
-    else:
-        adapter = ImagenAdapter(api_key=settings.GOOGLE_API_KEY, model=settings.GOOGLE_IMAGE_MODEL)
-        provider_desc = f"google model={settings.GOOGLE_IMAGE_MODEL}"
+async def _execute(
+    job_id: str,
+    job_type: str,
+    image_path: Path,
+    params: Dict[str, Any],
+    input_digest: Optional[str] = None,
+) -> Tuple[List[str], List[Dict[str, Any]]]:
+    # 流水线由任务类型声明（services/prompts.py 的 JOB_TYPES）；参数已在入队时校验
+    spec = get_job_type(job_type)
+    # 上游由 provider router 选择（常驻适配器、按健康度与延迟路由、故障转移）
+    adapter = provider_router
+    # 没有后端时 edit 会直接报错，占位的空模型名只用于生成 key
+    models = provider_router.models or [""]
+    provider_desc = provider_router.describe()
 
     size = params.get("size", "1024x1024")
-    n = int(params.get("n", 1))
+    n = max(1, min(int(params.get("n", 1)), settings.MAX_OUTPUTS_PER_JOB))
     seed = params.get("seed")
+    seed = None if seed is None else int(seed)
     logger.info("[job %s] execute type=%s provider=%s size=%s n=%s seed=%s", job_id, job_type, provider_desc, size, n, seed)
 
-    if job_type == "figurine":
-        prompt = build_prompt(TEMPLATES["figurine"], params)
-        imgs = await adapter.edit(image_path, prompt, size=size, n=n, seed=seed)
-        logger.info("[job %s] figurine -> %d image(s)", job_id, len(imgs or []))
-        return imgs
-
-    if job_type == "era_style":
-        prompt = build_prompt(TEMPLATES["era_style"], params)
-        imgs = await adapter.edit(image_path, prompt, size=size, n=n, seed=seed)
-        logger.info("[job %s] era_style -> %d image(s)", job_id, len(imgs or []))
-        return imgs
-
-    if job_type == "enhance":
-        prompt = build_prompt(TEMPLATES["enhance"], params)
-        imgs = await adapter.edit(image_path, prompt, size=size, n=n, seed=seed)
-        logger.info("[job %s] enhance -> %d image(s)", job_id, len(imgs or []))
-        return imgs
-
-    if job_type == "old_photo_restore":
-        prompt = build_prompt(TEMPLATES["old_photo_restore"], params)
-        imgs = await adapter.edit(image_path, prompt, size=size, n=n, seed=seed)
-        logger.info("[job %s] old_photo_restore -> %d image(s)", job_id, len(imgs or []))
-        return imgs
-
-    if job_type == "id_photo":
-        prompt = build_prompt(TEMPLATES["id_photo"], params)
-        imgs = await adapter.edit(image_path, prompt, size=size, n=n, seed=seed)
-        logger.info("[job %s] id_photo -> %d image(s)", job_id, len(imgs or []))
-        return imgs
-
-    if job_type == "hairstyle_grid":
-        # 逐个发型生成，收集 9 张
-        results: List[bytes] = []
-        for name in HAIRSTYLES:
-            hair_prompt = f"为此人更换为{name}发型，保持脸部特征不变，正面头像构图，均匀光线，背景干净，高分辨率。"
-            prompt = build_prompt(hair_prompt, params)
-            imgs = await adapter.edit(image_path, prompt, size=size, n=1, seed=seed)
-            logger.info("[job %s] hairstyle %s -> %d image(s)", job_id, name, len(imgs or []))
-            if imgs:
-                results.append(imgs[0])
-        logger.info("[job %s] hairstyle_grid total -> %d image(s)", job_id, len(results))
-        return results
-
-    # default fallback: return original via no-op edit prompt to keep pipeline stable
-    prompt = "Keep the image, minor enhance for clarity."
-    return await adapter.edit(image_path, prompt, size=size, n=1, seed=seed)
+    with stage_timer("prompt_build"):
+        variants = spec.variants(params, n, seed)
+    # 上传时已计算摘要；旧任务没有则补算
+    input_digest = input_digest or await asyncio.to_thread(file_sha256, image_path)
+    keys = [
+        # seed 为空的 n>1 采样用槽位序号区分，避免多张结果命中同一条缓存
+        {
+            model: cache_key(input_digest, prompt, model, size, v_seed, i if v_seed is None and n > 1 else 0)
+            for model in models
+        }
+        for i, (_, prompt, v_seed) in enumerate(variants)
+    ]
+    urls, failed = await _fan_out(job_id, spec, adapter, image_path, variants, size, keys, input_digest)
+    if spec.postprocess and spec.contact_sheet and len(urls) > 1:
+        # 九宫格等多图任务：额外生成一张平铺总览图，列表页只需加载这一张
+        paths = [p for p in (path_from_url(u) for u in urls) if p is not None]
+        sheet, blobs = await postprocessor.contact_sheet(paths)
+        if sheet is not None:
+            current = await _load(job_id)
+            await _update(job_id, contact_sheet=sheet, variant_blobs=[*(current.get("variant_blobs") or []), *blobs])
+    return urls, failed
+
+
+async def _fan_out(
+    job_id: str,
+    spec: JobTypeSpec,
+    adapter: Any,
+    image_path: Path,
+    variants: List[Variant],
+    size: str,
+    keys: List[Dict[str, str]],
+    input_digest: str,
+) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """
+    并发执行子请求（每个任务最多 FANOUT_CONCURRENCY 个同时在途），
+    每完成一个就落盘、按槽位顺序更新 results 与 progress；单个槽位失败只记录在 failed_slots。
+    结果写入 CAS blob；命中结果缓存的槽位直接引用已有 blob，不请求上游。
+    keys[idx] 为该槽位 {模型: 缓存 key}（按路由顺序）：查找时依次尝试，结果按实际服务的后端的模型写入。
+    每个槽位的结果随后在进程池中生成缩略图与 WebP/AVIF 版本（不占用上游并发名额）。
+    上游流式返回时，每解码完一张图片就作为部分结果落盘并推送（该槽位按半完成计进度），调用结束后以最终结果替换。
+    """
+    sem = asyncio.Semaphore(max(1, settings.FANOUT_CONCURRENCY))
+    slots: List[Optional[List[Tuple[str, str]]]] = [None] * len(variants)  # 每槽位 [(blob digest, url)]
+    slot_paths: Dict[int, List[Path]] = {}
+    slot_variants: Dict[int, List[Optional[Dict[str, Any]]]] = {}
+    variant_blobs: List[str] = []
+    failed: Dict[int, Dict[str, Any]] = {}
+    streaming: set = set()  # 已收到部分结果、尚未完成的槽位
+    done = 0
+    # 每次写入的是完整快照：串行化写入，并在锁内取快照，后写入的总是更新的状态
+    publish_lock = asyncio.Lock()
+
+    def _snapshot() -> Tuple[List[str], List[Dict[str, Any]]]:
+        urls = [u for slot in slots if slot for _, u in slot]
+        return urls, [failed[k] for k in sorted(failed)]
+
+    async def _publish() -> None:
+        async with publish_lock:
+            urls, failed_slots = _snapshot()
+            blobs = [d for slot in slots if slot for d, _ in slot]
+            described = [
+                v for i, slot in enumerate(slots) if slot for v in slot_variants.get(i) or [None] * len(slot)
+            ]
+            await _update(
+                job_id,
+                progress=5 + 90 * (2 * done + len(streaming)) // (2 * len(variants)),
+                results=urls,
+                result_blobs=blobs,
+                variants=described,
+                variant_blobs=list(variant_blobs),
+                failed_slots=failed_slots,
+            )
+
+    def _save(img_bytes: bytes) -> Tuple[str, Path]:
+        # 写入 CAS 并标记为可公开的任务结果
+        return blob_store.put_bytes(img_bytes, sniff_image_type(img_bytes[:16]) or "png", public=True)
+
+    async def _postprocess(idx: int) -> None:
+        described = []
+        for path in slot_paths.pop(idx, []):
+            variant, blobs = await postprocessor.variants(path)
+            described.append(variant)
+            variant_blobs.extend(blobs)
+        slot_variants[idx] = described
+
+    async def _call_slot(idx: int, label: str, prompt: str, slot_seed: Optional[int]) -> None:
+        partial: List[Tuple[str, Path]] = []
+
+        async def _on_image(img_bytes: bytes) -> None:
+            # 部分结果：重试 / 对冲可能重复送来同一张图，按摘要去重
+            digest, path = await asyncio.to_thread(_save, img_bytes)
+            if any(d == digest for d, _ in partial):
+                await asyncio.to_thread(blob_store.decref, [digest])
+                return
+            partial.append((digest, path))
+            slots[idx] = [(d, result_url(p)) for d, p in partial]
+            streaming.add(idx)
+            await _publish()
+
+        try:
+            # 相同 (输入图, prompt, model, size, seed) 的并发调用共享一次上游请求
+            # 预处理按 (输入摘要, size) 记忆，同一任务的多个子请求只编码一次
+            prepared = await preprocessor.prepare(image_path, input_digest, size) if spec.preprocess else None
+            on_image = _on_image if getattr(adapter, "streams", False) else None
+            imgs, model = await single_flight.do(
+                next(iter(keys[idx].values())),
+                lambda: adapter.serve(
+                    image_path, prompt, size=size, n=1, seed=slot_seed, image=prepared, on_image=on_image
+                ),
+            )
+            if not imgs:
+                raise RuntimeError("provider returned no image")
+            # 写入 CAS：相同内容（如回退返回的原图）不会重复落盘
+            with stage_timer("result_save"):
+                stored = await asyncio.to_thread(lambda: [_save(img_bytes) for img_bytes in imgs])
+            # 最终结果已各自持有引用，释放部分结果的引用（内容相同时只是计数 -1）
+            await asyncio.to_thread(blob_store.decref, [d for d, _ in partial])
+            slots[idx] = [(digest, result_url(path)) for digest, path in stored]
+            slot_paths[idx] = [path for _, path in stored]
+            logger.info("[job %s] slot %d (%s) -> %d image(s)", job_id, idx + 1, label, len(imgs))
+            # 只缓存单图结果；适配器回退返回的原图不入缓存
+            key = keys[idx].get(model) if model is not None else None
+            if settings.RESULT_CACHE_ENABLED and key and len(stored) == 1 and stored[0][0] != input_digest:
+                await asyncio.to_thread(result_cache.put, key, stored[0][0])
+            SLOTS.inc(outcome="success", **metric_labels.get())
+        except Exception as e:
+            if partial:
+                await asyncio.to_thread(blob_store.decref, [d for d, _ in partial])
+                slots[idx] = None
+            SLOTS.inc(outcome="failure", **metric_labels.get())
+            logger.warning("[job %s] slot %d (%s) failed: %s", job_id, idx + 1, label, e)
+            failed[idx] = {"index": idx + 1, "label": label, "error": str(e) or type(e).__name__}
+
+    async def _run_slot(idx: int, label: str, prompt: str, slot_seed: Optional[int]) -> None:
+        nonlocal done
+        hit = await asyncio.to_thread(result_cache.get_any, list(keys[idx].values())) if settings.RESULT_CACHE_ENABLED else None
+        if hit is not None:
+            slots[idx] = [(hit.stem, result_url(hit))]
+            slot_paths[idx] = [hit]
+            logger.info("[job %s] slot %d (%s) -> cache hit", job_id, idx + 1, label)
+            SLOTS.inc(outcome="cache_hit", **metric_labels.get())
+        else:
+            async with sem:
+                await _call_slot(idx, label, prompt, slot_seed)
+        if spec.postprocess and idx in slot_paths:
+            await _postprocess(idx)
+        # 与 done 同时更新：其他槽位在此之间推送时进度不会回退
+        streaming.discard(idx)
+        done += 1
+        await _publish()
 
+    await asyncio.gather(*(_run_slot(i, *v) for i, v in enumerate(variants)))
+    return _snapshot()
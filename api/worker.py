@@ -0,0 +1,286 @@
+from __future__ import annotations
+import asyncio
+import logging
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from .config import settings
+from .events import job_events
+from .job_store import import_legacy_jobs, job_store, publish_job_blobs
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, process_stats, registry
+from .queue import JobQueue, Lease, job_queue
+from .services.http_client import shared_http
+from .services.postprocess import postprocessor
+from .services.result_cache import result_cache
+from .startup import startup, warmup_steps
+from .storage import blob_store, ensure_storage_dirs
+from .tasks import job_priority, mark_failed, run_job
+
+logger = logging.getLogger("imagen.worker")
+
+Runner = Callable[[str], Awaitable[None]]
+
+TERMINAL_STATUSES = ("finished", "failed")
+# 恢复时跳过最近创建的 pending 任务：API 先写任务记录再入队，两步之间的任务不是“丢失”的
+RECOVER_GRACE = 10.0
+
+
+class QueueWorker:
+    """
+    持久队列的消费者：concurrency 个协程各自 reserve -> run_job -> ack。
+    - 执行期间每 visibility_timeout/3 续约一次；续约失败说明租约已过期并可能被其他 worker 领取，放弃本次执行
+    - 被停止（SIGTERM / 应用关闭）时 nack，任务立即回到队列
+    - 进程崩溃时租约到期，任务在下一次 reserve 时重新投递；超过 max_deliveries 次标记为失败
+    - 已是 finished/failed 的任务（重复投递）直接 ack
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        runner: Runner,
+        concurrency: int = 4,
+        visibility_timeout: float = 60.0,
+        poll_interval: float = 0.5,
+        max_deliveries: int = 3,
+        type_limits: Optional[Dict[str, int]] = None,
+    ):
+        self.queue = queue
+        self.runner = runner
+        self.concurrency = max(1, int(concurrency))
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self.max_deliveries = max(1, int(max_deliveries))
+        self.type_limits = dict(type_limits or {})
+        self._consumers: List[asyncio.Task] = []
+        self.running = 0
+        self.processed = 0
+        self.redelivered = 0
+        self.lost_leases = 0
+
+    # ---- lifecycle ----
+    async def recover(self) -> int:
+        """
+        启动时调用：放回过期租约；状态为 running/pending 却不在队列中的任务（队列数据丢失、
+        或 worker 在入队前崩溃）重新入队。返回处理的任务数。
+        """
+        count = await asyncio.to_thread(self.queue.requeue_expired)
+        cutoff = time.time() - RECOVER_GRACE
+        for status in ("running", "pending"):
+            jobs = await asyncio.to_thread(job_store.list, status, cutoff, 100_000)
+            for job in jobs:
+                if await asyncio.to_thread(self.queue.state, job["id"]) is not None:
+                    continue
+                if status == "running":
+                    await asyncio.to_thread(job_store.update, job["id"], status="pending", progress=0)
+                priority = job_priority(job["type"], job.get("params") or {})
+                await asyncio.to_thread(
+                    self.queue.enqueue, job["id"], job["type"], priority, job.get("batch_id"), job.get("client")
+                )
+                count += 1
+        if count:
+            logger.warning("[worker] recovered %d job(s) into the queue", count)
+        return count
+
+    async def start(self) -> None:
+        if self._consumers:
+            return
+        self._consumers = [
+            asyncio.create_task(self._consume(i), name=f"queue-worker-{i}") for i in range(self.concurrency)
+        ]
+        logger.info(
+            "[worker] started concurrency=%d visibility_timeout=%.0fs type_limits=%s",
+            self.concurrency, self.visibility_timeout, self.type_limits,
+        )
+
+    async def stop(self) -> None:
+        consumers, self._consumers = self._consumers, []
+        for t in consumers:
+            t.cancel()
+        await asyncio.gather(*consumers, return_exceptions=True)
+        logger.info("[worker] stopped after %d job(s)", self.processed)
+
+    # ---- consuming ----
+    async def _reserve(self) -> Optional[Lease]:
+        call = asyncio.ensure_future(asyncio.to_thread(self.queue.reserve, self.type_limits, self.visibility_timeout))
+        try:
+            return await asyncio.shield(call)
+        except asyncio.CancelledError:
+            # 停止时 reserve 可能仍在线程中执行：等它结束，领到的任务立即放回，不让它等到租约过期
+            lease = await call
+            if lease is not None:
+                await asyncio.to_thread(self.queue.nack, lease)
+            raise
+
+    async def _consume(self, index: int) -> None:
+        while True:
+            try:
+                lease = await self._reserve()
+            except Exception:
+                logger.exception("[worker] reserve failed")
+                await asyncio.sleep(self.poll_interval)
+                continue
+            if lease is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            await self._handle(lease)
+
+    async def _handle(self, lease: Lease) -> None:
+        try:
+            data = await asyncio.to_thread(job_store.get, lease.job_id)
+        except FileNotFoundError:
+            logger.warning("[worker] job %s has no record, dropping", lease.job_id)
+            await asyncio.to_thread(self.queue.ack, lease)
+            return
+        if data.get("status") in TERMINAL_STATUSES:
+            await asyncio.to_thread(self.queue.ack, lease)
+            return
+        if lease.deliveries > self.max_deliveries:
+            logger.error("[worker] job %s exceeded %d deliveries", lease.job_id, self.max_deliveries)
+            await asyncio.to_thread(
+                mark_failed, lease.job_id, f"worker lost the job {self.max_deliveries} time(s), giving up"
+            )
+            await asyncio.to_thread(self.queue.ack, lease)
+            return
+        if lease.deliveries > 1:
+            self.redelivered += 1
+            logger.warning("[worker] job %s redelivered (delivery %d)", lease.job_id, lease.deliveries)
+
+        lost = False
+        current = asyncio.current_task()
+
+        async def _heartbeat() -> None:
+            nonlocal lost
+            while True:
+                await asyncio.sleep(self.visibility_timeout / 3)
+                if not await asyncio.to_thread(self.queue.extend, lease, self.visibility_timeout):
+                    lost = True
+                    self.lost_leases += 1
+                    logger.warning("[worker] lease on job %s lost, abandoning this run", lease.job_id)
+                    current.cancel()
+                    return
+
+        heartbeat = asyncio.create_task(_heartbeat(), name=f"lease:{lease.job_id}")
+        self.running += 1
+        try:
+            await self.runner(lease.job_id)
+        except asyncio.CancelledError:
+            if lost:
+                current.uncancel()
+                return
+            # 停止中：放回队列，由其他 worker（或重启后的本 worker）接手；
+            # nack 失败时租约到期后同样会被重新投递
+            try:
+                await asyncio.to_thread(self.queue.nack, lease)
+            except Exception:
+                logger.exception(
+                    "[worker] nack of job %s failed, it will be redelivered after the lease expires", lease.job_id
+                )
+            raise
+        finally:
+            self.running -= 1
+            heartbeat.cancel()
+        self.processed += 1
+        await asyncio.to_thread(self.queue.ack, lease)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "running": self.running,
+            "processed": self.processed,
+            "redelivered": self.redelivered,
+            "lost_leases": self.lost_leases,
+        }
+
+
+def make_queue_worker(concurrency: Optional[int] = None) -> QueueWorker:
+    if job_queue is None:
+        raise RuntimeError("QUEUE_BACKEND=memory has no durable queue; set QUEUE_BACKEND=sqlite or redis")
+    return QueueWorker(
+        job_queue,
+        run_job,
+        concurrency=concurrency or settings.QUEUE_WORKER_CONCURRENCY,
+        visibility_timeout=settings.QUEUE_VISIBILITY_TIMEOUT,
+        poll_interval=settings.QUEUE_POLL_INTERVAL,
+        max_deliveries=settings.QUEUE_MAX_DELIVERIES,
+        type_limits=settings.JOB_TYPE_CONCURRENCY,
+    )
+
+
+def _serve_metrics(port: int) -> ThreadingHTTPServer:
+    """worker 进程没有 FastAPI：用标准库在后台线程上暴露 /metrics（阶段耗时、上游调用等）。"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+async def main(concurrency: Optional[int] = None, metrics_port: int = 0) -> None:
+    startup.mark("imported")
+    worker = make_queue_worker(concurrency)
+    loop = asyncio.get_running_loop()
+    job_events.bind(loop)
+    with startup.phase("storage"):
+        ensure_storage_dirs()
+        for store in (job_store, blob_store, result_cache):
+            store.open()
+        imported = await asyncio.to_thread(import_legacy_jobs, job_store)
+        if imported or blob_store.needs_public_backfill:
+            await asyncio.to_thread(publish_job_blobs, job_store, blob_store)
+    with startup.phase("http"):
+        await shared_http.start()
+    server = _serve_metrics(metrics_port) if metrics_port else None
+    if server is not None:
+        registry.gauge("imagen_worker_running", "Jobs running in this worker process", fn=lambda: worker.running)
+        registry.counter(
+            "imagen_worker_redelivered_total", "Jobs picked up again after a lost lease", fn=lambda: worker.redelivered
+        )
+        registry.gauge("imagen_process_rss_bytes", "Resident set size of this process", fn=lambda: process_stats()["rss_bytes"])
+        registry.gauge("imagen_process_threads", "Threads in this process", fn=lambda: process_stats()["threads"])
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    warmup: Optional[asyncio.Task] = None
+    try:
+        with startup.phase("workers"):
+            await worker.recover()
+            await worker.start()
+        startup.serving()
+        if settings.STARTUP_WARMUP:
+            warmup = asyncio.create_task(startup.warm_up(warmup_steps()), name="warmup")
+        await stop.wait()
+    finally:
+        startup.stopping()
+        if warmup is not None:
+            warmup.cancel()
+        await worker.stop()
+        postprocessor.shutdown()
+        await shared_http.aclose()
+        if server is not None:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run NanoImage jobs from the durable queue (QUEUE_BACKEND)")
+    parser.add_argument("--concurrency", type=int, default=None, help="jobs run at once (QUEUE_WORKER_CONCURRENCY)")
+    parser.add_argument("--metrics-port", type=int, default=0, help="serve Prometheus /metrics on this port")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    asyncio.run(main(args.concurrency, args.metrics_port))
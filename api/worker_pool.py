@@ -0,0 +1,250 @@
+from __future__ import annotations
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .clients import LimitsFor, limits_for
+from .config import settings
+
+logger = logging.getLogger("imagen.worker_pool")
+
+Runner = Callable[[str], Awaitable[None]]
+Item = Tuple[int, int, str, str, Optional[str], str]  # (priority, seq, job_id, job_type, group, client)
+
+NO_CLIENT = ""  # 未带客户端标识的任务（内部提交）共用一个调度队列
+
+
+class QueueFullError(Exception):
+    """队列深度超过 JOB_QUEUE_LIMIT，调用方应返回 429 并附带 Retry-After。"""
+
+    def __init__(self, depth: int, retry_after: int):
+        super().__init__(f"job queue is full (depth={depth})")
+        self.depth = depth
+        self.retry_after = retry_after
+
+
+class WorkerPool:
+    """
+    进程内常驻的 asyncio 任务池，替代“每个任务一个线程 + 一个事件循环”。
+    - 固定数量的 worker 协程共享 uvicorn 的事件循环
+    - 按客户端加权公平调度（start-time fair queuing）：每个客户端一个优先级队列，
+      客户端每取走一个任务，其虚拟时间前进 1/weight；总是从虚拟时间最小的客户端取任务，
+      新来的或空闲过的客户端从当前虚拟时间起步，一个客户端的大批量任务不会让其他客户端一直排队
+    - 客户端内部：priority 越小越先执行，同优先级按提交顺序
+    - 可按客户端限制同时运行数（ClientLimits.max_running），规则同下
+    - 按任务类型限制并发（JOB_TYPE_CONCURRENCY），被限流的任务留在队列里，不占用 worker
+    - 按分组限制并发（批量任务的子任务以 batch id 为组，见 set_group_limit），规则同上
+    - submit() 线程安全，可在同步路由（线程池）中调用
+    """
+
+    def __init__(
+        self,
+        size: int,
+        queue_limit: int,
+        type_limits: Optional[Dict[str, int]] = None,
+        client_limits: LimitsFor = limits_for,
+    ):
+        self.size = max(1, int(size))
+        self.queue_limit = max(1, int(queue_limit))
+        self.type_limits = dict(type_limits or {})
+        self.client_limits = client_limits
+
+        self._heaps: Dict[str, List[Item]] = {}  # client -> (priority, seq, job_id, job_type, group, client)
+        self._seq = itertools.count()
+        self._vtime = 0.0  # 最近一次取走的任务的虚拟开始时间
+        self._finish: Dict[str, float] = {}  # client -> 该客户端下一个任务的虚拟开始时间
+        self._running_by_client: Counter = Counter()
+        self._running_by_type: Counter = Counter()
+        self.group_limits: Dict[str, int] = {}
+        self._running_by_group: Counter = Counter()
+        self._queued_by_group: Counter = Counter()
+        self._running = 0
+        self._depth = 0  # 已提交但尚未被 worker 取走的任务数（含尚未进入 heap 的）
+        self._depth_lock = threading.Lock()
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._cond: Optional[asyncio.Condition] = None
+        self._workers: List[asyncio.Task] = []
+        self._runner: Optional[Runner] = None
+
+    # ---- lifecycle ----
+    async def start(self, runner: Runner) -> None:
+        if self._workers:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._cond = asyncio.Condition()
+        self._runner = runner
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"job-worker-{i}") for i in range(self.size)
+        ]
+        logger.info(
+            "[pool] started size=%d queue_limit=%d type_limits=%s",
+            self.size, self.queue_limit, self.type_limits,
+        )
+
+    async def stop(self) -> None:
+        workers, self._workers = self._workers, []
+        for t in workers:
+            t.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        logger.info("[pool] stopped (%d job(s) left in queue)", sum(len(h) for h in self._heaps.values()))
+
+    @property
+    def started(self) -> bool:
+        return bool(self._workers)
+
+    # ---- submission ----
+    def check_capacity(self) -> None:
+        """在保存上传文件之前调用，队列已满时抛出 QueueFullError。"""
+        depth = self.depth
+        if depth >= self.queue_limit:
+            raise QueueFullError(depth, settings.JOB_QUEUE_RETRY_AFTER)
+
+    def set_group_limit(self, group: str, limit: int) -> None:
+        """限制同一分组同时运行的任务数；该组任务全部结束后自动移除。"""
+        self.group_limits[group] = max(1, int(limit))
+
+    def submit(
+        self,
+        job_id: str,
+        job_type: str,
+        priority: int = 0,
+        group: Optional[str] = None,
+        client: Optional[str] = None,
+    ) -> None:
+        if self._loop is None:
+            raise RuntimeError("WorkerPool 尚未启动（应在应用 startup 中调用 start）")
+        with self._depth_lock:
+            self._depth += 1
+        item = (int(priority), next(self._seq), job_id, job_type, group, client or NO_CLIENT)
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self._loop:
+            self._loop.create_task(self._push(item))
+        else:
+            asyncio.run_coroutine_threadsafe(self._push(item), self._loop)
+
+    async def _push(self, item: Item) -> None:
+        assert self._cond is not None
+        async with self._cond:
+            heapq.heappush(self._heaps.setdefault(item[5], []), item)
+            if item[4] is not None:
+                self._queued_by_group[item[4]] += 1
+            self._cond.notify()
+
+    # ---- workers ----
+    def _eligible(self, item: Item) -> bool:
+        limit = self.type_limits.get(item[3])
+        if limit is not None and self._running_by_type[item[3]] >= limit:
+            return False
+        group = item[4]
+        limit = self.group_limits.get(group) if group is not None else None
+        return limit is None or self._running_by_group[group] < limit
+
+    def _pop_from(self, heap: List[Item]) -> Optional[Item]:
+        skipped = []
+        found = None
+        while heap:
+            item = heapq.heappop(heap)
+            if self._eligible(item):
+                found = item
+                break
+            skipped.append(item)
+        for item in skipped:
+            heapq.heappush(heap, item)
+        return found
+
+    def _pop_eligible(self) -> Optional[Item]:
+        # 按 (虚拟开始时间, 队首提交序号) 依次尝试各客户端，取第一个有可执行任务的
+        order = sorted(
+            (max(self._vtime, self._finish.get(client, 0.0)), heap[0][1], client)
+            for client, heap in self._heaps.items()
+            if heap
+        )
+        for start, _, client in order:
+            limits = self.client_limits(client or None)
+            if limits.max_running > 0 and self._running_by_client[client] >= limits.max_running:
+                continue
+            item = self._pop_from(self._heaps[client])
+            if item is None:
+                continue
+            self._vtime = start
+            self._finish[client] = start + 1.0 / limits.weight
+            if not self._heaps[client]:
+                del self._heaps[client]
+            return item
+        return None
+
+    def _forget_client(self, client: str) -> None:
+        # 客户端没有排队也没有运行中的任务时丢弃其虚拟时间；再次提交时从当前虚拟时间起步
+        if not self._running_by_client[client] and client not in self._heaps:
+            del self._running_by_client[client]
+            self._finish.pop(client, None)
+
+    async def _worker(self, idx: int) -> None:
+        assert self._cond is not None and self._runner is not None
+        while True:
+            async with self._cond:
+                item = self._pop_eligible()
+                while item is None:
+                    await self._cond.wait()
+                    item = self._pop_eligible()
+                _, _, job_id, job_type, group, client = item
+                self._running_by_type[job_type] += 1
+                self._running_by_client[client] += 1
+                self._running += 1
+                if group is not None:
+                    self._queued_by_group[group] -= 1
+                    self._running_by_group[group] += 1
+            with self._depth_lock:
+                self._depth -= 1
+            try:
+                await self._runner(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("[pool] worker %d: job %s crashed", idx, job_id)
+            finally:
+                async with self._cond:
+                    self._running_by_type[job_type] -= 1
+                    self._running_by_client[client] -= 1
+                    self._forget_client(client)
+                    self._running -= 1
+                    if group is not None:
+                        self._running_by_group[group] -= 1
+                        if not self._running_by_group[group] and not self._queued_by_group[group]:
+                            del self._running_by_group[group], self._queued_by_group[group]
+                            self.group_limits.pop(group, None)
+                    # 类型名额释放后，之前被跳过的任务可能变为可执行
+                    self._cond.notify_all()
+
+    # ---- introspection ----
+    @property
+    def depth(self) -> int:
+        with self._depth_lock:
+            return self._depth
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "size": self.size,
+            "queue_limit": self.queue_limit,
+            "depth": self.depth,
+            "running": self._running,
+            "running_by_type": {k: v for k, v in self._running_by_type.items() if v},
+            "running_by_group": {k: v for k, v in self._running_by_group.items() if v},
+            "running_by_client": {k or "-": v for k, v in self._running_by_client.items() if v},
+            "queued_by_client": {k or "-": len(h) for k, h in self._heaps.items() if h},
+        }
+
+
+worker_pool = WorkerPool(
+    size=settings.WORKER_POOL_SIZE,
+    queue_limit=settings.JOB_QUEUE_LIMIT,
+    type_limits=settings.JOB_TYPE_CONCURRENCY,
+)
@@ -0,0 +1,121 @@
+"""
+对比代理请求/响应中 base64 处理的峰值内存（tracemalloc）：
+- old：整图 b64encode 成 str -> dict -> json.dumps；响应 resp.json() + re.search + b64decode
+- new：JsonBase64Body 分块编码请求体；DataUrlScanner 按网络块增量解码响应
+用法：python scripts/bench_proxy_memory.py [--mb 10] [--images 1]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import re
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from api.services.b64stream import DataUrlScanner, JsonBase64Body, data_url_placeholder  # noqa: E402
+
+NET_CHUNK = 64 * 1024
+
+
+def envelope(url: str) -> dict:
+    return {
+        "model": "bench",
+        "stream": False,
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": "Edit this image"},
+            {"type": "image_url", "image_url": {"url": url}},
+        ]}],
+    }
+
+
+def old_request(path: Path) -> int:
+    data = path.read_bytes()
+    url = "data:image/png;base64," + base64.b64encode(data).decode("utf-8")
+    body = json.dumps(envelope(url)).encode("utf-8")  # httpx 的 json= 序列化
+    return len(body)
+
+
+async def new_request(path: Path) -> int:
+    body = JsonBase64Body(envelope(data_url_placeholder()), "image/png", path)
+    sent = 0
+    async for chunk in body:
+        sent += len(chunk)
+    return sent
+
+
+def old_response(wire: bytes) -> int:
+    raw = bytes(wire)  # httpx 读入完整响应体
+    payload = json.loads(raw)
+    text = payload["choices"][0]["message"]["content"]
+    total = 0
+    for m in re.finditer(r"data:image/([a-zA-Z0-9.+-]+);base64,([A-Za-z0-9+/=]+)", text):
+        total += len(base64.b64decode(m.group(2)))
+    return total
+
+
+def new_response(wire: bytes) -> int:
+    view = memoryview(wire)
+    scanner = DataUrlScanner()
+    total = 0
+    for i in range(0, len(view), NET_CHUNK):
+        # 模拟逐块到达的网络数据；解码出的图片在写入 blob 前仍需完整保留
+        total += sum(len(img) for img in scanner.feed(bytes(view[i: i + NET_CHUNK])))
+    total += sum(len(img) for img in scanner.close())
+    return total
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    result = fn(*args)
+    if asyncio.iscoroutine(result):
+        result = asyncio.run(result)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mb", type=float, default=10.0, help="size of each synthetic image")
+    parser.add_argument("--images", type=int, default=1, help="images per response")
+    parser.add_argument("--tmp", default="scripts/tmp")
+    args = parser.parse_args()
+
+    tmp = Path(args.tmp)
+    tmp.mkdir(parents=True, exist_ok=True)
+    src = tmp / "bench_input.bin"
+    size = int(args.mb * 1024 * 1024)
+    src.write_bytes(os.urandom(size))
+    images = [os.urandom(size) for _ in range(args.images)]
+    content = " ".join(f"![img](data:image/png;base64,{base64.b64encode(img).decode()})" for img in images)
+    wire = json.dumps({"choices": [{"message": {"content": content}}]}).encode("utf-8")
+    del content
+
+    mb = 1024 * 1024
+    rows = []
+    for name, fn, arg in (
+        ("request/old", old_request, src),
+        ("request/new", new_request, src),
+        ("response/old", old_response, wire),
+        ("response/new", new_response, wire),
+    ):
+        result, peak = measure(fn, arg)
+        rows.append((name, result, peak))
+        print(f"{name:<14} peak={peak / mb:8.1f} MiB  ({result} bytes)")
+
+    assert rows[0][1] == rows[1][1], "request bodies differ in length"
+    assert rows[2][1] == rows[3][1], "decoded images differ in length"
+    print(
+        "request peak ratio %.1fx, response peak ratio %.1fx"
+        % (rows[0][2] / max(rows[1][2], 1), rows[2][2] / max(rows[3][2], 1))
+    )
+    src.unlink()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+导入耗时剖析：在全新的解释器中以 python -X importtime 导入模块（默认 api.app），
+按顶层包汇总自身耗时，列出自身耗时最多的模块，并检查启动路径上不应出现的重模块（应在后台预热中加载）。
+用法：
+  python scripts/import_profile.py                       # 报告 api.app 的导入耗时
+  python scripts/import_profile.py --top 30 --json out.json
+  python scripts/import_profile.py --budget-ms 1500      # 总耗时超出预算时退出码为 1（CI 回归检查）
+  python scripts/import_profile.py --module api.worker
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+# 启动路径上不应导入（由 api.startup 的预热或首次使用时加载）
+DEFAULT_FORBID = ["PIL", "google.genai"]
+
+
+def profile(module: str, runs: int) -> List[Dict[str, Any]]:
+    """每次在新的解释器中导入；取各模块在多次运行中的最小值，减少磁盘缓存等噪声。"""
+    best: Dict[str, Dict[str, Any]] = {}
+    for _ in range(max(1, runs)):
+        # 导入 api.* 不应有文件系统副作用；仍指向临时目录，避免剖析时碰到真实存储
+        with tempfile.TemporaryDirectory(prefix="importprof-") as storage:
+            env = {**os.environ, "PYTHONPATH": str(ROOT), "STORAGE_DIR": storage}
+            proc = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                cwd=str(ROOT), env=env, capture_output=True, text=True,
+            )
+        if proc.returncode != 0:
+            raise SystemExit(f"import {module} failed:\n{proc.stderr[-2000:]}")
+        for line in proc.stderr.splitlines():
+            m = LINE.match(line)
+            if not m:
+                continue
+            self_us, cum_us, name = int(m.group(1)), int(m.group(2)), m.group(4)
+            entry = {"module": name, "self_ms": self_us / 1000, "cumulative_ms": cum_us / 1000}
+            if name not in best or entry["cumulative_ms"] < best[name]["cumulative_ms"]:
+                best[name] = entry
+    return list(best.values())
+
+
+def report(entries: List[Dict[str, Any]], module: str, top: int, forbid: List[str]) -> Dict[str, Any]:
+    total = max((e["cumulative_ms"] for e in entries if e["module"] == module), default=0.0)
+    packages: Dict[str, float] = {}
+    for e in entries:
+        root = e["module"].split(".")[0]
+        packages[root] = packages.get(root, 0.0) + e["self_ms"]
+    forbidden = sorted(
+        e["module"] for e in entries
+        if any(e["module"] == f or e["module"].startswith(f + ".") for f in forbid)
+    )
+    return {
+        "module": module,
+        "total_ms": round(total, 1),
+        "modules": len(entries),
+        "packages": {k: round(v, 1) for k, v in sorted(packages.items(), key=lambda kv: -kv[1])[:top]},
+        "top_self": [
+            {"module": e["module"], "self_ms": round(e["self_ms"], 1)}
+            for e in sorted(entries, key=lambda e: -e["self_ms"])[:top]
+        ],
+        "forbidden_imports": forbidden,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="Profile import time of the API on a cold interpreter")
+    p.add_argument("--module", default="api.app")
+    p.add_argument("--runs", type=int, default=3, help="fresh interpreters; the minimum per module is kept")
+    p.add_argument("--top", type=int, default=15)
+    p.add_argument("--forbid", default=",".join(DEFAULT_FORBID),
+                   help="comma-separated modules that must not be imported at startup ('' to disable)")
+    p.add_argument("--budget-ms", type=float, default=0, help="exit 1 when the total import time exceeds this")
+    p.add_argument("--json", help="write the report to this file")
+    args = p.parse_args(argv)
+
+    forbid = [f.strip() for f in args.forbid.split(",") if f.strip()]
+    result = report(profile(args.module, args.runs), args.module, args.top, forbid)
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    print(text)
+    if args.json:
+        Path(args.json).write_text(text, encoding="utf-8")
+
+    failed = False
+    if result["forbidden_imports"]:
+        print(f"FAIL: heavy modules imported at startup: {', '.join(result['forbidden_imports'][:10])}", file=sys.stderr)
+        failed = True
+    if args.budget_ms and result["total_ms"] > args.budget_ms:
+        print(f"FAIL: import of {args.module} took {result['total_ms']}ms > budget {args.budget_ms}ms", file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,422 @@
+"""
+端到端压测：按目标速率向 POST /api/jobs 提交各类任务（含 hairstyle_grid），等待完成，输出机器可读的报告。
+- 任务延迟：提交 -> finished/failed（SSE 推送，失败时轮询），按类型给出 p50/p90/p99
+- 阶段耗时：压测前后各抓取一次 /metrics 的 imagen_stage_seconds 直方图，按差值估算各阶段分位数
+- 进程资源：压测期间定时采样 imagen_process_rss_bytes / imagen_process_threads 的峰值
+  （持久队列模式下用多个 --metrics-url 同时采样 worker 进程，见 python -m api.worker --metrics-port）
+- 与基线比较：--baseline 给出上次的报告，吞吐下降或延迟 / 内存上升超过 --tolerance 时退出码为 1
+上游请用 scripts/stub_provider.py 代替，避免真实调用费用。
+用法：
+  python scripts/stub_provider.py --latency-median 1.5 &
+  PROVIDER=proxy PROXY_BASE_URL=http://127.0.0.1:18777 PROXY_API_KEY=stub python -m uvicorn api.app:app --port 8000 &
+  python scripts/load_bench.py --rate 2 --duration 60 --out bench.json
+  python scripts/load_bench.py --rate 2 --duration 60 --baseline bench.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+JOB_TYPES = ["enhance", "figurine", "era_style", "old_photo_restore", "id_photo", "hairstyle_grid"]
+JOB_PARAMS: Dict[str, Dict[str, Any]] = {
+    "era_style": {"era": "80", "gender": "女性", "hair": "大波浪卷发", "face": "复古妆容", "backdrop": "老街"},
+}
+TERMINAL = ("finished", "failed")
+SAMPLE = re.compile(r'^([a-zA-Z_:][\w:]*)(?:\{(.*)\})?\s+(\S+)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+# 与基线比较的指标：(报告中的路径, 越大越好)
+COMPARED = [
+    ("summary.jobs_per_s", True),
+    ("summary.latency.p50", False),
+    ("summary.latency.p99", False),
+    ("process.peak_rss_bytes", False),
+]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * q
+    lo, hi = math.floor(k), math.ceil(k)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def latency_summary(values: List[float]) -> Dict[str, Optional[float]]:
+    def r(v: Optional[float]) -> Optional[float]:
+        return None if v is None else round(v, 3)
+
+    return {
+        "count": len(values),
+        "mean": r(sum(values) / len(values)) if values else None,
+        "p50": r(percentile(values, 0.5)),
+        "p90": r(percentile(values, 0.9)),
+        "p99": r(percentile(values, 0.99)),
+        "max": r(max(values)) if values else None,
+    }
+
+
+# ---- Prometheus 文本解析 ----
+def parse_metrics(text: str) -> Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float]:
+    out = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        m = SAMPLE.match(line)
+        if not m:
+            continue
+        labels = tuple(sorted(LABEL.findall(m.group(2) or "")))
+        try:
+            out[(m.group(1), labels)] = float(m.group(3))
+        except ValueError:
+            continue
+    return out
+
+
+def stage_histograms(samples: Dict) -> Dict[str, Dict[str, Any]]:
+    """按 stage 汇总 imagen_stage_seconds（合并 job_type / provider 标签）：{stage: {buckets: {le: n}, sum, count}}"""
+    stages: Dict[str, Dict[str, Any]] = defaultdict(lambda: {"buckets": defaultdict(float), "sum": 0.0, "count": 0.0})
+    for (name, labels), value in samples.items():
+        if not name.startswith("imagen_stage_seconds"):
+            continue
+        d = dict(labels)
+        stage = stages[d.get("stage", "")]
+        if name.endswith("_bucket"):
+            stage["buckets"][float(d["le"].replace("+Inf", "inf"))] += value
+        elif name.endswith("_sum"):
+            stage["sum"] += value
+        elif name.endswith("_count"):
+            stage["count"] += value
+    return stages
+
+
+def merge_histograms(scrapes: List[Dict[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    merged: Dict[str, Dict[str, Any]] = defaultdict(lambda: {"buckets": defaultdict(float), "sum": 0.0, "count": 0.0})
+    for scrape in scrapes:
+        for stage, h in scrape.items():
+            m = merged[stage]
+            for le, n in h["buckets"].items():
+                m["buckets"][le] += n
+            m["sum"] += h["sum"]
+            m["count"] += h["count"]
+    return merged
+
+
+def histogram_quantile(q: float, buckets: Dict[float, float]) -> Optional[float]:
+    """与 Prometheus histogram_quantile 相同的桶内线性插值。"""
+    bounds = sorted(buckets)
+    if not bounds or buckets[bounds[-1]] <= 0:
+        return None
+    rank = q * buckets[bounds[-1]]
+    prev_bound, prev_count = 0.0, 0.0
+    for bound in bounds:
+        count = buckets[bound]
+        if count >= rank:
+            if math.isinf(bound):
+                return prev_bound
+            if count == prev_count:
+                return bound
+            return prev_bound + (bound - prev_bound) * (rank - prev_count) / (count - prev_count)
+        prev_bound, prev_count = bound, count
+    return prev_bound
+
+
+def stage_report(before: Dict[str, Dict[str, Any]], after: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    out = {}
+    for stage, h in sorted(after.items()):
+        b = before.get(stage, {"buckets": {}, "sum": 0.0, "count": 0.0})
+        count = h["count"] - b["count"]
+        if count <= 0:
+            continue
+        buckets = {le: n - b["buckets"].get(le, 0.0) for le, n in h["buckets"].items()}
+        q = {name: histogram_quantile(v, buckets) for name, v in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))}
+        out[stage] = {
+            "count": int(count),
+            "mean": round((h["sum"] - b["sum"]) / count, 4),
+            **{k: None if v is None else round(v, 4) for k, v in q.items()},
+        }
+    return out
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.mix = self._parse_mix(args.mix)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.outcomes: Dict[str, int] = defaultdict(int)
+        self.errors: List[str] = []
+        self.peak_rss: Dict[str, float] = defaultdict(float)
+        self.peak_threads: Dict[str, float] = defaultdict(float)
+        self.peak_rss_total = 0.0
+        self._base_image = self._make_image()
+
+    @staticmethod
+    def _parse_mix(spec: str) -> List[Tuple[str, float]]:
+        if not spec:
+            return [(t, 1.0) for t in JOB_TYPES]
+        mix = []
+        for item in spec.split(","):
+            name, _, weight = item.partition("=")
+            mix.append((name.strip(), float(weight or 1)))
+        return mix
+
+    def _make_image(self):
+        from PIL import Image, ImageDraw
+
+        side = self.args.image_px
+        img = Image.new("RGB", (side, side), (235, 240, 250))
+        draw = ImageDraw.Draw(img)
+        for _ in range(40):
+            x, y = self.rnd.randrange(side), self.rnd.randrange(side)
+            r = self.rnd.randrange(8, side // 4)
+            draw.ellipse([x - r, y - r, x + r, y + r], fill=tuple(self.rnd.randrange(256) for _ in range(3)))
+        return img
+
+    def image_bytes(self, seq: int) -> bytes:
+        """默认每个任务一张不同的图（改一个像素），避免结果缓存让压测失真；--repeat-inputs 时复用。"""
+        img = self._base_image
+        if not self.args.repeat_inputs:
+            img = img.copy()
+            img.putpixel((seq % img.width, (seq // img.width) % img.height), (seq % 256, (seq >> 8) % 256, 7))
+        buf = BytesIO()
+        img.save(buf, "JPEG", quality=90)
+        return buf.getvalue()
+
+    def pick_type(self) -> str:
+        total = sum(w for _, w in self.mix)
+        x = self.rnd.uniform(0, total)
+        for name, weight in self.mix:
+            x -= weight
+            if x <= 0:
+                return name
+        return self.mix[-1][0]
+
+    async def scrape(self, client: httpx.AsyncClient) -> List[Dict]:
+        texts = []
+        for url in self.metrics_urls:
+            try:
+                r = await client.get(url)
+                texts.append(parse_metrics(r.text))
+            except httpx.HTTPError as e:
+                self.errors.append(f"scrape {url}: {e}")
+                texts.append({})
+        return texts
+
+    @property
+    def metrics_urls(self) -> List[str]:
+        return self.args.metrics_url or [self.args.base.rstrip("/") + "/metrics"]
+
+    async def sample_process(self, client: httpx.AsyncClient, stop: asyncio.Event) -> None:
+        while not stop.is_set():
+            scrapes = await self.scrape(client)
+            total = 0.0
+            for url, samples in zip(self.metrics_urls, scrapes):
+                rss = samples.get(("imagen_process_rss_bytes", ()), 0.0)
+                threads = samples.get(("imagen_process_threads", ()), 0.0)
+                self.peak_rss[url] = max(self.peak_rss[url], rss)
+                self.peak_threads[url] = max(self.peak_threads[url], threads)
+                total += rss
+            self.peak_rss_total = max(self.peak_rss_total, total)
+            try:
+                await asyncio.wait_for(stop.wait(), self.args.sample_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait_job(self, client: httpx.AsyncClient, job_id: str) -> str:
+        try:
+            async with client.stream("GET", f"/api/jobs/{job_id}/events", timeout=None) as r:
+                r.raise_for_status()
+                async for line in r.aiter_lines():
+                    if line.startswith("data:"):
+                        status = json.loads(line[5:])["status"]
+                        if status in TERMINAL:
+                            return status
+        except (httpx.HTTPError, ValueError):
+            pass
+        while True:  # SSE 不可用时轮询
+            r = await client.get(f"/api/jobs/{job_id}")
+            status = r.json().get("status")
+            if status in TERMINAL:
+                return status
+            await asyncio.sleep(0.5)
+
+    async def one(self, client: httpx.AsyncClient, seq: int) -> None:
+        job_type = self.pick_type()
+        params = dict(JOB_PARAMS.get(job_type, {}))
+        if self.args.size:
+            params["size"] = self.args.size
+        started = time.monotonic()
+        try:
+            r = await client.post(
+                "/api/jobs",
+                data={"type": job_type, "params": json.dumps(params, ensure_ascii=False)},
+                files={"file": (f"bench-{seq}.jpg", self.image_bytes(seq), "image/jpeg")},
+            )
+        except httpx.HTTPError as e:
+            self.outcomes["error"] += 1
+            self.errors.append(f"submit: {e!r}")
+            return
+        if r.status_code == 429:
+            self.outcomes["rejected"] += 1
+            return
+        if r.status_code != 200:
+            self.outcomes["error"] += 1
+            self.errors.append(f"submit {r.status_code}: {r.text[:200]}")
+            return
+        status = await self.wait_job(client, r.json()["job_id"])
+        self.outcomes[status] += 1
+        if status == "finished":
+            self.latencies[job_type].append(time.monotonic() - started)
+
+    async def run(self) -> Dict[str, Any]:
+        a = self.args
+        limits = httpx.Limits(max_connections=a.max_connections, max_keepalive_connections=a.max_connections)
+        async with httpx.AsyncClient(base_url=a.base, timeout=a.timeout, limits=limits, trust_env=False) as client:
+            before = merge_histograms([stage_histograms(s) for s in await self.scrape(client)])
+            stop = asyncio.Event()
+            sampler = asyncio.create_task(self.sample_process(client, stop))
+            tasks: List[asyncio.Task] = []
+            started = time.monotonic()
+            seq = 0
+            next_at = started
+            # 开环负载：按目标速率提交，不等待前一个任务完成（--poisson 时到达间隔服从指数分布）
+            while True:
+                if (a.jobs and seq >= a.jobs) or (not a.jobs and next_at - started >= a.duration):
+                    break
+                await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+                tasks.append(asyncio.create_task(self.one(client, seq)))
+                seq += 1
+                next_at += self.rnd.expovariate(a.rate) if a.poisson else 1.0 / a.rate
+            submit_seconds = time.monotonic() - started
+            done, pending = await asyncio.wait(tasks, timeout=a.drain_timeout) if tasks else (set(), set())
+            for t in pending:
+                t.cancel()
+            self.outcomes["timed_out"] += len(pending)
+            wall = time.monotonic() - started
+            stop.set()
+            await sampler
+            after = merge_histograms([stage_histograms(s) for s in await self.scrape(client)])
+
+        all_latencies = [v for values in self.latencies.values() for v in values]
+        finished = self.outcomes.get("finished", 0)
+        return {
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "git_rev": git_rev(),
+                "args": {k: v for k, v in vars(a).items() if k not in ("out", "baseline")},
+            },
+            "summary": {
+                "submitted": seq,
+                "outcomes": dict(self.outcomes),
+                "submit_seconds": round(submit_seconds, 3),
+                "wall_seconds": round(wall, 3),
+                "jobs_per_s": round(finished / wall, 4) if wall > 0 else 0.0,
+                "latency": latency_summary(all_latencies),
+            },
+            "by_type": {t: latency_summary(v) for t, v in sorted(self.latencies.items())},
+            "stages": stage_report(before, after),
+            "process": {
+                "peak_rss_bytes": self.peak_rss_total,
+                "by_endpoint": {
+                    url: {"peak_rss_bytes": self.peak_rss[url], "peak_threads": self.peak_threads[url]}
+                    for url in self.metrics_urls
+                },
+            },
+            "errors": self.errors[:20],
+        }
+
+
+def git_rev() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def lookup(report: Dict[str, Any], path: str) -> Optional[float]:
+    cur: Any = report
+    for key in path.split("."):
+        if not isinstance(cur, dict) or key not in cur:
+            return None
+        cur = cur[key]
+    return cur if isinstance(cur, (int, float)) else None
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> Tuple[List[Dict[str, Any]], bool]:
+    rows, regressed = [], False
+    for path, higher_is_better in COMPARED:
+        new, old = lookup(report, path), lookup(baseline, path)
+        if new is None or old is None or old == 0:
+            rows.append({"metric": path, "baseline": old, "current": new, "change": None, "regression": False})
+            continue
+        change = (new - old) / old
+        bad = change < -tolerance if higher_is_better else change > tolerance
+        regressed |= bad
+        rows.append({"metric": path, "baseline": old, "current": new, "change": round(change, 4), "regression": bad})
+    return rows, regressed
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="End-to-end load benchmark for the NanoImage API")
+    p.add_argument("--base", default="http://127.0.0.1:8000")
+    p.add_argument("--rate", type=float, default=1.0, help="job submissions per second")
+    p.add_argument("--duration", type=float, default=30.0, help="seconds of submissions (ignored with --jobs)")
+    p.add_argument("--jobs", type=int, default=0, help="submit exactly this many jobs")
+    p.add_argument("--poisson", action="store_true", help="exponential inter-arrival times instead of a fixed rate")
+    p.add_argument("--mix", default="", help="job type weights, e.g. enhance=3,hairstyle_grid=1 (default: all types)")
+    p.add_argument("--size", default="", help="params.size for every job")
+    p.add_argument("--image-px", type=int, default=768, help="edge of the synthetic input image")
+    p.add_argument("--repeat-inputs", action="store_true", help="reuse one input image (exercises the result cache)")
+    p.add_argument("--metrics-url", action="append", help="metrics endpoint to scrape (repeatable; default <base>/metrics)")
+    p.add_argument("--sample-interval", type=float, default=0.5)
+    p.add_argument("--drain-timeout", type=float, default=600.0, help="max wait for outstanding jobs after submitting")
+    p.add_argument("--timeout", type=float, default=60.0)
+    p.add_argument("--max-connections", type=int, default=200)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", help="write the JSON report here (default: stdout)")
+    p.add_argument("--baseline", help="compare against a previous report; exit 1 on regression")
+    p.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression vs baseline")
+    args = p.parse_args()
+    if args.rate <= 0:
+        p.error("--rate must be positive")
+
+    report = asyncio.run(Bench(args).run())
+    regressed = False
+    if args.baseline:
+        rows, regressed = compare(report, json.loads(Path(args.baseline).read_text(encoding="utf-8")), args.tolerance)
+        report["baseline"] = {"path": args.baseline, "tolerance": args.tolerance, "comparison": rows, "regressed": regressed}
+        for row in rows:
+            change = "n/a" if row["change"] is None else f"{row['change'] * 100:+.1f}%"
+            flag = "  REGRESSION" if row["regression"] else ""
+            print(f"{row['metric']:<28} {row['baseline']!s:>14} -> {row['current']!s:<14} {change}{flag}", file=sys.stderr)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).write_text(text, encoding="utf-8")
+        s = report["summary"]
+        print(
+            f"{s['submitted']} submitted, {s['outcomes']}, {s['jobs_per_s']} jobs/s, "
+            f"p50={s['latency']['p50']}s p99={s['latency']['p99']}s -> {args.out}",
+            file=sys.stderr,
+        )
+    else:
+        print(text)
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
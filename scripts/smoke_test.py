@@ -26,13 +26,31 @@ with httpx.Client(trust_env=False) as client:
     job_id = r.json()["job_id"]
     print("job_id:", job_id)
 
-    for _ in range(60):
+    # 优先订阅 SSE 推送；失败时回退为每秒轮询
+    final = None
+    try:
+        with client.stream("GET", f"{BASE}/api/jobs/{job_id}/events", timeout=None) as es:
+            print("GET /api/jobs/{job_id}/events ->", es.status_code)
+            es.raise_for_status()
+            for line in es.iter_lines():
+                if not line.startswith("data: "):
+                    continue
+                s = json.loads(line[len("data: "):])
+                print("status:", s["status"], "progress:", s.get("progress"))
+                if s["status"] in ("finished", "failed"):
+                    final = s
+                    break
+    except httpx.HTTPError as e:
+        print("SSE unavailable, falling back to polling:", e)
+
+    for _ in range(0 if final else 60):
         s_resp = client.get(f"{BASE}/api/jobs/{job_id}")
         print("GET /api/jobs/{job_id} ->", s_resp.status_code)
         s = s_resp.json()
         print("status:", s["status"], "progress:", s.get("progress"))
         if s["status"] in ("finished", "failed"):
-            print("final:", s)
+            final = s
             break
         time.sleep(1)
+    print("final:", final)
 
@@ -0,0 +1,237 @@
+"""
+本地 OpenAI 兼容的上游替身（/v1/chat/completions），用于压测与回归，不产生真实调用费用：
+- 合成模式：按对数正态分布模拟延迟，按比例返回错误（429 带 Retry-After），返回指定大小的真实 PNG
+- 录制模式：转发到真实上游，把每次的响应与延迟存成 cassette（按 模型 + 提示词 + 输入图摘要 作 key）
+- 回放模式：按 key 返回录制的响应；未命中时退回合成响应（--replay-miss error 则返回 404）
+- 请求体 "stream": true 时以 SSE 分块返回 content 增量（--stream-delay 控制分块间隔，模拟逐步生成）
+用法：
+  python scripts/stub_provider.py --port 18777 --latency-median 2 --latency-sigma 0.4 --error-rate 0.02 --payload-kb 600
+  python scripts/stub_provider.py --record cassettes/ --upstream https://api.laozhang.ai
+  python scripts/stub_provider.py --replay cassettes/
+然后以 PROVIDER=proxy PROXY_BASE_URL=http://127.0.0.1:18777 PROXY_API_KEY=stub 启动 API。
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import random
+import re
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+DATA_URL = re.compile(r"^data:([\w/+.-]+);base64,(.*)$", re.S)
+STREAM_PIECE = 16 * 1024
+
+
+def synthetic_png(kb: int, seed: int = 0) -> bytes:
+    """噪声 PNG 几乎不可压缩，边长按 3 字节/像素估算，文件大小接近 kb。"""
+    from PIL import Image
+
+    side = max(8, int(math.sqrt(kb * 1024 / 3)))
+    rnd = random.Random(seed)
+    img = Image.frombytes("RGB", (side, side), rnd.randbytes(side * side * 3))
+    buf = BytesIO()
+    img.save(buf, "PNG", compress_level=1)
+    return buf.getvalue()
+
+
+def cassette_key(payload: Dict[str, Any]) -> str:
+    """模型 + 文本部分 + 输入图内容摘要；同一任务重复提交命中同一条录制。"""
+    h = hashlib.sha256(str(payload.get("model", "")).encode())
+    for message in payload.get("messages") or []:
+        content = message.get("content")
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        for part in parts:
+            if part.get("type") == "text":
+                h.update(b"t:" + str(part.get("text", "")).encode())
+            elif part.get("type") == "image_url":
+                m = DATA_URL.match((part.get("image_url") or {}).get("url", ""))
+                data = base64.b64decode(m.group(2)) if m else b""
+                h.update(b"i:" + hashlib.sha256(data).digest())
+    return h.hexdigest()[:32]
+
+
+def completion(content: str, model: str) -> Dict[str, Any]:
+    return {
+        "id": f"chatcmpl-stub-{random.getrandbits(48):x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+    }
+
+
+async def sse_chunks(content: str, model: str, delay: float = 0.0) -> AsyncIterator[bytes]:
+    """content 按 STREAM_PIECE 切成 delta 事件；delay 为相邻事件的间隔，模拟逐步生成。"""
+    for i in range(0, len(content), STREAM_PIECE):
+        if i and delay > 0:
+            await asyncio.sleep(delay)
+        delta = {"choices": [{"index": 0, "delta": {"content": content[i: i + STREAM_PIECE]}}], "model": model}
+        yield f"data: {json.dumps(delta)}\n\n".encode()
+    yield b'data: {"choices":[{"index":0,"delta":{},"finish_reason":"stop"}]}\n\n'
+    yield b"data: [DONE]\n\n"
+
+
+def content_from_completion(body: bytes) -> Optional[str]:
+    try:
+        return json.loads(body)["choices"][0]["message"]["content"]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+class Stub:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.images = [synthetic_png(args.payload_kb, seed=i) for i in range(max(1, args.variety))]
+        self.cassettes = Path(args.record or args.replay) if (args.record or args.replay) else None
+        if self.cassettes is not None:
+            self.cassettes.mkdir(parents=True, exist_ok=True)
+        self.counts: Dict[str, int] = {"requests": 0, "errors": 0, "replayed": 0, "recorded": 0, "misses": 0}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def latency(self) -> float:
+        a = self.args
+        if a.latency_median <= 0:
+            return 0.0
+        value = a.latency_median * math.exp(self.rnd.gauss(0, a.latency_sigma)) if a.latency_sigma > 0 else a.latency_median
+        return min(value, a.latency_max)
+
+    def synthetic_content(self) -> str:
+        imgs = [self.rnd.choice(self.images) for _ in range(self.args.images_per_response)]
+        return " ".join(f"![image](data:image/png;base64,{base64.b64encode(img).decode()})" for img in imgs)
+
+    def respond(self, content: str, model: str, stream: bool) -> Response:
+        if stream:
+            return StreamingResponse(
+                sse_chunks(content, model, self.args.stream_delay), media_type="text/event-stream"
+            )
+        return JSONResponse(completion(content, model))
+
+    async def record(self, request: Request, raw: bytes, key: str, stream: bool) -> Response:
+        started = time.monotonic()
+        payload = json.loads(raw)
+        payload["stream"] = False  # 录制完整响应；回放时按请求决定是否分块
+        headers = {"Authorization": request.headers.get("authorization", ""), "Content-Type": "application/json"}
+        async with httpx.AsyncClient(timeout=self.args.upstream_timeout, trust_env=False) as client:
+            resp = await client.post(
+                f"{self.args.upstream.rstrip('/')}/v1/chat/completions", content=json.dumps(payload), headers=headers
+            )
+        cassette = {
+            "status": resp.status_code,
+            "latency": round(time.monotonic() - started, 3),
+            "retry_after": resp.headers.get("retry-after"),
+            "body": resp.text,
+        }
+        (self.cassettes / f"{key}.json").write_text(json.dumps(cassette), encoding="utf-8")
+        self.counts["recorded"] += 1
+        content = content_from_completion(resp.content) if resp.status_code == 200 else None
+        if content is None:
+            return Response(resp.content, status_code=resp.status_code, media_type="application/json")
+        return self.respond(content, payload.get("model", ""), stream)
+
+    async def replay(self, key: str, model: str, stream: bool) -> Optional[Response]:
+        path = self.cassettes / f"{key}.json"
+        if not path.exists():
+            self.counts["misses"] += 1
+            return None
+        cassette = json.loads(path.read_text(encoding="utf-8"))
+        self.counts["replayed"] += 1
+        # --latency-median > 0 时以合成延迟代替录制的延迟
+        await asyncio.sleep(self.latency() if self.args.latency_median > 0 else cassette.get("latency", 0))
+        content = content_from_completion(cassette["body"].encode()) if cassette["status"] == 200 else None
+        if content is None:
+            headers = {"Retry-After": cassette["retry_after"]} if cassette.get("retry_after") else None
+            return Response(cassette["body"], status_code=cassette["status"], headers=headers, media_type="application/json")
+        return self.respond(content, model, stream)
+
+    async def handle(self, request: Request) -> Response:
+        raw = await request.body()
+        self.counts["requests"] += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            try:
+                payload = json.loads(raw)
+            except ValueError:
+                return JSONResponse({"error": {"message": "invalid JSON"}}, status_code=400)
+            model = str(payload.get("model", ""))
+            stream = bool(payload.get("stream"))
+            if self.args.record:
+                return await self.record(request, raw, cassette_key(payload), stream)
+            if self.args.replay:
+                replayed = await self.replay(cassette_key(payload), model, stream)
+                if replayed is not None:
+                    return replayed
+                if self.args.replay_miss == "error":
+                    return JSONResponse({"error": {"message": "no cassette for request"}}, status_code=404)
+
+            await asyncio.sleep(self.latency())
+            if self.rnd.random() < self.args.error_rate:
+                self.counts["errors"] += 1
+                status = self.rnd.choice(self.args.error_status)
+                headers = {"Retry-After": "1"} if status == 429 else None
+                return JSONResponse({"error": {"message": f"stub error {status}"}}, status_code=status, headers=headers)
+            return self.respond(self.synthetic_content(), model, stream)
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counts, "in_flight": self.in_flight, "max_in_flight": self.max_in_flight,
+                "payload_bytes": [len(i) for i in self.images]}
+
+
+def build_app(args: argparse.Namespace) -> FastAPI:
+    stub = Stub(args)
+    app = FastAPI(title="NanoImage stub provider")
+    app.add_api_route("/v1/chat/completions", stub.handle, methods=["POST"])
+    # API 启动预热（WARMUP_PROXY_PATH）用它预建连接
+    app.add_api_route("/v1/models", lambda: {"object": "list", "data": []}, methods=["GET"])
+    app.add_api_route("/stats", stub.stats, methods=["GET"])
+    app.state.stub = stub
+    return app
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="OpenAI-compatible stub provider for load tests")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=18777)
+    p.add_argument("--latency-median", type=float, default=1.0, help="seconds; lognormal median (0 = no delay)")
+    p.add_argument("--latency-sigma", type=float, default=0.3, help="lognormal sigma (0 = fixed latency)")
+    p.add_argument("--latency-max", type=float, default=60.0, help="cap on a single simulated latency")
+    p.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with an error")
+    p.add_argument("--error-status", type=lambda s: [int(x) for x in s.split(",")], default=[503, 429])
+    p.add_argument("--payload-kb", type=int, default=512, help="approximate size of each returned PNG")
+    p.add_argument("--images-per-response", type=int, default=1)
+    p.add_argument("--variety", type=int, default=4, help="distinct synthetic images to rotate through")
+    p.add_argument("--stream-delay", type=float, default=0.0, help="seconds between SSE chunks of a streamed response")
+    p.add_argument("--seed", type=int, default=None)
+    mode = p.add_mutually_exclusive_group()
+    mode.add_argument("--record", metavar="DIR", help="forward to --upstream and store cassettes in DIR")
+    mode.add_argument("--replay", metavar="DIR", help="answer from cassettes in DIR")
+    p.add_argument("--upstream", default="https://api.laozhang.ai", help="real provider base URL for --record")
+    p.add_argument("--upstream-timeout", type=float, default=180.0)
+    p.add_argument("--replay-miss", choices=("synthetic", "error"), default="synthetic")
+    return p.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    app = build_app(args)
+    print(f"stub provider on http://{args.host}:{args.port}  (GET /stats for counters)", file=sys.stderr)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+测试公共设施：
+- 导入 api.* 之前把 STORAGE_DIR 指向临时目录，关闭启动预热与后处理进程池
+- stub_provider：在后台线程中运行 scripts/stub_provider.py 的上游替身（真实的本地 HTTP 服务）
+- run：在新的事件循环中执行协程，结束前关闭共享的 httpx 客户端（它绑定在创建时的事件循环上）
+"""
+from __future__ import annotations
+import asyncio
+import io
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "scripts"))
+
+os.environ["STORAGE_DIR"] = tempfile.mkdtemp(prefix="imagen-tests-")
+os.environ.setdefault("STARTUP_WARMUP", "false")
+os.environ.setdefault("POSTPROCESS_ENABLED", "false")
+os.environ.setdefault("PROVIDER", "proxy")
+os.environ.setdefault("PROXY_API_KEY", "stub")
+
+import uvicorn  # noqa: E402
+
+import stub_provider as stub_script  # noqa: E402
+from api.services.http_client import shared_http  # noqa: E402
+from api.services.proxy_adapter import ProxyAdapter  # noqa: E402
+from api.services.resilience import CircuitBreaker, Resilience, RetryPolicy, TokenBucket  # noqa: E402
+from api.services.router import Backend  # noqa: E402
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class StubServer:
+    """一个运行中的上游替身：base_url 供适配器使用，stats() 读取它的请求数 / 最大并发等计数。"""
+
+    def __init__(self, argv: List[str]):
+        self.port = _free_port()
+        self.app = stub_script.build_app(stub_script.parse_args(["--port", str(self.port), *argv]))
+        self.server = uvicorn.Server(uvicorn.Config(self.app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def stats(self) -> Dict[str, Any]:
+        return self.app.state.stub.stats()
+
+    def start(self) -> "StubServer":
+        self.thread.start()
+        deadline = time.monotonic() + 10
+        while not self.server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("stub provider did not start")
+            time.sleep(0.02)
+        return self
+
+    def stop(self) -> None:
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+@pytest.fixture
+def stub_provider() -> Iterator[Callable[..., StubServer]]:
+    """工厂：stub_provider("--latency-median", "0.2", ...) 启动一个替身，测试结束后停止。"""
+    servers: List[StubServer] = []
+
+    def start(*argv: str) -> StubServer:
+        server = StubServer(["--latency-sigma", "0", "--payload-kb", "4", "--variety", "1", *argv]).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def run() -> Callable[[Awaitable[Any]], Any]:
+    def _run(coro: Awaitable[Any]) -> Any:
+        async def main() -> Any:
+            try:
+                return await coro
+            finally:
+                await shared_http.aclose()
+
+        return asyncio.run(main())
+
+    return _run
+
+
+def make_backend(
+    name: str,
+    base_url: str,
+    stream: bool = False,
+    max_attempts: int = 1,
+    failure_threshold: int = 5,
+    model: str = "stub-model",
+) -> Backend:
+    """指向替身的代理后端；默认不重试，便于断言调用次数。"""
+    return Backend(
+        name=name,
+        kind="proxy",
+        model=model,
+        adapter=ProxyAdapter(api_key="stub", base_url=base_url, model=model, stream=stream),
+        resilience=Resilience(
+            name,
+            retry=RetryPolicy(max_attempts=max_attempts, base_delay=0.01),
+            bucket=TokenBucket(rate=0),
+            breaker=CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=60),
+            max_in_flight=64,
+        ),
+        stream=stream,
+    )
+
+
+def wait_jobs(client: Any, job_ids: List[str], timeout: float = 30.0) -> List[Dict[str, Any]]:
+    """轮询 GET /api/jobs/{id}（TestClient），直到全部结束，返回各任务的状态。"""
+    deadline = time.monotonic() + timeout
+    while True:
+        jobs = [client.get(f"/api/jobs/{j}").json() for j in job_ids]
+        if all(j["status"] in ("finished", "failed") for j in jobs):
+            return jobs
+        assert time.monotonic() < deadline, [j["status"] for j in jobs]
+        time.sleep(0.05)
+
+
+def png_bytes(seed: Optional[int] = None) -> bytes:
+    """一张小 PNG；不同 seed 内容不同（输入摘要不同，不会命中其他测试的结果缓存）。"""
+    from PIL import Image
+
+    rnd = random.Random(seed)
+    img = Image.new("RGB", (32, 32), tuple(rnd.randrange(256) for _ in range(3)))
+    buf = io.BytesIO()
+    img.save(buf, "PNG")
+    return buf.getvalue()
+
+
+@pytest.fixture
+def input_png(tmp_path: Path) -> Path:
+    path = tmp_path / "input.png"
+    path.write_bytes(png_bytes(random.randrange(1 << 30)))
+    return path
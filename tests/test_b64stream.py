@@ -0,0 +1,70 @@
+from __future__ import annotations
+import base64
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from api.services.b64stream import ENCODE_CHUNK, JsonBase64Body, data_url_placeholder
+from api.services.proxy_adapter import _read_limited
+
+IMAGE = os.urandom(2 * ENCODE_CHUNK + 1)  # 三块，最后一块带填充
+
+
+def envelope():
+    return {
+        "model": "m",
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": "把背景换成“星空”"},
+            {"type": "image_url", "image_url": {"url": data_url_placeholder()}},
+        ]}],
+    }
+
+
+def expected() -> bytes:
+    body = envelope()
+    body["messages"][0]["content"][1]["image_url"]["url"] = "data:image/png;base64," + base64.b64encode(IMAGE).decode()
+    return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+
+async def collect(body: JsonBase64Body):
+    return [chunk async for chunk in body]
+
+
+@pytest.mark.parametrize("source", ["bytes", "memoryview", "path"])
+def test_body_matches_the_buffered_json(source, tmp_path: Path, run):
+    if source == "path":
+        src = tmp_path / "in.png"
+        src.write_bytes(IMAGE)
+    else:
+        src = IMAGE if source == "bytes" else memoryview(IMAGE)
+    body = JsonBase64Body(envelope(), "image/png", src)
+    chunks = run(collect(body))
+
+    assert b"".join(chunks) == expected()
+    assert body.content_length == len(expected())
+    # 按块编码：没有哪一块是整张图片的 base64
+    assert max(len(c) for c in chunks) <= 4 * ENCODE_CHUNK // 3
+
+
+def test_envelope_without_placeholder_is_rejected():
+    with pytest.raises(ValueError):
+        JsonBase64Body({"model": "m"}, "image/png", b"x")
+
+
+class _Body:
+    def __init__(self, size: int):
+        self.size = size
+        self.read = 0
+
+    async def aiter_bytes(self):
+        while self.read < self.size:
+            self.read += 1024
+            yield b"e" * 1024
+
+
+def test_error_body_is_read_only_up_to_the_limit(run):
+    resp = _Body(1 << 20)
+    assert run(_read_limited(resp, 800)) == "e" * 800
+    assert resp.read == 1024
@@ -0,0 +1,91 @@
+from __future__ import annotations
+import io
+import json
+import random
+import time
+import zipfile
+from typing import Any, Dict, List
+
+from fastapi.testclient import TestClient
+
+from api.app import app
+from api.job_store import job_store
+from api.services.router import provider_router
+from api.storage import path_from_url
+from conftest import make_backend, png_bytes
+
+
+def _create(client: TestClient, files: List[Any], params: Dict[str, Any]) -> Dict[str, Any]:
+    resp = client.post(
+        "/api/batches",
+        data={"type": "enhance", "params": json.dumps(params)},
+        files=[("files", f) for f in files],
+    )
+    assert resp.status_code == 200, resp.text
+    return resp.json()
+
+
+def _wait_batch(client: TestClient, batch_id: str, timeout: float = 30.0) -> Dict[str, Any]:
+    deadline = time.monotonic() + timeout
+    while True:
+        status = client.get(f"/api/batches/{batch_id}").json()
+        if status["status"] in ("finished", "failed"):
+            return status
+        assert time.monotonic() < deadline, status["counts"]
+        time.sleep(0.05)
+
+
+def test_batch_runs_children_under_its_concurrency_cap(stub_provider, monkeypatch):
+    stub = stub_provider("--latency-median", "0.2")
+    monkeypatch.setattr(provider_router, "backends", [make_backend("stub", stub.base_url)])
+    images = [png_bytes(random.randrange(1 << 30)) for _ in range(3)]
+    files = [(f"photo {i}.png", image, "image/png") for i, image in enumerate(images)]
+    files.append(("notes.txt", b"definitely not an image", "image/png"))
+
+    with TestClient(app) as client:
+        created = _create(client, files, {"concurrency": 1, "seed": 1})
+        assert len(created["job_ids"]) == 3
+        assert created["rejected"] == [
+            {"index": 4, "filename": "notes.txt", "error": "file is not a supported image (png/jpeg/webp/gif/bmp)"}
+        ]
+        status = _wait_batch(client, created["batch_id"])
+
+    # params.concurrency=1：子任务逐个执行
+    assert stub.stats()["max_in_flight"] == 1
+    assert (status["status"], status["progress"], status["total"]) == ("finished", 100, 3)
+    assert status["counts"] == {"finished": 3}
+    assert [j["id"] for j in status["jobs"]] == created["job_ids"]
+    assert [j["filename"] for j in status["jobs"]] == ["photo 0.png", "photo 1.png", "photo 2.png"]
+    assert len(status["rejected"]) == 1
+
+
+def test_batch_status_and_zip(stub_provider, monkeypatch):
+    stub = stub_provider("--latency-median", "0")
+    monkeypatch.setattr(provider_router, "backends", [make_backend("stub", stub.base_url)])
+    files = [(f"p{i}.png", png_bytes(random.randrange(1 << 30)), "image/png") for i in range(3)]
+
+    with TestClient(app) as client:
+        created = _create(client, files, {})
+        batch_id = created["batch_id"]
+        # zip 在子任务完成前就可以开始下载：逐个写出，全部结束后附上 manifest
+        resp = client.get(f"/api/batches/{batch_id}/zip")
+        assert resp.status_code == 200
+        assert resp.headers["content-type"] == "application/zip"
+        status = client.get(f"/api/batches/{batch_id}").json()
+
+        # 子任务记录被保留策略清理后显示为 expired，不影响整体状态
+        job_store.delete(created["job_ids"][1])
+        after = client.get(f"/api/batches/{batch_id}").json()
+        assert client.get("/api/batches/missing").status_code == 404
+
+    archive = zipfile.ZipFile(io.BytesIO(resp.content))
+    manifest = json.loads(archive.read("manifest.json"))
+    assert manifest["complete"] and manifest["missing"] == []
+    assert [e["status"] for e in manifest["jobs"]] == ["finished"] * 3
+    for i, (entry, job) in enumerate(zip(manifest["jobs"], status["jobs"])):
+        assert entry["files"] == [f"{i + 1:04d}_p{i}/1.png"]
+        assert archive.read(entry["files"][0]) == path_from_url(job["results"][0]).read_bytes()
+
+    assert after["status"] == "finished"
+    assert after["counts"] == {"finished": 2, "expired": 1}
+    assert after["jobs"][1]["status"] == "expired"
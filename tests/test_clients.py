@@ -0,0 +1,210 @@
+from __future__ import annotations
+import asyncio
+import random
+import uuid
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+from fastapi.testclient import TestClient
+
+from api.app import app
+from api.clients import ClientLimits, client_gate, limits_for
+from api.config import settings
+from api.queue import RedisJobQueue, SQLiteJobQueue
+from api.services.router import provider_router
+from api.worker_pool import WorkerPool, worker_pool
+from conftest import make_backend, png_bytes, wait_jobs
+
+
+@pytest.fixture
+def api_client(stub_provider, monkeypatch):
+    """开启按客户端限额；返回 (TestClient, 本测试专用的 API key 请求头, 客户端标识)。"""
+    stub = stub_provider("--latency-median", "0")
+    monkeypatch.setattr(provider_router, "backends", [make_backend("stub", stub.base_url)])
+    name = uuid.uuid4().hex[:8]
+    monkeypatch.setattr(settings, "CLIENT_LIMITS_ENABLED", True)
+    monkeypatch.setattr(settings, "CLIENT_API_KEYS", {f"sk-{name}": name})
+    monkeypatch.setattr(settings, "CLIENT_RATE_LIMIT", 0.0)
+    monkeypatch.setattr(settings, "CLIENT_MAX_ACTIVE_JOBS", 0)
+    with TestClient(app) as client:
+        yield client, {settings.CLIENT_KEY_HEADER: f"sk-{name}"}, f"key:{name}"
+
+
+def _submit(client: TestClient, headers: Dict[str, str], body: bytes = b""):
+    return client.post(
+        "/api/jobs",
+        data={"type": "enhance"},
+        files={"file": ("in.png", body or png_bytes(random.randrange(1 << 30)), "image/png")},
+        headers=headers,
+    )
+
+
+def test_rate_limit_returns_429_with_retry_after(api_client, monkeypatch):
+    client, headers, name = api_client
+    monkeypatch.setattr(settings, "CLIENT_RATE_LIMIT", 0.01)
+    monkeypatch.setattr(settings, "CLIENT_RATE_BURST", 2)
+
+    job_ids = [_submit(client, headers).json()["job_id"] for _ in range(2)]
+    resp = _submit(client, headers)
+    assert resp.status_code == 429
+    assert resp.json()["detail"]["reason"] == "rate"
+    assert int(resp.headers["Retry-After"]) >= 1
+    wait_jobs(client, job_ids)
+    usage = client.get("/api/usage", headers=headers).json()
+    assert (usage["client"], usage["usage"]["jobs"], usage["usage"]["rate_limited"]) == (name, 2, 1)
+
+
+def test_rejected_requests_refund_the_token(api_client, monkeypatch):
+    client, headers, name = api_client
+    monkeypatch.setattr(settings, "CLIENT_RATE_LIMIT", 0.01)
+    monkeypatch.setattr(settings, "CLIENT_RATE_BURST", 1)
+
+    # 非图片（415）与队列已满（429）都不消耗令牌，也不计入已接受的任务
+    assert _submit(client, headers, b"not an image at all").status_code == 415
+    monkeypatch.setattr(worker_pool, "queue_limit", 0)
+    resp = _submit(client, headers)
+    assert resp.status_code == 429 and resp.json()["detail"].startswith("Too many queued jobs")
+    monkeypatch.setattr(worker_pool, "queue_limit", settings.JOB_QUEUE_LIMIT)
+
+    resp = _submit(client, headers)
+    assert resp.status_code == 200, resp.text
+    wait_jobs(client, [resp.json()["job_id"]])
+    assert client.get("/api/usage", headers=headers).json()["usage"]["jobs"] == 1
+    assert client_gate.totals[(name, "accepted")] == 1
+    assert (name, "rate_limited") not in client_gate.totals
+
+
+def test_max_active_jobs_per_client(api_client, stub_provider, monkeypatch):
+    client, headers, _ = api_client
+    slow = stub_provider("--latency-median", "0.5")
+    monkeypatch.setattr(provider_router, "backends", [make_backend("slow", slow.base_url)])
+    monkeypatch.setattr(settings, "CLIENT_MAX_ACTIVE_JOBS", 2)
+
+    job_ids = [_submit(client, headers).json()["job_id"] for _ in range(2)]
+    resp = _submit(client, headers)
+    assert resp.status_code == 429
+    assert resp.json()["detail"]["reason"] == "active"
+    assert client.get("/api/usage", headers=headers).json()["active_jobs"] == 2
+    # 其他客户端不受影响
+    other = _submit(client, {})
+    assert other.status_code == 200
+
+    wait_jobs(client, [*job_ids, other.json()["job_id"]])
+    resp = _submit(client, headers)
+    assert resp.status_code == 200, resp.text
+    wait_jobs(client, [resp.json()["job_id"]])
+
+
+def _limits(**by_client: ClientLimits):
+    return lambda client: by_client.get(client or "", limits_for(None))
+
+
+def test_pool_interleaves_clients(run):
+    order: List[str] = []
+    release = asyncio.Event()
+
+    async def runner(job_id: str) -> None:
+        if job_id == "blocker":
+            await release.wait()
+        order.append(job_id)
+
+    async def main():
+        pool = WorkerPool(size=1, queue_limit=100)
+        await pool.start(runner)
+        try:
+            pool.submit("blocker", "enhance", client="c")
+            await asyncio.sleep(0.01)
+            # 客户端 a 先提交一大批，b 随后提交两个：b 不必等 a 的任务全部执行完
+            for i in range(4):
+                pool.submit(f"a{i}", "enhance", client="a")
+            for i in range(2):
+                pool.submit(f"b{i}", "enhance", client="b")
+            await asyncio.sleep(0.01)
+            release.set()
+            while len(order) < 7:
+                await asyncio.sleep(0.01)
+        finally:
+            await pool.stop()
+
+    run(main())
+    assert order == ["blocker", "a0", "b0", "a1", "b1", "a2", "a3"]
+
+
+def test_pool_caps_running_jobs_per_client(run):
+    running: Counter = Counter()
+    peak: Counter = Counter()
+
+    async def runner(job_id: str) -> None:
+        client = job_id[0]
+        running[client] += 1
+        peak[client] = max(peak[client], running[client])
+        await asyncio.sleep(0.05)
+        running[client] -= 1
+
+    async def main():
+        capped = ClientLimits(rate=0, burst=1, max_active=0, max_running=1, weight=1.0)
+        pool = WorkerPool(size=4, queue_limit=100, client_limits=_limits(a=capped))
+        await pool.start(runner)
+        try:
+            for i in range(3):
+                pool.submit(f"a{i}", "enhance", client="a")
+                pool.submit(f"b{i}", "enhance", client="b")
+            await asyncio.sleep(0.01)
+            while pool.depth or pool.stats()["running"]:
+                await asyncio.sleep(0.01)
+        finally:
+            await pool.stop()
+
+    run(main())
+    assert peak == {"a": 1, "b": 3}
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def make_queue(request, tmp_path: Path):
+    def make(**limits: ClientLimits):
+        if request.param == "sqlite":
+            return SQLiteJobQueue(tmp_path / "queue.db", client_limits=_limits(**limits))
+        return RedisJobQueue("fakeredis://", f"test:{uuid.uuid4().hex}", client_limits=_limits(**limits))
+
+    return make
+
+
+def _drain(queue) -> List[str]:
+    order = []
+    while True:
+        lease = queue.reserve({}, 60)
+        if lease is None:
+            return order
+        order.append(lease.job_id)
+        queue.ack(lease)
+
+
+def test_durable_queue_interleaves_clients(make_queue):
+    queue = make_queue()
+    for i in range(4):
+        queue.enqueue(f"a{i}", "enhance", 10, client="a")
+    for i in range(2):
+        queue.enqueue(f"b{i}", "enhance", 10, client="b")
+    assert _drain(queue) == ["a0", "b0", "a1", "b1", "a2", "a3"]
+
+
+def test_durable_queue_honours_weights_and_max_running(make_queue):
+    heavy = ClientLimits(rate=0, burst=1, max_active=0, max_running=0, weight=2.0)
+    capped = ClientLimits(rate=0, burst=1, max_active=0, max_running=1, weight=1.0)
+    queue = make_queue(b=heavy, c=capped)
+    for i in range(3):
+        queue.enqueue(f"a{i}", "enhance", 10, client="a")
+    for i in range(4):
+        queue.enqueue(f"b{i}", "enhance", 10, client="b")
+    # 权重 2 的客户端每轮领取两个
+    assert _drain(queue) == ["a0", "b0", "b1", "a1", "b2", "b3", "a2"]
+
+    for i in range(2):
+        queue.enqueue(f"c{i}", "enhance", 10, client="c")
+    first = queue.reserve({}, 60)
+    assert first.job_id == "c0" and first.client == "c"
+    assert queue.reserve({}, 60) is None  # c 已有一个运行中
+    queue.ack(first)
+    assert queue.reserve({}, 60).job_id == "c1"
@@ -0,0 +1,99 @@
+from __future__ import annotations
+import asyncio
+import random
+
+from fastapi.testclient import TestClient
+
+from api.app import app
+from api.job_store import job_store
+from api.services.result_cache import result_cache
+from api.services.router import provider_router
+from conftest import make_backend, png_bytes, wait_jobs
+
+N = 6
+
+
+def test_identical_jobs_share_one_upstream_call(stub_provider, monkeypatch):
+    # 上游足够慢：后提交的任务在第一个调用在途时加入（singleflight），之后的命中结果缓存
+    stub = stub_provider("--latency-median", "0.5")
+    monkeypatch.setattr(provider_router, "backends", [make_backend("stub", stub.base_url)])
+    image = png_bytes(random.randrange(1 << 30))
+    params = '{"size": "1024x1024", "seed": 7}'
+
+    with TestClient(app) as client:
+        entries = result_cache.stats()["entries"]
+        job_ids = []
+        for _ in range(N):
+            resp = client.post(
+                "/api/jobs",
+                data={"type": "enhance", "params": params},
+                files={"file": ("in.png", image, "image/png")},
+            )
+            assert resp.status_code == 200, resp.text
+            job_ids.append(resp.json()["job_id"])
+        jobs = wait_jobs(client, job_ids)
+
+        assert [j["status"] for j in jobs] == ["finished"] * N
+        assert stub.stats()["requests"] == 1
+        assert result_cache.stats()["entries"] == entries + 1
+        digests = {tuple(job_store.get(j)["result_blobs"]) for j in job_ids}
+        assert len(digests) == 1 and len(next(iter(digests))) == 1
+        assert len({j["results"][0] for j in jobs}) == 1
+
+
+def test_followers_survive_leader_cancellation(run):
+    from api.services.singleflight import SingleFlight
+
+    flight = SingleFlight()
+    calls = 0
+
+    async def upstream():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.1)
+        return [b"image"]
+
+    async def main():
+        leader = asyncio.create_task(flight.do("k", upstream))
+        await asyncio.sleep(0.01)
+        followers = [asyncio.create_task(flight.do("k", upstream)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await asyncio.gather(*followers)
+
+    assert run(main()) == [[b"image"]] * 3
+    # 取消后由一个等待者重新执行，其余仍共享它的结果
+    assert calls == 2
+
+
+def test_result_cache_is_keyed_by_the_serving_model(stub_provider, monkeypatch):
+    bad = stub_provider("--latency-median", "0", "--error-rate", "1", "--error-status", "503")
+    good = stub_provider("--latency-median", "0")
+    other = stub_provider("--latency-median", "0")
+    image = png_bytes(random.randrange(1 << 30))
+
+    def submit(client, *backends):
+        monkeypatch.setattr(provider_router, "backends", list(backends))
+        resp = client.post(
+            "/api/jobs",
+            data={"type": "enhance", "params": '{"seed": 7}'},
+            files={"file": ("in.png", image, "image/png")},
+        )
+        assert resp.status_code == 200, resp.text
+        return wait_jobs(client, [resp.json()["job_id"]])[0]
+
+    with TestClient(app) as client:
+        # 首选后端（model-a）失败，由 model-b 返回：结果按 model-b 记录
+        first = submit(
+            client,
+            make_backend("a", bad.base_url, model="model-a"),
+            make_backend("b", good.base_url, model="model-b"),
+        )
+        assert first["status"] == "finished"
+        # 只剩 model-b：命中缓存，不请求上游
+        second = submit(client, make_backend("b", good.base_url, model="model-b"))
+        assert second["results"] == first["results"]
+        assert good.stats()["requests"] == 1
+        # model-a 没有缓存的结果：请求上游
+        assert submit(client, make_backend("a", other.base_url, model="model-a"))["status"] == "finished"
+        assert other.stats()["requests"] == 1
@@ -0,0 +1,88 @@
+from __future__ import annotations
+import asyncio
+import json
+import random
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+from api.app import app
+from api.events import JobEvents, job_events
+from api.services.router import provider_router
+from conftest import make_backend, png_bytes
+
+
+def test_slow_subscriber_keeps_the_latest_snapshots(run):
+    events = JobEvents(queue_size=2)
+
+    async def main():
+        q = events.subscribe("j1")
+        for i in range(5):
+            events.publish("j1", {"progress": i})
+        got = [q.get_nowait()["progress"] for _ in range(q.qsize())]
+        events.unsubscribe("j1", q)
+        return got
+
+    assert run(main()) == [3, 4]
+    assert events.subscribers() == 0
+
+
+def test_publish_from_a_worker_thread(run):
+    events = JobEvents()
+
+    async def main():
+        q = events.subscribe("j1")
+        # 任务记录在线程中更新：快照经 call_soon_threadsafe 交给事件循环
+        thread = threading.Thread(target=events.publish, args=("j1", {"status": "running"}))
+        thread.start()
+        got = await asyncio.wait_for(q.get(), 1)
+        thread.join()
+        events.publish("other", {"status": "running"})  # 无订阅者：直接忽略
+        return got
+
+    assert run(main()) == {"status": "running"}
+
+
+def _submit(client: TestClient) -> str:
+    resp = client.post(
+        "/api/jobs",
+        data={"type": "enhance"},
+        files={"file": ("in.png", png_bytes(random.randrange(1 << 30)), "image/png")},
+    )
+    assert resp.status_code == 200, resp.text
+    return resp.json()["job_id"]
+
+
+def test_sse_streams_until_the_job_finishes(stub_provider, monkeypatch):
+    stub = stub_provider("--latency-median", "0.2")
+    monkeypatch.setattr(provider_router, "backends", [make_backend("stub", stub.base_url)])
+
+    with TestClient(app) as client:
+        assert client.get("/api/jobs/missing/events").status_code == 404
+        job_id = _submit(client)
+        with client.stream("GET", f"/api/jobs/{job_id}/events") as events:
+            assert events.headers["content-type"].startswith("text/event-stream")
+            snapshots = [json.loads(line[5:]) for line in events.iter_lines() if line.startswith("data:")]
+        assert snapshots[-1]["status"] == "finished" and snapshots[-1]["results"]
+        assert [s["progress"] for s in snapshots] == sorted(s["progress"] for s in snapshots)
+        assert job_events.subscribers() == 0
+
+
+def test_websocket_streams_until_the_job_finishes(stub_provider, monkeypatch):
+    stub = stub_provider("--latency-median", "0.2")
+    monkeypatch.setattr(provider_router, "backends", [make_backend("stub", stub.base_url)])
+
+    with TestClient(app) as client:
+        with pytest.raises(WebSocketDisconnect) as missing:
+            with client.websocket_connect("/api/jobs/missing/ws") as ws:
+                ws.receive_json()
+        assert missing.value.code == 4404
+
+        job_id = _submit(client)
+        snapshots = []
+        with client.websocket_connect(f"/api/jobs/{job_id}/ws") as ws:
+            while not snapshots or snapshots[-1].get("status") not in ("finished", "failed"):
+                snapshots.append(ws.receive_json())
+        assert snapshots[-1]["status"] == "finished" and snapshots[-1]["results"]
@@ -0,0 +1,102 @@
+from __future__ import annotations
+import asyncio
+import random
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi.testclient import TestClient
+
+from api.app import app
+from api.config import settings
+from api.job_store import job_store
+from api.services.errors import ProviderError
+from api.services.prompts import HAIRSTYLE_TEMPLATE, HAIRSTYLES
+from api.services.router import Backend, provider_router
+from api.storage import path_from_url
+from conftest import make_backend, png_bytes, wait_jobs
+
+
+class FakeAdapter:
+    """按 (prompt, seed) 返回各不相同的图片；随机延迟，记录最大在途数；prompt 含 fail 关键字的子请求失败。"""
+
+    streams = False
+
+    def __init__(self, fail: str = ""):
+        self.fail = fail
+        self.token = uuid.uuid4().int
+        self.images: Dict[Tuple[str, Optional[int]], bytes] = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def call_edit(self, image_path: Path, prompt: str, seed: Optional[int] = None, **kwargs: Any) -> List[bytes]:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(random.uniform(0.01, 0.1))
+            if self.fail and self.fail in prompt:
+                raise ProviderError("upstream refused")
+            return [self.images.setdefault((prompt, seed), png_bytes(hash((self.token, prompt, seed))))]
+        finally:
+            self.in_flight -= 1
+
+
+def _backend(adapter: FakeAdapter) -> Backend:
+    backend = make_backend("fake", "http://unused")
+    backend._adapter = adapter
+    return backend
+
+
+def _submit(client: TestClient, job_type: str, params: str = "{}") -> str:
+    resp = client.post(
+        "/api/jobs",
+        data={"type": job_type, "params": params},
+        files={"file": ("in.png", png_bytes(random.randrange(1 << 30)), "image/png")},
+    )
+    assert resp.status_code == 200, resp.text
+    return resp.json()["job_id"]
+
+
+def test_grid_keeps_slot_order_and_reports_failed_slots(monkeypatch):
+    failing = HAIRSTYLES[2]
+    adapter = FakeAdapter(fail=failing)
+    monkeypatch.setattr(provider_router, "backends", [_backend(adapter)])
+    monkeypatch.setattr(settings, "IMAGEN_DISABLE_FALLBACK", True)
+
+    with TestClient(app) as client:
+        job_id = _submit(client, "hairstyle_grid")
+        job = wait_jobs(client, [job_id])[0]
+
+    assert job["status"] == "finished"
+    assert job["failed_slots"] == [
+        {"index": 3, "label": failing, "error": "all provider backends failed: fake: upstream refused"}
+    ]
+    # 结果按 HAIRSTYLES 顺序排列（跳过失败的槽位），与完成先后无关
+    by_style = {
+        name: image
+        for (prompt, _), image in adapter.images.items()
+        for name in HAIRSTYLES
+        if prompt.startswith(HAIRSTYLE_TEMPLATE.format(name=name))
+    }
+    expected = [by_style[name] for name in HAIRSTYLES if name != failing]
+    assert [path_from_url(u).read_bytes() for u in job["results"]] == expected
+    # 每个任务同时在途的子请求不超过 FANOUT_CONCURRENCY
+    assert adapter.max_in_flight == settings.FANOUT_CONCURRENCY
+
+
+def test_n_outputs_use_the_same_fan_out(monkeypatch):
+    adapter = FakeAdapter()
+    monkeypatch.setattr(provider_router, "backends", [_backend(adapter)])
+    monkeypatch.setattr(settings, "FANOUT_CONCURRENCY", 2)
+
+    with TestClient(app) as client:
+        job_id = _submit(client, "enhance", '{"n": 4, "seed": 10}')
+        job = wait_jobs(client, [job_id])[0]
+
+    assert job["status"] == "finished" and job["failed_slots"] == []
+    assert adapter.max_in_flight == 2
+    # 指定 seed 时各采样使用 seed, seed+1, ...，结果按采样顺序排列
+    expected = [image for (_, seed), image in sorted(adapter.images.items(), key=lambda item: item[0][1])]
+    assert sorted(seed for _, seed in adapter.images) == [10, 11, 12, 13]
+    assert [path_from_url(u).read_bytes() for u in job["results"]] == expected
+    assert len(set(job_store.get(job_id)["result_blobs"])) == 4
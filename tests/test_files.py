@@ -0,0 +1,101 @@
+from __future__ import annotations
+import random
+import time
+from typing import Iterator, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from fastapi.testclient import TestClient
+
+from api.app import app
+from api.config import settings
+from api.storage import blob_store, blob_url, signed_blob_url
+from conftest import png_bytes
+
+
+@pytest.fixture
+def client() -> Iterator[TestClient]:
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def result() -> Tuple[str, str, bytes]:
+    """一个任务结果 blob：(digest, url, content)。"""
+    data = png_bytes(random.randrange(1 << 30))
+    digest, _ = blob_store.put_bytes(data, "png", public=True)
+    return digest, blob_url(digest, "png"), data
+
+
+def test_blob_is_immutable_with_content_etag(client, result):
+    digest, url, data = result
+    resp = client.get(url)
+    assert resp.status_code == 200 and resp.content == data
+    assert resp.headers["etag"] == f'"{digest}"'
+    assert resp.headers["cache-control"] == f"public, max-age={settings.FILES_CACHE_MAX_AGE}, immutable"
+    assert resp.headers["content-type"] == "image/png"
+
+    for headers in ({"If-None-Match": f'"{digest}"'}, {"If-None-Match": f'W/"{digest}", "other"'},
+                    {"If-Modified-Since": resp.headers["last-modified"]}):
+        cached = client.get(url, headers=headers)
+        assert cached.status_code == 304 and cached.content == b""
+        assert cached.headers["etag"] == f'"{digest}"'
+    assert client.get(url, headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_range_request(client, result):
+    _, url, data = result
+    resp = client.get(url, headers={"Range": "bytes=8-23"})
+    assert resp.status_code == 206
+    assert resp.content == data[8:24]
+    assert resp.headers["content-range"] == f"bytes 8-23/{len(data)}"
+    tail = client.get(url, headers={"Range": "bytes=-4"})
+    assert tail.status_code == 206 and tail.content == data[-4:]
+
+
+def test_only_public_blobs_are_served(client, result):
+    digest, url, _ = result
+    # 上传的输入图同样在 CAS 中，但不对外提供
+    upload, _ = blob_store.put_bytes(png_bytes(random.randrange(1 << 30)), "png")
+    assert client.get(blob_url(upload, "png")).status_code == 404
+    assert client.get(f"/files/blobs/{digest[2:4]}/{digest[:2]}/{digest}.png").status_code == 404
+    assert client.get(f"/files/blobs/{digest[:2]}/{digest[2:4]}/{digest}.PNG").status_code == 404
+    # 存储目录中的数据库、任务记录不对外暴露
+    assert client.get("/files/blobs.db").status_code == 404
+    assert client.get("/files/results/../jobs.db").status_code == 404
+
+
+def test_signed_urls(client, result, monkeypatch):
+    digest, url, data = result
+    monkeypatch.setattr(settings, "FILES_SIGNED_URLS", True)
+    resp = client.get(url, follow_redirects=False)
+    assert resp.status_code == 302
+    location = resp.headers["location"]
+    assert urlsplit(location).path == f"/objects/{digest}.png"
+
+    signed = client.get(location)
+    assert signed.status_code == 200 and signed.content == data
+    assert signed.headers["etag"] == f'"{digest}"'
+
+    query = parse_qs(urlsplit(location).query)
+    expires, sig = query["expires"][0], query["sig"][0]
+    other, _ = blob_store.put_bytes(png_bytes(random.randrange(1 << 30)), "png", public=True)
+    tampered = [
+        f"/objects/{digest}.png?expires={expires}&sig={'0' * len(sig)}",
+        f"/objects/{digest}.png?expires={int(expires) + 3600}&sig={sig}",
+        f"/objects/{other}.png?expires={expires}&sig={sig}",
+        f"/objects/{digest}.png",
+    ]
+    for bad in tampered:
+        assert client.get(bad).status_code == 403, bad
+    # 过期的签名
+    ttl = settings.FILES_SIGNED_URL_TTL
+    assert client.get(signed_blob_url(digest, "png", now=time.time() - 2 * ttl)).status_code == 403
+
+
+def test_sendfile_offload(client, result, monkeypatch):
+    digest, url, _ = result
+    monkeypatch.setattr(settings, "FILES_SENDFILE_HEADER", "X-Accel-Redirect")
+    resp = client.get(url)
+    assert resp.status_code == 200 and resp.content == b""
+    assert resp.headers["x-accel-redirect"] == f"/_storage/blobs/{digest[:2]}/{digest[2:4]}/{digest}.png"
@@ -0,0 +1,58 @@
+from __future__ import annotations
+import asyncio
+
+from api.config import settings
+from api.services.http_client import SharedHttpClient, shared_http
+from api.services.proxy_adapter import ProxyAdapter
+
+N = 20
+
+
+def test_sequential_requests_reuse_one_connection(stub_provider, run):
+    stub = stub_provider("--latency-median", "0")
+    http = SharedHttpClient()
+
+    async def main():
+        try:
+            for _ in range(N):
+                resp = await http.get().get(f"{stub.base_url}/v1/models")
+                assert resp.status_code == 200
+        finally:
+            await http.aclose()
+
+    run(main())
+    assert http.requests == N
+    assert http.new_connections == 1
+
+
+def test_concurrent_requests_stay_within_pool(stub_provider, run):
+    stub = stub_provider("--latency-median", "0")
+    http = SharedHttpClient()
+
+    async def main():
+        client = http.get()
+        try:
+            for _ in range(3):
+                await asyncio.gather(*(client.get(f"{stub.base_url}/v1/models") for _ in range(N)))
+        finally:
+            await http.aclose()
+
+    run(main())
+    assert http.requests == 3 * N
+    assert 1 <= http.new_connections <= min(N, settings.PROXY_MAX_CONNECTIONS)
+
+
+def test_adapter_calls_share_the_process_client(stub_provider, run, input_png):
+    stub = stub_provider("--latency-median", "0")
+    adapter = ProxyAdapter(api_key="stub", base_url=stub.base_url, model="stub-model")
+    before = shared_http.stats()
+
+    async def main():
+        for _ in range(5):
+            assert len(await adapter.call_edit(input_png, "enhance")) == 1
+
+    run(main())
+    after = shared_http.stats()
+    assert after["requests"] - before["requests"] == 5
+    assert after["new_connections"] - before["new_connections"] == 1
+    assert stub.stats()["requests"] == 5
@@ -0,0 +1,111 @@
+from __future__ import annotations
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from api.config import settings
+from api.services import imagen_adapter
+from api.services.imagen_adapter import ImagenAdapter
+
+N = 8
+LATENCY = 0.3
+
+
+def _response() -> SimpleNamespace:
+    part = SimpleNamespace(inline_data=SimpleNamespace(data=b"image"))
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+
+class _Models:
+    """google-genai 的 client.models 替身：每次调用固定耗时 LATENCY，记录最大并发。"""
+
+    def __init__(self):
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def _enter(self) -> None:
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def _exit(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def generate_content(self, model, contents):
+        self._enter()
+        try:
+            time.sleep(LATENCY)
+            return _response()
+        finally:
+            self._exit()
+
+
+class _AioModels(_Models):
+    async def generate_content(self, model, contents):
+        self._enter()
+        try:
+            await asyncio.sleep(LATENCY)
+            return _response()
+        finally:
+            self._exit()
+
+
+def _adapter(client) -> ImagenAdapter:
+    adapter = ImagenAdapter(api_key="stub")
+    adapter._client = client  # 不导入 google-genai
+    return adapter
+
+
+@pytest.fixture
+def fresh_executor(monkeypatch):
+    """每个测试使用新的有界线程池（按当前 GOOGLE_EXECUTOR_WORKERS 创建），结束时关闭。"""
+    monkeypatch.setattr(imagen_adapter, "_executor", None)
+    yield
+    if imagen_adapter._executor is not None:
+        imagen_adapter._executor.shutdown(wait=True)
+
+
+def _gather_calls(run, adapter, input_png):
+    async def main():
+        started = time.monotonic()
+        results = await asyncio.gather(*(adapter.call_edit(input_png, "enhance") for _ in range(N)))
+        return time.monotonic() - started, results
+
+    return run(main())
+
+
+@pytest.mark.parametrize("path", ["aio", "executor"])
+def test_concurrent_calls_overlap(run, input_png, monkeypatch, fresh_executor, path):
+    monkeypatch.setattr(settings, "GOOGLE_EXECUTOR_WORKERS", N)
+    if path == "aio":
+        models = _AioModels()
+        client = SimpleNamespace(aio=SimpleNamespace(models=models))
+    else:
+        models = _Models()
+        client = SimpleNamespace(models=models)  # 没有 client.aio：走线程池
+
+    wall, results = _gather_calls(run, _adapter(client), input_png)
+    assert results == [[b"image"]] * N
+    # 并发执行：总耗时接近单次延迟 L，而不是 N×L
+    assert LATENCY <= wall < 2 * LATENCY, wall
+    assert models.max_in_flight == N
+    assert (imagen_adapter._executor is None) == (path == "aio")
+
+
+def test_executor_is_bounded(run, input_png, monkeypatch, fresh_executor):
+    workers = 2
+    monkeypatch.setattr(settings, "GOOGLE_EXECUTOR_WORKERS", workers)
+    models = _Models()
+
+    wall, results = _gather_calls(run, _adapter(SimpleNamespace(models=models)), input_png)
+    assert results == [[b"image"]] * N
+    # 同时最多 workers 个阻塞调用，其余排队等待线程
+    assert models.max_in_flight == workers
+    assert wall >= (N // workers) * LATENCY * 0.9, wall
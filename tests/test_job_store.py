@@ -0,0 +1,102 @@
+from __future__ import annotations
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from api.job_store import FileJobStore, SQLiteJobStore, import_legacy_jobs, migrate_json_jobs
+
+
+def _job(job_id: str, status: str = "pending", created_at: float = 0.0, **extra):
+    return {"id": job_id, "type": "enhance", "status": status, "progress": 0, "params": {},
+            "results": [], "created_at": created_at or time.time(), **extra}
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def store(request, tmp_path: Path):
+    if request.param == "file":
+        return FileJobStore(tmp_path / "jobs")
+    return SQLiteJobStore(tmp_path / "jobs.db")
+
+
+def test_create_get_update_delete(store):
+    store.create(_job("j1"))
+    assert store.get("j1")["status"] == "pending"
+    updated = store.update("j1", status="running", progress=50)
+    assert (updated["status"], updated["progress"], updated["type"]) == ("running", 50, "enhance")
+    assert store.get("j1") == updated
+    store.delete("j1")
+    with pytest.raises(FileNotFoundError):
+        store.get("j1")
+    with pytest.raises(FileNotFoundError):
+        store.update("j1", status="failed")
+
+
+def test_list_filters_and_orders_by_creation(store):
+    now = time.time()
+    store.create(_job("new", "finished", now))
+    store.create(_job("old", "finished", now - 100))
+    store.create(_job("mid", "failed", now - 50))
+    assert [j["id"] for j in store.list()] == ["old", "mid", "new"]
+    assert [j["id"] for j in store.list("finished")] == ["old", "new"]
+    assert [j["id"] for j in store.list(before=now - 10)] == ["old", "mid"]
+    assert [j["id"] for j in store.list(limit=1)] == ["old"]
+    assert store.count() == 3
+
+
+def test_concurrent_updates_keep_every_field(tmp_path: Path):
+    store = SQLiteJobStore(tmp_path / "jobs.db")
+    store.create(_job("j1"))
+
+    def patch(i: int) -> None:
+        for n in range(20):
+            store.update("j1", **{f"field_{i}": n})
+
+    threads = [threading.Thread(target=patch, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 读-合并-写在事务内完成：并发更新不同字段不会互相覆盖
+    assert {k: v for k, v in store.get("j1").items() if k.startswith("field_")} == {f"field_{i}": 19 for i in range(4)}
+
+
+def test_status_column_follows_updates(tmp_path: Path):
+    store = SQLiteJobStore(tmp_path / "jobs.db")
+    store.create_many([_job("a", client="c1"), _job("b", client="c1"), _job("c", client="c2")])
+    store.update("b", status="finished")
+    assert store.count_active("c1") == 1 and store.count_active("c2") == 1
+    assert [j["id"] for j in store.list("finished")] == ["b"]
+    assert set(store.get_many(["a", "c", "missing"])) == {"a", "c"}
+
+
+def test_client_column_is_backfilled_on_upgrade(tmp_path: Path):
+    db = tmp_path / "jobs.db"
+    old = sqlite3.connect(str(db))
+    old.execute(
+        "CREATE TABLE jobs (id TEXT PRIMARY KEY, type TEXT NOT NULL, status TEXT NOT NULL, "
+        "created_at REAL NOT NULL, updated_at REAL NOT NULL, data TEXT NOT NULL)"
+    )
+    old.execute(
+        "INSERT INTO jobs VALUES ('j1', 'enhance', 'running', 0, 0, '{\"id\": \"j1\", \"client\": \"c1\"}')"
+    )
+    old.commit()
+    old.close()
+    assert SQLiteJobStore(db).count_active("c1") == 1
+
+
+def test_legacy_json_jobs_are_imported_once(tmp_path: Path):
+    legacy = FileJobStore(tmp_path / "jobs")
+    legacy.create(_job("j1", "finished"))
+    legacy.create(_job("j2"))
+    store = SQLiteJobStore(tmp_path / "jobs.db")
+    assert migrate_json_jobs(store, legacy.jobs_dir, dry_run=True) == 2 and store.count() == 0
+
+    assert import_legacy_jobs(store, legacy.jobs_dir) == 2
+    assert store.get("j1")["status"] == "finished"
+    # 已有任务的存储不再自动导入
+    legacy.create(_job("j3"))
+    assert import_legacy_jobs(store, legacy.jobs_dir) == 0
+    assert store.count() == 2
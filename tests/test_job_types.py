@@ -0,0 +1,80 @@
+from __future__ import annotations
+import random
+
+import pytest
+from fastapi.testclient import TestClient
+
+from api.app import app
+from api.services import prompts
+from api.services.errors import InvalidJobRequest
+from api.services.prompts import HAIRSTYLES, NEGATIVE_DEFAULT, JobTypeSpec, get_job_type, validate_job
+from api.services.router import provider_router
+from conftest import make_backend, png_bytes, wait_jobs
+
+
+def test_every_type_validates_with_defaults():
+    for name in prompts.JOB_TYPES:
+        params = validate_job(name, {})
+        assert all(params[p] for p in get_job_type(name).placeholders())
+    assert validate_job("era_style", {"era": "1980"})["era"] == "1980"
+    assert validate_job("era_style", {})["backdrop"] == "北京胡同夏日风景"
+
+
+@pytest.mark.parametrize(
+    "job_type, params, message",
+    [
+        ("nope", {}, "unknown job type"),
+        ("enhance", [], "JSON object"),
+        ("enhance", {"size": "big"}, "params.size"),
+        ("enhance", {"n": "two"}, "params.n"),
+        ("enhance", {"seed": True}, "params.seed"),
+        ("enhance", {"priority": 0}, "between 10 and 20"),
+        ("enhance", {"negatives": ["x"]}, "params.negatives"),
+        ("era_style", {"era": {"year": 1970}}, "params.era"),
+    ],
+)
+def test_invalid_requests_are_rejected(job_type, params, message):
+    with pytest.raises(InvalidJobRequest, match=message):
+        validate_job(job_type, params)
+
+
+def test_params_are_normalised():
+    params = validate_job("enhance", {"n": "9", "seed": "7", "priority": 15, "size": "512x512"})
+    assert (params["n"], params["seed"], params["priority"]) == (4, 7, 15)
+    # fan_out 类型的子请求数固定，params.n 被忽略
+    assert "n" not in validate_job("hairstyle_grid", {"n": 2})
+
+
+def test_variants_expand_in_result_order():
+    enhance = get_job_type("enhance")
+    assert enhance.variants({}, 1, None) == [("enhance", prompts.TEMPLATES["enhance"] + " " + NEGATIVE_DEFAULT, None)]
+    assert [(label, seed) for label, _, seed in enhance.variants({}, 3, 5)] == [
+        ("enhance#1", 5), ("enhance#2", 6), ("enhance#3", 7),
+    ]
+    grid = get_job_type("hairstyle_grid").variants({"negatives": "不要帽子"}, 1, 3)
+    assert [label for label, _, _ in grid] == HAIRSTYLES
+    assert all(prompt.endswith("不要帽子") and seed == 3 for _, prompt, seed in grid)
+
+
+def test_a_registered_type_runs_without_touching_the_pipeline(stub_provider, monkeypatch):
+    stub = stub_provider("--latency-median", "0")
+    monkeypatch.setattr(provider_router, "backends", [make_backend("stub", stub.base_url)])
+    monkeypatch.setitem(
+        prompts.JOB_TYPES, "sketch",
+        JobTypeSpec("sketch", "把照片画成{medium}素描", defaults={"medium": "铅笔"}, preprocess=False),
+    )
+
+    with TestClient(app) as client:
+        image = png_bytes(random.randrange(1 << 30))
+        resp = client.post(
+            "/api/jobs", data={"type": "sketch", "params": '{"n": 2}'}, files={"file": ("in.png", image, "image/png")}
+        )
+        assert resp.status_code == 200, resp.text
+        job = wait_jobs(client, [resp.json()["job_id"]])[0]
+        assert job["status"] == "finished" and len(job["results"]) == 2
+        assert stub.stats()["requests"] == 2
+
+        rejected = client.post(
+            "/api/jobs", data={"type": "unknown"}, files={"file": ("in.png", image, "image/png")}
+        )
+        assert rejected.status_code == 400 and "unknown job type" in rejected.text
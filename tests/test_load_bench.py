@@ -0,0 +1,79 @@
+from __future__ import annotations
+import base64
+import math
+from pathlib import Path
+from typing import Any, Dict
+
+import httpx
+import pytest
+
+import load_bench
+from conftest import png_bytes
+
+
+def _payload(image: bytes, prompt: str = "enhance", stream: bool = False) -> Dict[str, Any]:
+    return {
+        "model": "stub-model",
+        "stream": stream,
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": "data:image/png;base64," + base64.b64encode(image).decode()}},
+        ]}],
+    }
+
+
+def _request(base_url: str, image: bytes, prompt: str = "enhance") -> httpx.Response:
+    return httpx.post(f"{base_url}/v1/chat/completions", json=_payload(image, prompt), timeout=10, trust_env=False)
+
+
+def test_record_then_replay_without_the_upstream(stub_provider, tmp_path: Path):
+    upstream = stub_provider("--latency-median", "0")
+    recorder = stub_provider("--latency-median", "0", "--record", str(tmp_path), "--upstream", upstream.base_url)
+    image = png_bytes(1)
+    recorded = _request(recorder.base_url, image)
+    assert recorded.status_code == 200
+    assert upstream.stats()["requests"] == 1 and len(list(tmp_path.glob("*.json"))) == 1
+
+    # 回放：同一输入图与提示词命中录制，不再访问上游；请求流式时按 SSE 分块返回
+    replayer = stub_provider("--latency-median", "0", "--replay", str(tmp_path), "--replay-miss", "error")
+    content = recorded.json()["choices"][0]["message"]["content"]
+    assert _request(replayer.base_url, image).json()["choices"][0]["message"]["content"] == content
+    url = f"{replayer.base_url}/v1/chat/completions"
+    with httpx.stream("POST", url, json=_payload(image, stream=True), timeout=10, trust_env=False) as streamed:
+        assert streamed.headers["content-type"].startswith("text/event-stream")
+        assert b"data: [DONE]" in streamed.read()
+    assert _request(replayer.base_url, image, prompt="other").status_code == 404
+    assert replayer.stats()["replayed"] == 2 and replayer.stats()["misses"] == 1
+    assert upstream.stats()["requests"] == 1
+
+
+def test_recorded_errors_are_replayed(stub_provider, tmp_path: Path):
+    upstream = stub_provider("--latency-median", "0", "--error-rate", "1", "--error-status", "429")
+    recorder = stub_provider("--latency-median", "0", "--record", str(tmp_path), "--upstream", upstream.base_url)
+    assert _request(recorder.base_url, png_bytes(2)).status_code == 429
+
+    replayer = stub_provider("--latency-median", "0", "--replay", str(tmp_path))
+    resp = _request(replayer.base_url, png_bytes(2))
+    assert resp.status_code == 429 and resp.headers["retry-after"] == "1"
+
+
+def test_histogram_quantile_interpolates_like_prometheus():
+    buckets = {0.1: 10.0, 0.5: 30.0, 1.0: 40.0, math.inf: 40.0}
+    assert load_bench.histogram_quantile(0.5, buckets) == pytest.approx(0.3)
+    assert load_bench.histogram_quantile(1.0, buckets) == 1.0
+    assert load_bench.histogram_quantile(0.5, {math.inf: 0.0}) is None
+    assert load_bench.percentile([4, 1, 3, 2], 0.5) == 2.5
+
+
+def test_compare_flags_regressions_beyond_tolerance():
+    baseline = {"summary": {"jobs_per_s": 10.0, "latency": {"p50": 1.0, "p99": 2.0}}}
+    report = {"summary": {"jobs_per_s": 8.5, "latency": {"p50": 1.05, "p99": 2.5}}}
+    rows, regressed = load_bench.compare(report, baseline, tolerance=0.1)
+    assert regressed
+    assert {r["metric"]: r["regression"] for r in rows} == {
+        "summary.jobs_per_s": True,
+        "summary.latency.p50": False,
+        "summary.latency.p99": True,
+        "process.peak_rss_bytes": False,  # 基线中没有：不比较
+    }
+    assert not load_bench.compare(baseline, baseline, tolerance=0.1)[1]
@@ -0,0 +1,93 @@
+from __future__ import annotations
+import asyncio
+import uuid
+
+from fastapi.testclient import TestClient
+
+from api.app import app
+from api.metrics import CONTENT_TYPE, STAGE_SECONDS, Registry, set_metric_labels, stage_timer
+
+
+def test_text_rendering():
+    registry = Registry()
+    calls = registry.counter("demo_calls_total", "Calls", ("provider", "outcome"))
+    calls.inc(provider="a", outcome="success")
+    calls.inc(2, provider='we"ird\n', outcome="failure")
+    registry.gauge("demo_depth", "Depth", fn=lambda: 3)
+    registry.gauge("demo_by_type", "By type", ("job_type",), fn=lambda: {("enhance",): 1.5})
+    registry.gauge("demo_broken", "Raises", fn=lambda: 1 / 0)
+
+    assert registry.render() == "\n".join([
+        "# HELP demo_calls_total Calls",
+        "# TYPE demo_calls_total counter",
+        'demo_calls_total{provider="a",outcome="success"} 1',
+        'demo_calls_total{provider="we\\"ird\\n",outcome="failure"} 2',
+        "# HELP demo_depth Depth",
+        "# TYPE demo_depth gauge",
+        "demo_depth 3",
+        "# HELP demo_by_type By type",
+        "# TYPE demo_by_type gauge",
+        'demo_by_type{job_type="enhance"} 1.5',
+        # 回调出错的指标整体跳过，不影响其余指标
+    ]) + "\n"
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    hist = registry.histogram("demo_seconds", "Latency", ("stage",), buckets=(1, 0.1))
+    for v in (0.05, 0.1, 0.5, 5):
+        hist.observe(v, stage="call")
+    assert registry.render().splitlines()[2:] == [
+        'demo_seconds_bucket{stage="call",le="0.1"} 2',
+        'demo_seconds_bucket{stage="call",le="1"} 3',
+        'demo_seconds_bucket{stage="call",le="+Inf"} 4',
+        'demo_seconds_sum{stage="call"} 5.65',
+        'demo_seconds_count{stage="call"} 4',
+    ]
+
+
+def _count(stage: str, job_type: str = "", provider: str = "") -> float:
+    series = STAGE_SECONDS._series.get((stage, job_type, provider))
+    return series[-1] if series else 0
+
+
+def test_stage_timer_as_context_manager_and_decorator():
+    stage = f"test_{uuid.uuid4().hex[:8]}"
+
+    @stage_timer(stage, provider="decorated")
+    def sync_fn() -> int:
+        return 1
+
+    @stage_timer(stage, provider="decorated")
+    async def async_fn() -> int:
+        await asyncio.sleep(0.01)
+        return 2
+
+    async def main() -> None:
+        # 缺省标签取 metric_labels 上下文，显式传入的优先
+        set_metric_labels(job_type="enhance", provider="ctx")
+        with stage_timer(stage):
+            pass
+        async with stage_timer(stage):
+            await asyncio.sleep(0.01)
+        assert sync_fn() == 1 and await async_fn() == 2
+        try:
+            with stage_timer(stage, job_type="failing"):
+                raise ValueError
+        except ValueError:
+            pass
+
+    asyncio.run(main())
+    assert _count(stage, "enhance", "ctx") == 2
+    assert _count(stage, "enhance", "decorated") == 2
+    assert _count(stage, "failing", "ctx") == 1  # 异常时同样计时
+    assert STAGE_SECONDS._series[(stage, "enhance", "decorated")][-2] >= 0.01
+
+
+def test_metrics_endpoint():
+    with TestClient(app) as client:
+        resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == CONTENT_TYPE
+    for name in ("imagen_stage_seconds", "imagen_jobs_total", "imagen_ready"):
+        assert f"# TYPE {name} " in resp.text
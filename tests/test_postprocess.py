@@ -0,0 +1,82 @@
+from __future__ import annotations
+import io
+import random
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from api.config import settings
+from api.services.postprocess import Postprocessor
+from api.storage import blob_store, path_from_url
+
+
+def _image(width: int, height: int) -> Path:
+    buf = io.BytesIO()
+    Image.new("RGB", (width, height), tuple(random.randrange(256) for _ in range(3))).save(buf, "PNG")
+    _, path = blob_store.put_bytes(buf.getvalue(), "png")
+    return path
+
+
+def _size(url: str) -> tuple:
+    with Image.open(path_from_url(url)) as img:
+        return img.size
+
+
+@pytest.fixture
+def post(monkeypatch) -> Postprocessor:
+    monkeypatch.setattr(settings, "POSTPROCESS_ENABLED", True)
+    monkeypatch.setattr(settings, "POSTPROCESS_FORMATS", ["webp", "bmp"])
+    monkeypatch.setattr(settings, "POSTPROCESS_THUMB_EDGE", 64)
+    monkeypatch.setattr(settings, "POSTPROCESS_MAX_EDGE", 200)
+    return Postprocessor(workers=0)
+
+
+def test_variants_are_scaled_and_cached(post, run):
+    src = _image(400, 300)
+    described, digests = run(post.variants(src))
+
+    # 不支持的格式被跳过；JPEG 缩略图兜底 + WebP 缩略图与全尺寸版本
+    assert post.formats == ["webp"] and len(digests) == 3
+    assert (described["format"], described["width"], described["height"]) == ("png", 200, 150)
+    assert [(s["type"], s["width"]) for s in described["sources"]] == [("image/webp", 64), ("image/webp", 200)]
+    assert _size(described["thumbnail"]) == (64, 48)
+    assert all(blob_store.is_public(d) for d in digests)
+
+    # 同一张图、同样的设置：命中阶段缓存，不再编码
+    again, again_digests = run(post.variants(src))
+    assert (again, sorted(again_digests)) == (described, sorted(digests))
+    assert (post.processed, post.cache_hits) == (1, 1)
+
+
+def test_small_images_are_not_upscaled(post, run):
+    described, digests = run(post.variants(_image(40, 20)))
+    assert [(s["type"], s["width"]) for s in described["sources"]] == [("image/webp", 40)]
+    assert len(digests) == 2
+
+
+def test_contact_sheet_tiles_the_grid(post, run, monkeypatch):
+    monkeypatch.setattr(settings, "CONTACT_SHEET_TILE", 50)
+    monkeypatch.setattr(settings, "CONTACT_SHEET_GAP", 5)
+    paths = [_image(100, 60) for _ in range(5)]
+    url, digests = run(post.contact_sheet(paths))
+    # 5 张 -> 3 列 2 行
+    assert url.endswith(".webp") and len(digests) == 1
+    assert _size(url) == (3 * 50 + 4 * 5, 2 * 50 + 3 * 5)
+    assert run(post.contact_sheet(paths)) == (url, digests)
+    assert (post.sheets, post.cache_hits) == (1, 1)
+
+
+def test_failures_do_not_fail_the_job(post, run, tmp_path: Path):
+    broken = tmp_path / "broken.png"
+    broken.write_bytes(b"not an image")
+    assert run(post.variants(broken)) == (None, [])
+    assert post.failures == 1
+
+
+def test_disabled_stage_is_skipped(run, monkeypatch):
+    monkeypatch.setattr(settings, "POSTPROCESS_ENABLED", False)
+    post = Postprocessor(workers=0)
+    assert run(post.variants(_image(100, 100))) == (None, [])
+    assert run(post.contact_sheet([_image(100, 100)])) == (None, [])
+    assert post.processed == 0
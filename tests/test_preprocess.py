@@ -0,0 +1,78 @@
+from __future__ import annotations
+import asyncio
+import io
+import logging
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from api.config import settings
+from api.services import preprocess
+from api.services.preprocess import Preprocessor
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """统计实际执行的编码次数。"""
+    counted = {"n": 0}
+    prepare = preprocess._prepare
+
+    def counting(path: Path, edge: int):
+        counted["n"] += 1
+        return prepare(path, edge)
+
+    monkeypatch.setattr(preprocess, "_prepare", counting)
+    return counted
+
+
+def _photo(tmp_path: Path) -> Path:
+    # 横向存储、EXIF 标记需顺时针旋转 90°（Orientation=6）的 JPEG
+    img = Image.new("RGB", (400, 200), (200, 30, 30))
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    path = tmp_path / "photo.jpg"
+    img.save(path, "JPEG", exif=exif.tobytes())
+    return path
+
+
+def test_prepare_transposes_downscales_and_memoizes(tmp_path: Path, calls, run):
+    path = _photo(tmp_path)
+    pre = Preprocessor()
+
+    async def main():
+        # 同一输入、同一目标尺寸的并发调用只编码一次
+        return await asyncio.gather(*(pre.prepare(path, "digest", "100x100") for _ in range(9)))
+
+    results = run(main())
+    prepared = results[0]
+    assert all(r is prepared for r in results)
+    assert (prepared.width, prepared.height, prepared.mime) == (50, 100, "image/jpeg")
+    with Image.open(io.BytesIO(prepared.data)) as img:
+        assert img.format == "JPEG" and not img.getexif()
+    assert calls["n"] == 1 and (pre.hits, pre.misses) == (8, 1)
+    # 不同目标尺寸分别记忆
+    assert run(pre.prepare(path, "digest", "300x300")).height == 300
+    assert calls["n"] == 2
+
+
+def test_failures_are_memoized(tmp_path: Path, calls, run):
+    path = tmp_path / "broken.png"
+    path.write_bytes(b"\x89PNG\r\n\x1a\n" + b"\0" * 64)
+    pre = Preprocessor()
+    for _ in range(3):
+        assert run(pre.prepare(path, "broken", "1024x1024")) is None
+    # 无法解码的图片只尝试一次，之后直接发送原图
+    assert calls["n"] == 1
+    assert pre.stats() == {"hits": 2, "misses": 1, "failures": 1, "memo_items": 1}
+
+
+def test_invalid_format_is_reported_once(tmp_path: Path, calls, run, monkeypatch, caplog):
+    monkeypatch.setattr(settings, "PREPROCESS_FORMAT", "TIFF")
+    path = _photo(tmp_path)
+    pre = Preprocessor()
+    with caplog.at_level(logging.ERROR, logger="imagen.preprocess"):
+        for digest in ("a", "b", "c"):
+            assert run(pre.prepare(path, digest, "1024x1024")) is None
+    assert calls["n"] == 0
+    assert [r.getMessage() for r in caplog.records] == ["[preprocess] unsupported PREPROCESS_FORMAT 'TIFF', sending originals"]
@@ -0,0 +1,24 @@
+from __future__ import annotations
+import asyncio
+import time
+
+from api.services.proxy_adapter import ProxyAdapter
+
+N = 8
+LATENCY = 0.5
+
+
+def test_concurrent_calls_overlap(stub_provider, run, input_png):
+    stub = stub_provider("--latency-median", str(LATENCY))
+    adapter = ProxyAdapter(api_key="stub", base_url=stub.base_url, model="stub-model")
+
+    async def main():
+        started = time.monotonic()
+        results = await asyncio.gather(*(adapter.call_edit(input_png, "enhance") for _ in range(N)))
+        return time.monotonic() - started, results
+
+    wall, results = run(main())
+    assert all(len(imgs) == 1 for imgs in results)
+    # 并发执行：总耗时接近单次延迟 L，而不是 N×L
+    assert LATENCY <= wall < 2 * LATENCY, wall
+    assert stub.stats()["max_in_flight"] == N
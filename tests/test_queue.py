@@ -0,0 +1,231 @@
+from __future__ import annotations
+import asyncio
+import time
+import uuid
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from api import tasks, worker
+from api.job_store import SQLiteJobStore
+from api.queue import RedisJobQueue, SQLiteJobQueue
+from api.worker import RECOVER_GRACE, QueueWorker
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def queue(request, tmp_path: Path):
+    if request.param == "sqlite":
+        return SQLiteJobQueue(tmp_path / "queue.db")
+    return RedisJobQueue("fakeredis://", f"test:{uuid.uuid4().hex}")
+
+
+@pytest.fixture
+def store(tmp_path: Path, monkeypatch) -> SQLiteJobStore:
+    """独立的任务存储：worker 与 mark_failed 都使用它，不受其他测试留下的任务影响。"""
+    store = SQLiteJobStore(tmp_path / "jobs.db")
+    monkeypatch.setattr(worker, "job_store", store)
+    monkeypatch.setattr(tasks, "job_store", store)
+    return store
+
+
+def _job(job_id: str, status: str = "pending", age: float = 0.0) -> dict:
+    return {"id": job_id, "type": "enhance", "status": status, "progress": 0, "params": {},
+            "results": [], "created_at": time.time() - age}
+
+
+def test_reserve_ack_nack(queue):
+    assert queue.enqueue("j1", "enhance", 10)
+    assert not queue.enqueue("j1", "enhance", 10)  # 按 job_id 去重
+    lease = queue.reserve({}, 60)
+    assert (lease.job_id, lease.deliveries) == ("j1", 1)
+    assert queue.state("j1") == "leased" and queue.depth() == 0
+    assert queue.reserve({}, 60) is None
+
+    # nack 放回队列，不计入投递次数
+    queue.nack(lease)
+    assert queue.state("j1") == "ready" and queue.depth() == 1
+    lease = queue.reserve({}, 60)
+    assert lease.deliveries == 1
+    queue.ack(lease)
+    assert queue.state("j1") is None and queue.depth() == 0
+    assert queue.stats()["running"] == 0
+
+
+def test_expired_lease_is_redelivered(queue):
+    queue.enqueue("j1", "enhance", 10)
+    first = queue.reserve({}, 0.05)
+    time.sleep(0.1)
+    assert queue.state("j1") == "ready"
+    second = queue.reserve({}, 60)
+    assert (second.job_id, second.deliveries) == ("j1", 2)
+    assert second.receipt != first.receipt
+    # 旧租约已失效：续约失败，ack / nack 不影响新租约
+    assert not queue.extend(first, 60)
+    queue.ack(first)
+    queue.nack(first)
+    assert queue.state("j1") == "leased"
+    assert queue.extend(second, 60)
+    queue.ack(second)
+    assert queue.state("j1") is None
+
+
+def test_requeue_expired(queue):
+    queue.enqueue("j1", "enhance", 10)
+    queue.reserve({}, 0.01)
+    time.sleep(0.05)
+    assert queue.requeue_expired() == 1
+    assert queue.depth() == 1
+
+
+def test_type_and_group_limits(queue):
+    for i in range(3):
+        queue.enqueue(f"grid{i}", "hairstyle_grid", 10)
+    queue.enqueue("enhance0", "enhance", 20)
+    limits = {"hairstyle_grid": 1}
+    grid = queue.reserve(limits, 60)
+    assert grid.job_id == "grid0"
+    # 类型已满：跳过排在前面的 grid 任务
+    assert queue.reserve(limits, 60).job_id == "enhance0"
+    assert queue.reserve(limits, 60) is None
+    assert queue.stats()["running_by_type"] == {"hairstyle_grid": 1, "enhance": 1}
+    queue.ack(grid)
+    assert queue.reserve(limits, 60).job_id == "grid1"
+
+    queue.set_group_limit("batch", 1)
+    queue.enqueue("b0", "enhance", 0, group="batch")
+    queue.enqueue("b1", "enhance", 0, group="batch")
+    b0 = queue.reserve({}, 60)
+    assert (b0.job_id, b0.group) == ("b0", "batch")
+    assert queue.reserve({}, 60).job_id == "grid2"  # 同组已有一个运行中
+    queue.ack(b0)
+    assert queue.reserve({}, 60).job_id == "b1"
+
+
+def _run_worker(qw: QueueWorker, until, timeout: float = 5.0) -> None:
+    async def main():
+        await qw.start()
+        try:
+            deadline = time.monotonic() + timeout
+            while not until():
+                assert time.monotonic() < deadline
+                await asyncio.sleep(0.02)
+        finally:
+            await qw.stop()
+
+    asyncio.run(main())
+
+
+def test_worker_runs_and_acks(queue, store):
+    done: List[str] = []
+
+    async def runner(job_id: str) -> None:
+        done.append(job_id)
+        store.update(job_id, status="finished")
+
+    for i in range(3):
+        store.create(_job(f"j{i}"))
+        queue.enqueue(f"j{i}", "enhance", 10)
+    qw = QueueWorker(queue, runner, concurrency=2, poll_interval=0.01)
+    _run_worker(qw, lambda: qw.processed == 3)
+    assert sorted(done) == ["j0", "j1", "j2"]
+    assert queue.depth() == 0 and queue.state("j0") is None
+
+
+def test_worker_recover_requeues_lost_jobs(queue, store):
+    old = RECOVER_GRACE + 5
+    store.create(_job("running", "running", age=old))
+    store.create(_job("pending", "pending", age=old))
+    store.create(_job("queued", "pending", age=old))
+    store.create(_job("fresh", "pending"))  # 刚写入、尚未入队：不算丢失
+    store.create(_job("finished", "finished", age=old))
+    queue.enqueue("queued", "enhance", 10)
+
+    qw = QueueWorker(queue, runner=None)
+    assert asyncio.run(qw.recover()) == 2
+    assert {queue.state(j) for j in ("running", "pending", "queued")} == {"ready"}
+    assert queue.state("fresh") is None and queue.state("finished") is None
+    assert store.get("running")["status"] == "pending"
+
+
+def test_worker_fails_job_after_max_deliveries(queue, store):
+    calls: List[str] = []
+
+    async def runner(job_id: str) -> None:
+        calls.append(job_id)
+
+    store.create(_job("j1"))
+    queue.enqueue("j1", "enhance", 10)
+    # 模拟两次崩溃的 worker：领取后租约到期
+    for _ in range(2):
+        queue.reserve({}, 0.01)
+        time.sleep(0.03)
+    qw = QueueWorker(queue, runner, max_deliveries=2, poll_interval=0.01)
+    _run_worker(qw, lambda: store.get("j1")["status"] == "failed" and queue.state("j1") is None)
+    assert calls == []
+    assert "2 time(s)" in store.get("j1")["error"]
+
+
+def test_worker_abandons_a_lost_lease(queue, store, monkeypatch):
+    async def runner(job_id: str) -> None:
+        await asyncio.sleep(10)
+
+    store.create(_job("j1"))
+    queue.enqueue("j1", "enhance", 10)
+    monkeypatch.setattr(queue, "extend", lambda lease, vt: False)
+    qw = QueueWorker(queue, runner, visibility_timeout=0.15, poll_interval=0.01)
+    _run_worker(qw, lambda: qw.lost_leases == 1)
+    assert qw.processed == 0 and qw.running == 0
+
+
+def test_worker_stop_nacks_running_jobs(queue, store):
+    async def runner(job_id: str) -> None:
+        await asyncio.sleep(10)
+
+    store.create(_job("j1"))
+    queue.enqueue("j1", "enhance", 10)
+    # 其余消费者停止时可能正在 reserve：领到的任务同样放回
+    qw = QueueWorker(queue, runner, concurrency=4, poll_interval=0.001)
+    _run_worker(qw, lambda: qw.running == 1)
+    assert queue.state("j1") == "ready"
+    lease = queue.reserve({}, 60)
+    assert lease.deliveries == 1
+
+
+def test_worker_respects_type_limits(queue, store):
+    running = {"now": 0, "peak": 0}
+
+    async def runner(job_id: str) -> None:
+        running["now"] += 1
+        running["peak"] = max(running["peak"], running["now"])
+        await asyncio.sleep(0.05)
+        running["now"] -= 1
+        store.update(job_id, status="finished")
+
+    for i in range(4):
+        store.create(_job(f"g{i}"))
+        queue.enqueue(f"g{i}", "hairstyle_grid", 10)
+    qw = QueueWorker(queue, runner, concurrency=4, poll_interval=0.01, type_limits={"hairstyle_grid": 2})
+    _run_worker(qw, lambda: qw.processed == 4)
+    assert running["peak"] == 2
+
+
+def test_worker_stop_returns_a_job_reserved_while_stopping(queue, store, monkeypatch):
+    reserve = queue.reserve
+
+    def slow_reserve(type_limits, visibility_timeout):
+        time.sleep(0.2)  # 停止时 reserve 仍在线程中执行
+        return reserve(type_limits, visibility_timeout)
+
+    async def runner(job_id: str) -> None:
+        raise AssertionError("should not run")
+
+    store.create(_job("j1"))
+    queue.enqueue("j1", "enhance", 10)
+    monkeypatch.setattr(queue, "reserve", slow_reserve)
+    qw = QueueWorker(queue, runner, concurrency=1, poll_interval=0.01)
+    started = time.monotonic()
+    _run_worker(qw, lambda: time.monotonic() - started > 0.05)
+    time.sleep(0.3)
+    assert queue.state("j1") == "ready"
+    assert reserve({}, 60).deliveries == 1
@@ -0,0 +1,130 @@
+from __future__ import annotations
+import asyncio
+import random
+import time
+from typing import List
+
+import httpx
+import pytest
+
+from api.services.errors import ProviderError
+from api.services.resilience import CircuitBreaker, CircuitOpenError, Resilience, RetryPolicy, TokenBucket
+
+
+def test_breaker_opens_after_consecutive_outages(monkeypatch):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+    for _ in range(2):
+        breaker.on_failure(outage=True)
+    # 上游有响应的失败（如 400）打断连续计数
+    breaker.on_failure(outage=False)
+    for _ in range(2):
+        breaker.on_failure(outage=True)
+    assert breaker.state == "closed"
+    breaker.on_success()
+    for _ in range(3):
+        breaker.on_failure(outage=True)
+    assert breaker.state == "open" and breaker.opens == 1
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call("primary")
+
+    # reset_timeout 之后半开：只放行一个探测请求
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    breaker.before_call("primary")
+    assert breaker.state == "half_open" and not breaker.allows()
+    breaker.on_failure(outage=True)
+    assert breaker.state == "open" and breaker.opens == 2
+
+    monkeypatch.setattr(time, "monotonic", lambda: now + 30)
+    breaker.before_call("primary")
+    breaker.on_success()
+    assert breaker.state == "closed" and breaker.allows()
+
+
+def test_backoff_is_jittered_and_capped():
+    random.seed(1)
+    policy = RetryPolicy(base_delay=0.5, max_delay=4.0)
+    for attempt in range(6):
+        cap = min(4.0, 0.5 * 2 ** attempt)
+        delays = [policy.delay(attempt) for _ in range(200)]
+        assert all(0 <= d <= cap for d in delays)
+        assert max(delays) > cap * 0.8  # full jitter：取值覆盖整个区间
+    # Retry-After 是下限，但不超过 max_delay
+    assert policy.delay(0, retry_after=2.5) == 2.5
+    assert policy.delay(0, retry_after=60) == 4.0
+
+
+def _resilience(max_attempts: int = 3, rate: float = 0) -> Resilience:
+    return Resilience(
+        "primary",
+        retry=RetryPolicy(max_attempts=max_attempts, base_delay=0.001, max_delay=0.01),
+        bucket=TokenBucket(rate=rate),
+        breaker=CircuitBreaker(failure_threshold=10, reset_timeout=60),
+    )
+
+
+def _failing(errors: List[Exception]):
+    calls = {"n": 0}
+
+    async def fn() -> List[bytes]:
+        calls["n"] += 1
+        if errors:
+            raise errors.pop(0)
+        return [b"image"]
+
+    return fn, calls
+
+
+def test_retries_only_retryable_failures(run):
+    res = _resilience()
+    network = ProviderError("connect failed")
+    network.__cause__ = httpx.ConnectError("refused")
+    fn, calls = _failing([ProviderError("busy", status_code=503), network])
+    assert run(res.call(fn)) == [b"image"]
+    assert calls["n"] == 3
+    assert res.retries_by_status == {"503": 1, "ConnectError": 1}
+
+    # 400 不重试
+    fn, calls = _failing([ProviderError("bad request", status_code=400)])
+    with pytest.raises(ProviderError, match="bad request"):
+        run(res.call(fn))
+    assert calls["n"] == 1
+
+    # 重试次数用尽
+    fn, calls = _failing([ProviderError("busy", status_code=503) for _ in range(5)])
+    with pytest.raises(ProviderError, match="busy"):
+        run(res.call(fn))
+    assert calls["n"] == 3
+
+
+def test_429_retry_after_pauses_the_backend(run):
+    res = _resilience(max_attempts=2)
+    fn, calls = _failing([ProviderError("slow down", status_code=429, retry_after=0.2)])
+
+    async def main():
+        started = time.monotonic()
+        await res.call(fn)
+        return time.monotonic() - started
+
+    # 重试至少等待 Retry-After；暂停作用于整个后端的令牌桶
+    assert run(main()) >= 0.2
+    assert calls["n"] == 2 and res.bucket.waits == 1
+
+
+def test_token_bucket(run):
+    async def timed(bucket: TokenBucket, n: int) -> float:
+        started = time.monotonic()
+        for _ in range(n):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    # 容量 2 立即可用，其余按 20 个/秒补充
+    bucket = TokenBucket(rate=20, burst=2)
+    elapsed = run(timed(bucket, 6))
+    assert 0.18 <= elapsed < 0.4
+    assert bucket.waits == 4
+    assert run(timed(TokenBucket(rate=0), 100)) < 0.05
+
+    paused = TokenBucket(rate=0)
+    paused.pause(0.1)
+    assert run(timed(paused, 1)) >= 0.1
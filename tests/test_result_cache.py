@@ -0,0 +1,38 @@
+from __future__ import annotations
+from pathlib import Path
+
+from api.services.result_cache import ResultCache
+from api.storage import blob_store
+
+
+def _put(cache: ResultCache, key: str, data: bytes, stage: str = "result") -> None:
+    digest, _ = blob_store.put_bytes(data, "png")
+    cache.put(key, digest, stage=stage)
+    blob_store.decref([digest])
+
+
+def test_stage_entries_have_their_own_budget(tmp_path: Path):
+    cache = ResultCache(tmp_path / "cache.db", max_bytes=250, stage_max_bytes=150)
+    _put(cache, "r0", b"r0" * 50)
+    _put(cache, "r1", b"r1" * 50)
+    # 大量阶段条目只淘汰阶段条目，不挤掉上游结果
+    for i in range(3):
+        _put(cache, f"p{i}", f"p{i}".encode() * 50, stage="postprocess")
+    assert cache.get("r0") is not None and cache.get("r1") is not None
+    assert cache.get("p0", "postprocess") is None and cache.get("p2", "postprocess") is not None
+    assert cache.stats()["bytes"] == 200 and cache.stats()["stage_bytes"] == 100
+
+    # 上游结果超出自己的上限：淘汰最久未访问的结果
+    cache.get("r0")
+    _put(cache, "r2", b"r2" * 50)
+    assert cache.get("r1") is None
+    assert cache.get("r0") is not None and cache.get("p2", "postprocess") is not None
+    assert cache.evictions == 3  # p0、p1、r1
+
+
+def test_get_any_counts_one_lookup(tmp_path: Path):
+    cache = ResultCache(tmp_path / "cache.db", max_bytes=1 << 20, stage_max_bytes=1 << 20)
+    _put(cache, "model-b", b"result")
+    assert cache.get_any(["model-a", "model-b"]) is not None
+    assert cache.get_any(["model-a", "model-c"]) is None
+    assert (cache.hits, cache.misses) == (1, 1)
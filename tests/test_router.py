@@ -0,0 +1,88 @@
+from __future__ import annotations
+import asyncio
+import time
+
+import pytest
+
+from api.config import settings
+from api.services.errors import ProviderError
+from api.services.router import ProviderRouter
+from conftest import make_backend
+
+
+@pytest.mark.parametrize("status", ["503", "429"])
+def test_fails_over_when_primary_errors(stub_provider, run, input_png, status):
+    bad = stub_provider("--latency-median", "0", "--error-rate", "1", "--error-status", status)
+    good = stub_provider("--latency-median", "0")
+    primary, secondary = make_backend("primary", bad.base_url), make_backend("secondary", good.base_url)
+    router = ProviderRouter([primary, secondary])
+
+    imgs = run(router.edit(input_png, "enhance"))
+    assert len(imgs) == 1
+    assert router.failovers == 1
+    assert (primary.failures, secondary.failures) == (1, 0)
+    assert (bad.stats()["requests"], good.stats()["requests"]) == (1, 1)
+
+
+def test_hedges_slow_primary_and_cancels_the_loser(stub_provider, run, input_png):
+    slow = stub_provider("--latency-median", "1.5")
+    fast = stub_provider("--latency-median", "0.05")
+    primary, secondary = make_backend("primary", slow.base_url), make_backend("secondary", fast.base_url)
+    # 历史样本：primary 通常更快（排在前面），p95 即对冲等待时间
+    for _ in range(settings.ROUTER_MIN_SAMPLES):
+        primary.record(True, 0.1)
+        secondary.record(True, 0.2)
+    router = ProviderRouter([primary, secondary], hedge=True)
+
+    async def main():
+        started = time.monotonic()
+        imgs = await router.edit(input_png, "enhance")
+        elapsed = time.monotonic() - started
+        await asyncio.sleep(0.05)  # 让被取消的调用完成清理
+        leftover = [t for t in asyncio.all_tasks() if t.get_name() == "provider:primary"]
+        return imgs, elapsed, leftover
+
+    imgs, elapsed, leftover = run(main())
+    assert len(imgs) == 1
+    assert elapsed < 1.0
+    assert (router.hedges, router.hedge_wins) == (1, 1)
+    # 落败的 primary 调用被取消：没有残留任务、不在途，也不计入它的成败统计
+    assert leftover == []
+    assert primary.resilience.in_flight == 0
+    assert primary.requests == settings.ROUTER_MIN_SAMPLES
+    assert slow.stats()["requests"] == 1
+
+
+def test_open_breaker_short_circuits(stub_provider, run, input_png):
+    stub = stub_provider("--latency-median", "0")
+    backend = make_backend("primary", stub.base_url, failure_threshold=1)
+    backend.resilience.breaker.on_failure(outage=True)
+    assert backend.resilience.breaker.state == "open"
+    router = ProviderRouter([backend])
+
+    with pytest.raises(ProviderError):
+        run(router.edit(input_png, "enhance"))
+    assert backend.resilience.short_circuited == 1
+    assert stub.stats()["requests"] == 0
+
+
+def test_open_breaker_routes_to_the_next_backend(stub_provider, run, input_png):
+    broken = stub_provider("--latency-median", "0")
+    good = stub_provider("--latency-median", "0")
+    primary = make_backend("primary", broken.base_url, failure_threshold=1)
+    primary.resilience.breaker.on_failure(outage=True)
+    router = ProviderRouter([primary, make_backend("secondary", good.base_url)])
+
+    assert len(run(router.edit(input_png, "enhance"))) == 1
+    assert (broken.stats()["requests"], good.stats()["requests"]) == (0, 1)
+
+
+def test_serve_reports_the_model_that_answered(stub_provider, run, input_png):
+    bad = stub_provider("--latency-median", "0", "--error-rate", "1", "--error-status", "503")
+    good = stub_provider("--latency-median", "0")
+    router = ProviderRouter(
+        [make_backend("a", bad.base_url, model="model-a"), make_backend("b", good.base_url, model="model-b")]
+    )
+    assert router.models == ["model-a", "model-b"]
+    imgs, model = run(router.serve(input_png, "enhance"))
+    assert len(imgs) == 1 and model == "model-b"
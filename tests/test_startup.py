@@ -0,0 +1,74 @@
+from __future__ import annotations
+import asyncio
+import importlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+from api.app import app
+from api.config import settings
+from api.startup import Startup
+
+
+@pytest.fixture
+def fresh_startup(monkeypatch) -> Startup:
+    """尚未启动的就绪状态：替换 api.app 中的全局 startup（其他测试已经启动过应用）。"""
+    state = Startup()
+    monkeypatch.setattr(importlib.import_module("api.app"), "startup", state)
+    return state
+
+
+def test_ready_follows_the_startup_sequence(fresh_startup):
+    client = TestClient(app)
+    # 启动流程执行之前：存活但未就绪
+    assert client.get("/health").json() == {"status": "ok"}
+    resp = client.get("/ready")
+    assert resp.status_code == 503 and resp.json()["status"] == "starting"
+
+    with client:
+        resp = client.get("/ready")
+        assert resp.status_code == 200
+        body = resp.json()
+        assert body["status"] == "ready"
+        assert {"serving", "ready"} <= set(body["milestones"])
+        assert {"storage", "http", "workers"} <= set(body["phases"])
+
+    # 关闭期间（及之后）：负载均衡器不再转发
+    resp = client.get("/ready")
+    assert resp.status_code == 503 and resp.json()["status"] == "stopping"
+
+
+def test_warm_up_gates_readiness(run, monkeypatch):
+    monkeypatch.setattr(settings, "STARTUP_WARMUP", True)
+    monkeypatch.setattr(settings, "WARMUP_TIMEOUT", 0.05)
+    state = Startup()
+
+    async def ok():
+        pass
+
+    async def broken():
+        raise RuntimeError("no route to host")
+
+    async def slow():
+        await asyncio.sleep(1)
+
+    state.serving()
+    assert state.state == "warming" and not state.ready
+    run(state.warm_up({"ok": ok, "broken": broken, "slow": slow}))
+    # 预热失败只记录，不阻止就绪
+    assert state.ready
+    assert state.warmup == {
+        "ok": "ok",
+        "broken": "RuntimeError: no route to host",
+        "slow": "timed out after 0.05s",
+    }
+    assert {"warmup", "warmup_ok", "warmup_broken", "warmup_slow"} <= set(state.phases)
+
+
+def test_stopping_during_warm_up_stays_unready(run, monkeypatch):
+    monkeypatch.setattr(settings, "STARTUP_WARMUP", True)
+    state = Startup()
+    state.serving()
+    state.stopping()
+    run(state.warm_up({}))
+    assert state.state == "stopping" and not state.ready
@@ -0,0 +1,139 @@
+from __future__ import annotations
+import asyncio
+import hashlib
+import sqlite3
+import time
+from pathlib import Path
+
+import pytest
+
+from api.job_store import SQLiteJobStore, publish_job_blobs
+from api.retention import RetentionPolicy, RetentionService
+from api.storage import BlobStore
+
+
+@pytest.fixture
+def blobs(tmp_path: Path) -> BlobStore:
+    return BlobStore(tmp_path / "blobs", tmp_path / "blobs.db")
+
+
+def _refs(blobs: BlobStore, digest: str):
+    row = blobs._conn.execute("SELECT refs FROM blobs WHERE digest = ?", (digest,)).fetchone()
+    return row[0] if row else None
+
+
+def _age(blobs: BlobStore, seconds: float) -> None:
+    blobs._conn.execute("UPDATE blobs SET updated_at = updated_at - ?", (seconds,))
+
+
+def test_identical_content_is_stored_once(blobs, tmp_path: Path):
+    digest, path = blobs.put_bytes(b"content", "png")
+    again, same = blobs.put_bytes(b"content", "png")
+    assert (again, same) == (digest, path) and digest == hashlib.sha256(b"content").hexdigest()
+    assert path == tmp_path / "blobs" / digest[:2] / digest[2:4] / f"{digest}.png"
+    # 已存在的内容：丢弃临时文件，只增加引用
+    src = tmp_path / "upload.tmp"
+    src.write_bytes(b"content")
+    assert blobs.put_file(src, digest, "png") == path and not src.exists()
+    assert _refs(blobs, digest) == 3
+    assert (blobs.bytes_written, blobs.writes_skipped) == (7, 2)
+    assert blobs.stats()["blobs"] == 1 and blobs.stats()["bytes"] == 7
+
+
+def test_incref_and_decref(blobs):
+    digest, path = blobs.put_bytes(b"content", "png")
+    assert blobs.incref(digest) == path and _refs(blobs, digest) == 2
+    assert blobs.incref("0" * 64) is None
+    blobs.decref([digest, digest, digest])
+    assert _refs(blobs, digest) == 0  # 不会减到负数
+    assert blobs.stats()["unreferenced"] == 1
+    # 文件已被外部删除：incref 失败，不增加引用
+    path.unlink()
+    assert blobs.incref(digest) is None and _refs(blobs, digest) == 0
+
+
+def test_rewrite_of_a_missing_file_keeps_refs(blobs):
+    digest, path = blobs.put_bytes(b"content", "png")
+    blobs.put_bytes(b"content", "png")
+    path.unlink()
+    # 文件丢失后重新写入：已有的两个引用不能被重置为 1
+    _, again = blobs.put_bytes(b"content", "png")
+    assert again.read_bytes() == b"content"
+    assert _refs(blobs, digest) == 3
+
+
+def test_gc_removes_row_and_file_together(blobs):
+    kept, kept_path = blobs.put_bytes(b"kept", "png")
+    gone, gone_path = blobs.put_bytes(b"gone", "png")
+    fresh, fresh_path = blobs.put_bytes(b"fresh", "png")
+    blobs.decref([gone, fresh])
+    _age(blobs, 10)
+    blobs._conn.execute("UPDATE blobs SET updated_at = ? WHERE digest = ?", (time.time(), fresh))
+
+    assert blobs.gc(grace=5, dry_run=True) == (1, 4)
+    assert gone_path.exists()
+    assert blobs.gc(grace=5) == (1, 4)
+    assert _refs(blobs, gone) is None and not gone_path.exists()
+    # 仍有引用的、以及仍在宽限期内的都保留
+    assert kept_path.exists() and _refs(blobs, kept) == 1
+    assert fresh_path.exists() and _refs(blobs, fresh) == 0
+    # 被回收的内容再次写入：重新建立记录与文件
+    _, path = blobs.put_bytes(b"gone", "png")
+    assert path.exists() and _refs(blobs, gone) == 1
+
+
+def test_gc_skips_a_blob_referenced_again(blobs):
+    digest, path = blobs.put_bytes(b"content", "png")
+    blobs.decref([digest])
+    _age(blobs, 10)
+    assert blobs.incref(digest) == path
+    assert blobs.gc(grace=0) == (0, 0)
+    assert path.exists() and _refs(blobs, digest) == 1
+
+
+def test_blob_quota_respects_gc_grace(tmp_path: Path, blobs):
+    jobs = SQLiteJobStore(tmp_path / "jobs.db")
+    for i in range(3):
+        digest, _ = blobs.put_bytes(bytes([i]) * 100, "png")
+        jobs.create({"id": f"j{i}", "type": "enhance", "status": "finished", "progress": 100, "params": {},
+                     "results": [], "result_blobs": [digest], "created_at": time.time() - 100 + i})
+    service = RetentionService({"blobs": RetentionPolicy(max_bytes=150)}, jobs, blobs, batch=1)
+
+    asyncio.run(service._enforce_blob_quota(service.policies["blobs"]))
+    # 只删除最旧的任务直到引用的字节数低于配额；引用刚释放的 blob 要等宽限期过后才回收
+    assert [j["id"] for j in jobs.list("finished", None, 10)] == ["j2"]
+    assert blobs.stats()["bytes"] == 300 and blobs.stats()["unreferenced"] == 2
+
+    _age(blobs, 7200)
+    asyncio.run(service._enforce_blob_quota(service.policies["blobs"]))
+    assert blobs.stats()["bytes"] == 100
+    assert service.objects_removed == {"jobs": 2, "blobs": 2}
+
+
+def test_public_backfill_after_upgrade(tmp_path: Path):
+    db = tmp_path / "blobs.db"
+    old = sqlite3.connect(str(db))
+    old.execute(
+        "CREATE TABLE blobs (digest TEXT PRIMARY KEY, ext TEXT NOT NULL, size INTEGER NOT NULL, "
+        "refs INTEGER NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+    )
+    old.executemany(
+        "INSERT INTO blobs VALUES (?, 'png', 1, 1, 0, 0)", [("input",), ("result",), ("variant",)]
+    )
+    old.commit()
+    old.close()
+
+    blobs = BlobStore(tmp_path / "blobs", db)
+    blobs.open()
+    assert blobs.needs_public_backfill
+    jobs = SQLiteJobStore(tmp_path / "jobs.db")
+    jobs.create({"id": "j1", "type": "enhance", "status": "finished", "progress": 100, "params": {},
+                 "results": [], "input_sha256": "input", "result_blobs": ["result"], "variant_blobs": ["variant"],
+                 "created_at": time.time()})
+    assert publish_job_blobs(jobs, blobs) == 2
+    # 只有任务结果可公开，上传的输入图不提供
+    assert [blobs.is_public(d) for d in ("input", "result", "variant")] == [False, True, True]
+    # 再次启动不再回填
+    reopened = BlobStore(tmp_path / "blobs", db)
+    reopened.open()
+    assert not reopened.needs_public_backfill
@@ -0,0 +1,121 @@
+from __future__ import annotations
+import base64
+import json
+import os
+import random
+import time
+from typing import List
+
+import pytest
+from fastapi.testclient import TestClient
+
+from api.app import app
+from api.services.b64stream import DataUrlScanner, SseContentReader
+from api.services.proxy_adapter import ProxyAdapter
+from api.services.router import provider_router
+from conftest import make_backend, png_bytes
+
+IMAGES = [os.urandom(n) for n in (300, 301, 302, 3000)]  # 覆盖 0 / 1 / 2 个填充字符
+
+
+def data_url(img: bytes) -> bytes:
+    return b"data:image/png;base64," + base64.b64encode(img)
+
+
+def scan(chunks: List[bytes]) -> List[bytes]:
+    scanner = DataUrlScanner()
+    out: List[bytes] = []
+    for chunk in chunks:
+        out += scanner.feed(chunk)
+    return out + scanner.close()
+
+
+def split(data: bytes, rnd: random.Random, max_cuts: int = 20) -> List[bytes]:
+    cuts = sorted(rnd.sample(range(1, len(data)), min(len(data) - 1, rnd.randint(0, max_cuts))))
+    return [data[a:b] for a, b in zip([0, *cuts], [*cuts, len(data)])]
+
+
+def sse_event(content: str, finish_reason=None) -> bytes:
+    choice = {"delta": {"content": content}, "finish_reason": finish_reason}
+    return b"data: " + json.dumps({"choices": [choice]}).encode() + b"\n\n"
+
+
+@pytest.mark.parametrize(
+    "body, expected",
+    [
+        (b"![a](" + data_url(IMAGES[0]) + b") text ![b](" + data_url(IMAGES[1]) + b")", IMAGES[:2]),
+        # 两张图片之间没有任何分隔符：无填充、以及带填充的情况
+        (data_url(IMAGES[0]) + data_url(IMAGES[3]), [IMAGES[0], IMAGES[3]]),
+        (data_url(IMAGES[1]) + data_url(IMAGES[2]) + data_url(IMAGES[0]), [IMAGES[1], IMAGES[2], IMAGES[0]]),
+        # JSON 转义的 "\/"
+        (json.dumps({"content": (data_url(IMAGES[2]) + b'"' + data_url(IMAGES[1])).decode()})
+         .replace("/", "\\/").encode(), [IMAGES[2], IMAGES[1]]),
+    ],
+    ids=["markdown", "back-to-back", "back-to-back-padded", "json-escaped"],
+)
+def test_scanner_handles_any_chunk_boundaries(body, expected):
+    rnd = random.Random(0)
+    assert scan([body]) == expected
+    for _ in range(200):
+        assert scan(split(body, rnd)) == expected
+
+
+def test_scanner_across_sse_deltas():
+    a, b = data_url(IMAGES[0]).decode(), data_url(IMAGES[3]).decode()
+    # 第一张图片在选择结束（finish_reason）处结束，第二张被拆在多个增量里，紧接着就是 [DONE]
+    stream = (
+        sse_event(a[:100]) + sse_event(a[100:], finish_reason="stop")
+        + sse_event(b[:7]) + sse_event(b[7:2000]) + sse_event(b[2000:]) + b"data: [DONE]\n\n"
+    )
+    rnd = random.Random(1)
+    for _ in range(100):
+        reader, scanner, images = SseContentReader(), DataUrlScanner(), []
+        for chunk in split(stream, rnd, max_cuts=40):
+            for piece in reader.feed(chunk):
+                images += scanner.feed(piece)
+        # finish_reason / [DONE] 即边界：不需要 close() 也已取出两张
+        assert images == [IMAGES[0], IMAGES[3]]
+        assert reader.done
+
+
+def test_on_image_fires_before_the_call_returns(stub_provider, run, input_png):
+    stub = stub_provider("--latency-median", "0", "--payload-kb", "48", "--images-per-response", "2",
+                         "--stream-delay", "0.05")
+    adapter = ProxyAdapter(api_key="stub", base_url=stub.base_url, model="stub-model", stream=True)
+    seen: List[float] = []
+
+    async def on_image(img: bytes) -> None:
+        seen.append(time.monotonic())
+
+    async def main():
+        imgs = await adapter.call_edit(input_png, "enhance", on_image=on_image)
+        return imgs, time.monotonic()
+
+    imgs, returned = run(main())
+    assert len(imgs) == 2 and len(seen) == 2
+    # 第一张在整个响应结束之前就已送出
+    assert returned - seen[0] >= 0.1
+
+
+def test_partial_results_are_published_before_the_job_finishes(stub_provider, monkeypatch):
+    stub = stub_provider("--latency-median", "0", "--payload-kb", "48", "--images-per-response", "2",
+                         "--stream-delay", "0.05")
+    monkeypatch.setattr(provider_router, "backends", [make_backend("stub", stub.base_url, stream=True)])
+
+    with TestClient(app) as client:
+        resp = client.post(
+            "/api/jobs",
+            data={"type": "enhance"},
+            files={"file": ("in.png", png_bytes(random.randrange(1 << 30)), "image/png")},
+        )
+        job_id = resp.json()["job_id"]
+        snapshots = []
+        with client.stream("GET", f"/api/jobs/{job_id}/events") as events:
+            for line in events.iter_lines():
+                if line.startswith("data:"):
+                    snapshots.append(json.loads(line[5:]))
+
+    assert snapshots[-1]["status"] == "finished" and len(snapshots[-1]["results"]) == 2
+    partial = [s for s in snapshots if s["status"] == "running" and s["results"]]
+    assert partial, [(s["status"], len(s["results"])) for s in snapshots]
+    assert len(partial[0]["results"]) == 1
@@ -0,0 +1,112 @@
+from __future__ import annotations
+import hashlib
+import io
+import random
+from typing import Iterator, Set
+
+import pytest
+from fastapi import UploadFile
+from fastapi.testclient import TestClient
+
+from api.app import app
+from api.config import settings
+from api.storage import BLOBS_TMP_DIR, UnsupportedImage, UploadTooLarge, blob_store, ingest_upload
+from conftest import png_bytes
+
+LIMIT = 4096
+BOUNDARY = "test-boundary"
+
+
+@pytest.fixture
+def client(monkeypatch) -> Iterator[TestClient]:
+    monkeypatch.setattr(settings, "MAX_UPLOAD_BYTES", LIMIT)
+    with TestClient(app) as client:
+        yield client
+
+
+def _tmp_files() -> Set[str]:
+    return {p.name for p in BLOBS_TMP_DIR.glob("upload-*")}
+
+
+def _oversized() -> bytes:
+    # 合法的图片文件头 + 超出上限的内容
+    return png_bytes(random.randrange(1 << 30)) + b"\0" * (LIMIT * 2)
+
+
+def _multipart(payload: bytes) -> bytes:
+    return b"".join([
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="type"\r\n\r\nenhance\r\n'.encode(),
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="in.png"\r\n'.encode(),
+        b"Content-Type: image/png\r\n\r\n",
+        payload,
+        f"\r\n--{BOUNDARY}--\r\n".encode(),
+    ])
+
+
+def test_content_length_over_limit_is_rejected_before_parsing(client):
+    resp = client.post(
+        "/api/jobs",
+        data={"type": "enhance"},
+        files={"file": ("in.png", _oversized() + b"\0" * 128 * 1024, "image/png")},
+    )
+    assert resp.status_code == 413
+    assert resp.json()["detail"] == f"upload exceeds {LIMIT} bytes"
+
+
+def test_chunked_body_over_limit_is_rejected_while_streaming(client):
+    before = _tmp_files()
+    body = _multipart(_oversized())
+
+    def chunks():
+        # 没有 Content-Length：只能在写入时按累计字节数拒绝
+        for i in range(0, len(body), 1024):
+            yield body[i : i + 1024]
+
+    resp = client.post(
+        "/api/jobs", content=chunks(), headers={"Content-Type": f"multipart/form-data; boundary={BOUNDARY}"}
+    )
+    assert resp.status_code == 413
+    assert resp.json()["detail"] == f"file exceeds {LIMIT} bytes"
+    assert _tmp_files() == before
+
+
+def test_non_image_is_rejected_by_magic_bytes(client):
+    before = _tmp_files()
+    blobs = blob_store.stats()["blobs"]
+    # 声明为 image/png、扩展名为 .png 也不行：按文件头判断
+    resp = client.post(
+        "/api/jobs",
+        data={"type": "enhance"},
+        files={"file": ("in.png", b"<?php echo 'not an image'; ?>" * 10, "image/png")},
+    )
+    assert resp.status_code == 415
+    assert _tmp_files() == before
+    assert blob_store.stats()["blobs"] == blobs
+
+
+def _upload(data: bytes) -> UploadFile:
+    return UploadFile(io.BytesIO(data), filename="../../etc/passwd")
+
+
+def test_ingest_hashes_while_streaming_and_dedups(run):
+    data = png_bytes(random.randrange(1 << 30))
+    first = run(ingest_upload(_upload(data), LIMIT))
+    second = run(ingest_upload(_upload(data), LIMIT))
+
+    assert first.sha256 == hashlib.sha256(data).hexdigest()
+    assert (first.size, first.ext) == (len(data), "png")
+    # 按内容摘要命名：客户端文件名不参与，同一内容只保存一份
+    assert first.path == second.path == blob_store.path(first.sha256, "png")
+    assert first.path.read_bytes() == data
+
+
+@pytest.mark.parametrize(
+    "data, error",
+    [(b"GIF89a" + b"\0" * (LIMIT * 2), UploadTooLarge), (b"hello world, plain text", UnsupportedImage)],
+)
+def test_ingest_cleans_up_rejected_uploads(run, data, error):
+    before = _tmp_files()
+    # UploadFile 不带 size：只能在读取过程中发现超限
+    with pytest.raises(error):
+        run(ingest_upload(_upload(data), LIMIT))
+    assert _tmp_files() == before
@@ -0,0 +1,101 @@
+from __future__ import annotations
+import asyncio
+import random
+import time
+from collections import Counter
+from typing import List
+
+import pytest
+from fastapi.testclient import TestClient
+
+from api.app import app
+from api.config import settings
+from api.services.router import provider_router
+from api.worker_pool import QueueFullError, WorkerPool, worker_pool
+from conftest import make_backend, png_bytes, wait_jobs
+
+
+def _submit(client: TestClient):
+    return client.post(
+        "/api/jobs",
+        data={"type": "enhance"},
+        files={"file": ("in.png", png_bytes(random.randrange(1 << 30)), "image/png")},
+    )
+
+
+def test_full_queue_returns_429_with_retry_after(stub_provider, monkeypatch):
+    stub = stub_provider("--latency-median", "0.5")
+    monkeypatch.setattr(provider_router, "backends", [make_backend("stub", stub.base_url)])
+    with TestClient(app) as client:
+        # 同时只运行一个 enhance，队列中最多一个
+        monkeypatch.setitem(worker_pool.type_limits, "enhance", 1)
+        monkeypatch.setattr(worker_pool, "queue_limit", 1)
+        running = _submit(client).json()["job_id"]
+        while worker_pool.depth:  # 等它被 worker 取走
+            time.sleep(0.01)
+        queued = _submit(client).json()["job_id"]
+
+        resp = _submit(client)
+        assert resp.status_code == 429
+        assert resp.headers["Retry-After"] == str(settings.JOB_QUEUE_RETRY_AFTER)
+        assert resp.json()["detail"] == "Too many queued jobs (1), retry later"
+
+        jobs = wait_jobs(client, [running, queued])
+        assert [j["status"] for j in jobs] == ["finished", "finished"]
+        assert _submit(client).status_code == 200
+
+
+def test_check_capacity(run):
+    async def main():
+        pool = WorkerPool(size=1, queue_limit=2)
+        release = asyncio.Event()
+        await pool.start(lambda job_id: release.wait())
+        try:
+            pool.check_capacity()
+            for i in range(3):
+                pool.submit(f"j{i}", "enhance")
+            await asyncio.sleep(0.01)
+            # 一个运行中、两个排队
+            with pytest.raises(QueueFullError) as e:
+                pool.check_capacity()
+            release.set()
+            return e.value
+        finally:
+            await pool.stop()
+
+    err = run(main())
+    assert (err.depth, err.retry_after) == (2, settings.JOB_QUEUE_RETRY_AFTER)
+
+
+def test_type_limits_and_priority(run):
+    order: List[str] = []
+    running: Counter = Counter()
+    peak: Counter = Counter()
+
+    async def runner(job_id: str) -> None:
+        job_type = job_id.rstrip("0123456789")
+        order.append(job_id)
+        running[job_type] += 1
+        peak[job_type] = max(peak[job_type], running[job_type])
+        await asyncio.sleep(0.02)
+        running[job_type] -= 1
+
+    async def main():
+        pool = WorkerPool(size=3, queue_limit=100, type_limits={"grid": 1})
+        await pool.start(runner)
+        try:
+            for i in range(3):
+                pool.submit(f"grid{i}", "grid", priority=0)
+            for i in range(3):
+                pool.submit(f"low{i}", "enhance", priority=10)
+            await asyncio.sleep(0.01)
+            while pool.depth or pool.stats()["running"]:
+                await asyncio.sleep(0.01)
+        finally:
+            await pool.stop()
+
+    run(main())
+    # grid 同时只运行一个：空出的 worker 执行优先级更低的任务，不必等前面的 grid
+    assert peak == {"grid": 1, "low": 2}
+    assert order[:3] == ["grid0", "low0", "low1"]
+    assert sorted(order) == sorted([*(f"grid{i}" for i in range(3)), *(f"low{i}" for i in range(3))])
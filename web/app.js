@@ -199,7 +199,7 @@ el("submit").addEventListener("click", async () => {
     const r = await fetch("/api/jobs", { method: "POST", body: form });
     if (!r.ok) throw new Error("创建任务失败");
     const { job_id } = await r.json();
-    poll(job_id);
+    watch(job_id);
   } catch (err) {
     setProgress(0, "");
     toast(err.message || "网络错误");
@@ -209,25 +209,48 @@ el("submit").addEventListener("click", async () => {
   }
 });
 
+// 处理一次状态快照；返回 true 表示任务已结束
+function handleStatus(s){
+  setProgress(s.progress ?? 0, s.status);
+  // 多图任务：已完成的子图先展示
+  if (s.status === "running" && (s.results || []).length) renderResults(s);
+  if (s.status === "finished") {
+    renderResults(s);
+    if ((s.failed_slots || []).length) toast(`${s.failed_slots.length} 张生成失败`);
+    else toast("已完成");
+    hideOverlay();
+    return true;
+  }
+  if (s.status === "failed") {
+    statusBox.textContent = `失败：${s.error || "未知错误"}`;
+    toast("处理失败");
+    hideOverlay();
+    return true;
+  }
+  return false;
+}
+
+// 优先使用 SSE 推送进度；不支持或连接出错时回退为轮询
+function watch(jobId){
+  if (!window.EventSource) return poll(jobId);
+  const es = new EventSource(`/api/jobs/${jobId}/events`);
+  let done = false;
+  es.addEventListener("status", (ev) => {
+    try { done = handleStatus(JSON.parse(ev.data)); } catch (_) {}
+    if (done) es.close();
+  });
+  es.onerror = () => {
+    es.close();
+    if (!done) poll(jobId);
+  };
+}
+
 async function poll(jobId){
   const poller = setInterval(async () => {
     try {
       const r = await fetch(`/api/jobs/${jobId}`);
       if (!r.ok) throw new Error("查询失败");
-      const s = await r.json();
-      setProgress(s.progress ?? 0, s.status);
-      if (s.status === "finished") {
-        clearInterval(poller);
-        renderResults(s.results || []);
-        toast("已完成");
-        hideOverlay();
-      }
-      if (s.status === "failed") {
-        clearInterval(poller);
-        statusBox.textContent = `失败：${s.error || "未知错误"}`;
-        toast("处理失败");
-        hideOverlay();
-      }
+      if (handleStatus(await r.json())) clearInterval(poller);
     } catch (e) {
       clearInterval(poller);
       setProgress(0, "");
@@ -245,10 +268,28 @@ function setProgress(p, text){
   }
 }
 
-function renderResults(urls){
-  results.innerHTML = urls.map(u => `
+// 有后处理版本时用 <picture>：浏览器按支持的格式（AVIF/WebP）与显示宽度从 srcset 中选择，JPEG 缩略图兜底；
+// 下载链接始终指向原图
+function pictureHtml(url, v){
+  if (!v || !v.thumbnail) return `<img src="${url}" loading="lazy" class="w-full rounded border border-slate-200"/>`;
+  const byType = {};
+  (v.sources || []).forEach(src => { (byType[src.type] = byType[src.type] || []).push(`${src.url} ${src.width}w`); });
+  const sizes = "(min-width: 768px) 33vw, 100vw";
+  const sources = Object.entries(byType)
+    .map(([type, set]) => `<source type="${type}" srcset="${set.join(", ")}" sizes="${sizes}"/>`)
+    .join("");
+  return `<picture>${sources}<img src="${v.thumbnail}" width="${v.width}" height="${v.height}" loading="lazy" decoding="async" class="w-full h-auto rounded border border-slate-200"/></picture>`;
+}
+
+function renderResults(s){
+  const urls = s.results || [];
+  const variants = s.variants || [];
+  const sheet = s.contact_sheet
+    ? `<div class="col-span-full text-right"><a href="${s.contact_sheet}" download class="text-sm text-blue-600 hover:underline">下载总览图</a></div>`
+    : "";
+  results.innerHTML = sheet + urls.map((u, i) => `
     <figure class="space-y-2">
-      <img src="${u}" class="w-full rounded border border-slate-200"/>
+      ${pictureHtml(u, variants[i])}
       <div class="text-right">
         <a href="${u}" download class="text-sm text-blue-600 hover:underline">下载</a>
       </div>